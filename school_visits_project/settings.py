@@ -42,6 +42,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'visits.access.StaffAccessMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -73,6 +74,27 @@ DATABASES = {
     }
 }
 
+# Caché compartida por todos los workers: además del calendario público y
+# del dashboard guarda las versiones que invalidan el rol y el perfil de las
+# sesiones (ver visits/access.py), así que no puede ser por proceso como
+# LocMemCache. La tabla la crea la migración 0013 (o createcachetable).
+# Con Redis o Memcached disponibles se puede cambiar el backend.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'visits_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    # Solo contadores de aciertos/fallos, por proceso: no merecen una escritura
+    # en la BD en cada petición
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'school-visits',
+    },
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -192,6 +214,14 @@ else:
 DEFAULT_FROM_EMAIL = os.environ.get('EMAIL_HOST_USER', 'no-reply@claretsegovia.es')
 APPOINTMENT_NOTIFICATION_EMAIL = os.environ.get('EMAIL_HOST_USER', 'no-reply@claretsegovia.es')
 
+# Outbox de emails: tras cada commit un hilo envía lo pendiente. Con False solo
+# los envía el comando process_email_outbox (cron o proceso aparte)
+EMAIL_OUTBOX_DRAIN_ON_COMMIT = os.environ.get('EMAIL_OUTBOX_DRAIN_ON_COMMIT', 'True') == 'True'
+
+# Recordatorios diarios: conexiones SMTP en paralelo y tope de envíos del plan de IONOS
+REMINDER_EMAIL_WORKERS = int(os.environ.get('REMINDER_EMAIL_WORKERS', '3'))
+REMINDER_EMAILS_PER_MINUTE = int(os.environ.get('REMINDER_EMAILS_PER_MINUTE', '100'))  # 0 = sin límite
+
 # Configuración de URLs del colegio
 SCHOOL_CONFIG = {
     'name': 'Colegio Claret Segovia',
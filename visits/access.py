@@ -0,0 +1,119 @@
+# visits/access.py
+# ====================================
+# Rol y perfil del usuario por petición
+# ====================================
+#
+# Las vistas del panel necesitan saber si el usuario es supervisor, cuál es su
+# StaffProfile y qué etapas atiende. StaffAccessMiddleware lo deja en
+# request.staff_access, resuelto una vez y guardado en la sesión. Cambiar los
+# grupos del usuario, su perfil o sus etapas renueva su versión (ver
+# signals.py) y la sesión se vuelve a resolver en la siguiente petición. La
+# versión vive en la caché compartida (DatabaseCache, ver settings y
+# checks.py) para que la vean todos los workers; ACCESS_MAX_AGE limita lo que
+# dura una sesión si la versión se pierde (caché vaciada).
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.functional import SimpleLazyObject
+import time
+import logging
+
+from .models import StaffProfile
+
+logger = logging.getLogger(__name__)
+
+SUPERVISOR_GROUP = 'Supervisor'
+SESSION_KEY = 'visits_staff_access'
+ACCESS_MAX_AGE = 5 * 60
+
+
+class StaffAccess:
+    """Rol, id del StaffProfile (None si no tiene) y etapas del usuario"""
+
+    def __init__(self, is_supervisor=False, staff_id=None, stage_ids=()):
+        self.is_supervisor = is_supervisor
+        self.staff_id = staff_id
+        self.stage_ids = list(stage_ids)
+
+    @property
+    def has_profile(self):
+        return self.staff_id is not None
+
+    def __repr__(self):
+        return f"StaffAccess(is_supervisor={self.is_supervisor}, staff_id={self.staff_id}, stage_ids={self.stage_ids})"
+
+
+def _version_key(user_id):
+    return f'visits:staff_access:{user_id}'
+
+
+def resolve_staff_access(user):
+    """Consulta grupo, perfil y etapas del usuario"""
+    is_supervisor = user.groups.filter(name=SUPERVISOR_GROUP).exists()
+    staff_id = StaffProfile.objects.filter(user=user).values_list('id', flat=True).first()
+    stage_ids = []
+    if staff_id is not None:
+        stage_ids = list(StaffProfile.allowed_stages.through.objects.filter(
+            staffprofile_id=staff_id
+        ).values_list('schoolstage_id', flat=True))
+    return StaffAccess(is_supervisor, staff_id, stage_ids)
+
+
+def get_staff_access(request):
+    """StaffAccess de la petición, desde la sesión si sigue vigente"""
+    user = request.user
+    if not user.is_authenticated:
+        return StaffAccess()
+
+    version = cache.get(_version_key(user.pk), 0)
+    entry = request.session.get(SESSION_KEY)
+    if (
+        entry
+        and entry['user_id'] == user.pk
+        and entry['version'] == version
+        and time.time() - entry['resolved_at'] < ACCESS_MAX_AGE
+    ):
+        return StaffAccess(entry['is_supervisor'], entry['staff_id'], entry['stage_ids'])
+
+    access = resolve_staff_access(user)
+    request.session[SESSION_KEY] = {
+        'user_id': user.pk,
+        'version': version,
+        'resolved_at': time.time(),
+        'is_supervisor': access.is_supervisor,
+        'staff_id': access.staff_id,
+        'stage_ids': access.stage_ids,
+    }
+    logger.debug(f"Acceso resuelto para {user.username}: {access}")
+    return access
+
+
+def invalidate_staff_access(user_ids):
+    """
+    Renueva la versión de esos usuarios ya y otra vez tras el commit: una
+    petición que resuelva el acceso entre medias leería aún los datos viejos.
+    """
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return
+
+    def bump():
+        version = time.time_ns()
+        cache.set_many({_version_key(user_id): version for user_id in user_ids}, timeout=None)
+
+    bump()
+    transaction.on_commit(bump)
+
+
+class StaffAccessMiddleware:
+    """
+    Añade request.staff_access (perezoso: solo se resuelve si una vista lo
+    usa). Va después de SessionMiddleware y AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.staff_access = SimpleLazyObject(lambda: get_staff_access(request))
+        return self.get_response(request)
@@ -1,7 +1,8 @@
 from django.contrib import admin
+from django import forms
 from django.utils import timezone
 from django.utils.html import format_html
-from .models import SchoolStage, Course, StaffProfile, Appointment, AvailabilitySlot
+from .models import SchoolStage, Course, StaffProfile, Appointment, AvailabilitySlot, AvailabilityRule, EmailOutbox
 
 # ====================================
 # CourseInline para SchoolStageAdmin
@@ -111,6 +112,7 @@ class AppointmentAdmin(admin.ModelAdmin):
     search_fields = ['visitor_name', 'visitor_email', 'visitor_phone']
     date_hierarchy = 'date'
     readonly_fields = ['created_at']
+    actions = ['mark_completed', 'mark_cancelled', 'mark_pending']
 
     fieldsets = (
         ('Información del visitante', {
@@ -133,6 +135,23 @@ class AppointmentAdmin(admin.ModelAdmin):
         return obj.course.name if obj.course else '-'
     course_display.short_description = 'Curso'
 
+    def _set_status(self, request, queryset, status):
+        updated = Appointment.bulk_set_status(queryset, status)
+        label = dict(Appointment.STATUS_CHOICES)[status]
+        self.message_user(request, f"{updated} citas marcadas como {label}")
+
+    def mark_completed(self, request, queryset):
+        self._set_status(request, queryset, 'completed')
+    mark_completed.short_description = 'Marcar como Realizada'
+
+    def mark_cancelled(self, request, queryset):
+        self._set_status(request, queryset, 'cancelled')
+    mark_cancelled.short_description = 'Marcar como Cancelada'
+
+    def mark_pending(self, request, queryset):
+        self._set_status(request, queryset, 'pending')
+    mark_pending.short_description = 'Marcar como Pendiente'
+
     def formatted_date(self, obj):
         local_dt = timezone.localtime(obj.date)
         return local_dt.strftime("%d/%m/%Y %H:%M")
@@ -142,13 +161,41 @@ class AppointmentAdmin(admin.ModelAdmin):
 # ====================================
 # AvailabilitySlotAdmin
 # ====================================
+class AvailabilitySlotAdminForm(forms.ModelForm):
+    class Meta:
+        model = AvailabilitySlot
+        fields = '__all__'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        staff = cleaned_data.get('staff')
+        stages = cleaned_data.get('stages')
+        if staff and stages:
+            allowed = set(staff.allowed_stages.values_list('id', flat=True))
+            invalid = [stage.name for stage in stages if stage.id not in allowed]
+            if invalid:
+                raise forms.ValidationError({
+                    'stages': f"El staff no tiene asignadas las etapas: {', '.join(invalid)}"
+                })
+        return cleaned_data
+
+
 @admin.register(AvailabilitySlot)
 class AvailabilitySlotAdmin(admin.ModelAdmin):
-    list_display = ['staff', 'stage', 'formatted_date', 'formatted_time', 'duration', 'is_active', 'repeat_type']
-    list_filter = ['staff', 'stage', 'is_active', 'repeat_type', 'date']
+    form = AvailabilitySlotAdminForm
+    list_display = ['staff', 'get_stages', 'formatted_date', 'formatted_time', 'duration', 'is_active', 'repeat_type']
+    list_filter = ['staff', 'stages', 'is_active', 'repeat_type', 'date']
     search_fields = ['staff__user__first_name', 'staff__user__last_name']
     date_hierarchy = 'date'
     list_editable = ['is_active']
+    filter_horizontal = ['stages']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related('stages')
+
+    def get_stages(self, obj):
+        return ", ".join([stage.name for stage in obj.stages.all()])
+    get_stages.short_description = 'Etapas'
 
     def formatted_date(self, obj):
         if obj.date:
@@ -162,7 +209,7 @@ class AvailabilitySlotAdmin(admin.ModelAdmin):
 
     fieldsets = (
         ('Información básica', {
-            'fields': ('staff', 'stage', 'duration', 'is_active')
+            'fields': ('staff', 'stages', 'duration', 'is_active')
         }),
         ('Programación', {
             'fields': ('repeat_type', 'date', 'start_time', 'end_time'),
@@ -184,11 +231,15 @@ class AvailabilitySlotAdmin(admin.ModelAdmin):
                 staff_profile = StaffProfile.objects.get(user=request.user)
                 form.base_fields['staff'].initial = staff_profile
                 form.base_fields['staff'].disabled = True
-                form.base_fields['stage'].queryset = staff_profile.allowed_stages.all()
+                form.base_fields['stages'].queryset = staff_profile.allowed_stages.all()
             except StaffProfile.DoesNotExist:
                 pass
         return form
 
+    def delete_queryset(self, request, queryset):
+        # Borrado masivo sin una señal por slot (ver AvailabilitySlot.delete_batch)
+        AvailabilitySlot.delete_batch(queryset)
+
     def has_change_permission(self, request, obj=None):
         if not obj or request.user.is_superuser:
             return True
@@ -201,4 +252,42 @@ class AvailabilitySlotAdmin(admin.ModelAdmin):
             return True
         if hasattr(request.user, 'staffprofile') and request.user.is_staff:
             return True
-        return obj.staff.user == request.user
\ No newline at end of file
+        return obj.staff.user == request.user
+
+
+# ====================================
+# AvailabilityRuleAdmin
+# ====================================
+@admin.register(AvailabilityRule)
+class AvailabilityRuleAdmin(admin.ModelAdmin):
+    list_display = ['staff', 'weekday', 'month', 'year', 'formatted_time', 'duration', 'is_active']
+    list_filter = ['staff', 'stages', 'is_active', 'year', 'month', 'weekday']
+    search_fields = ['staff__user__first_name', 'staff__user__last_name']
+    filter_horizontal = ['stages']
+
+    def formatted_time(self, obj):
+        return f"{obj.start_time.strftime('%H:%M')} - {obj.end_time.strftime('%H:%M')}"
+    formatted_time.short_description = 'Horario'
+
+
+# ====================================
+# EmailOutboxAdmin
+# ====================================
+@admin.register(EmailOutbox)
+class EmailOutboxAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'to', 'subject', 'status', 'attempts', 'created_at', 'sent_at']
+    list_filter = ['status', 'kind']
+    search_fields = ['to', 'subject']
+    readonly_fields = ['kind', 'appointment', 'to', 'subject', 'html_body', 'attempts', 'last_error', 'created_at', 'sent_at', 'locked_at']
+    actions = ['retry_emails']
+
+    def retry_emails(self, request, queryset):
+        updated = queryset.exclude(status='sent').update(
+            status='pending',
+            attempts=0,
+            next_attempt_at=timezone.now(),
+            locked_at=None
+        )
+        self.message_user(request, f"{updated} emails marcados para reenvío")
+    retry_emails.short_description = 'Reintentar envío'
+
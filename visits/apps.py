@@ -6,4 +6,5 @@ class VisitsConfig(AppConfig):
     name = 'visits'
 
     def ready(self):
-        import visits.signals  # Importamos los signals al iniciar la app
\ No newline at end of file
+        import visits.signals  # Importamos los signals al iniciar la app
+        import visits.checks  # Comprobaciones de configuración (caché compartida)
\ No newline at end of file
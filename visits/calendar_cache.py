@@ -0,0 +1,138 @@
+# visits/calendar_cache.py
+# ====================================
+# Caché del calendario público de disponibilidad
+# ====================================
+#
+# get_stage_availability (sin fecha) devuelve las fechas con huecos de los
+# próximos 90 días. El resumen por fecha (ver scheduling.stage_calendar_summary)
+# se guarda por etapa y, cuando cambian citas o slots, se recalculan solo las
+# fechas afectadas de las etapas implicadas. Cada parche lee, modifica y vuelve
+# a guardar el calendario con un cerrojo por etapa en la caché compartida: dos
+# commits simultáneos no se pisan el parche. Si el cerrojo no llega a tiempo,
+# el calendario se descarta y se recalcula entero en la siguiente lectura.
+
+from django.core.cache import cache, caches
+from django.db import transaction
+from datetime import datetime, timedelta
+import time
+import logging
+
+from .models import StaffProfile
+from .scheduling import stage_calendar_summary
+
+logger = logging.getLogger(__name__)
+
+CALENDAR_DAYS = 90
+CALENDAR_TIMEOUT = 60 * 60
+# El cerrojo caduca solo si el worker que lo tiene muere a mitad de parche
+CALENDAR_LOCK_TIMEOUT = 10
+CALENDAR_LOCK_WAIT = 2
+HITS_KEY = 'visits:stage_calendar:hits'
+MISSES_KEY = 'visits:stage_calendar:misses'
+
+
+def _calendar_key(stage_id):
+    return f'visits:stage_calendar:{stage_id}'
+
+
+def _lock_key(stage_id):
+    return f'visits:stage_calendar:lock:{stage_id}'
+
+
+def _count(key):
+    # Contadores del proceso (caché 'local'): no cuestan una escritura compartida
+    counters = caches['local']
+    if not counters.add(key, 1, timeout=None):
+        counters.incr(key)
+
+
+def get_stage_calendar(stage_id):
+    """
+    Resumen {fecha: {'slots', 'first', 'last'}} de la etapa desde hoy, desde la
+    caché si es posible
+    """
+    today = datetime.now().date()
+    entry = cache.get(_calendar_key(stage_id))
+    if entry and entry['start'] == today:
+        _count(HITS_KEY)
+        return entry['days']
+
+    _count(MISSES_KEY)
+    days = stage_calendar_summary(stage_id, today, today + timedelta(days=CALENDAR_DAYS))
+    cache.set(_calendar_key(stage_id), {'start': today, 'days': days}, CALENDAR_TIMEOUT)
+    return days
+
+
+def _staff_stage_ids(staff_id):
+    return list(StaffProfile.allowed_stages.through.objects.filter(
+        staffprofile_id=staff_id
+    ).values_list('schoolstage_id', flat=True))
+
+
+def _acquire(stage_id):
+    """Espera hasta CALENDAR_LOCK_WAIT segundos por el cerrojo de la etapa"""
+    deadline = time.monotonic() + CALENDAR_LOCK_WAIT
+    while not cache.add(_lock_key(stage_id), 1, CALENDAR_LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def _patch_calendar(stage_id, days):
+    """Recalcula esas fechas en el calendario cacheado de la etapa, si lo hay"""
+    key = _calendar_key(stage_id)
+    if not _acquire(stage_id):
+        cache.delete(key)
+        logger.warning(f"Calendario de la etapa {stage_id} descartado: cerrojo ocupado")
+        return
+    try:
+        # Leído con el cerrojo: incluye el parche del commit anterior
+        entry = cache.get(key)
+        if entry is None:
+            return
+        end = entry['start'] + timedelta(days=CALENDAR_DAYS)
+        for day in days:
+            if not entry['start'] <= day <= end:
+                continue
+            summary = stage_calendar_summary(stage_id, day, day)
+            if day in summary:
+                entry['days'][day] = summary[day]
+            else:
+                entry['days'].pop(day, None)
+        cache.set(key, entry, CALENDAR_TIMEOUT)
+    finally:
+        cache.delete(_lock_key(stage_id))
+
+
+def refresh_calendar_dates(staff_id, days, stage_ids=None):
+    """
+    Recalcula, tras el commit, las fechas indicadas en los calendarios
+    cacheados de `stage_ids` (por defecto, las etapas del staff). Las etapas
+    sin calendario en caché no se tocan.
+    """
+    def patch():
+        for stage_id in (_staff_stage_ids(staff_id) if stage_ids is None else stage_ids):
+            _patch_calendar(stage_id, days)
+        logger.debug(f"Calendarios actualizados para el staff {staff_id}: {sorted(days)}")
+
+    transaction.on_commit(patch)
+
+
+def invalidate_calendars(staff_id):
+    """Descarta, tras el commit, los calendarios de todas las etapas del staff"""
+    transaction.on_commit(
+        lambda: cache.delete_many([_calendar_key(stage_id) for stage_id in _staff_stage_ids(staff_id)])
+    )
+
+
+def calendar_cache_stats():
+    counters = caches['local']
+    hits = counters.get(HITS_KEY, 0)
+    misses = counters.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / total, 3) if total else None,
+    }
@@ -0,0 +1,61 @@
+# visits/calendar_sync.py
+# ====================================
+# Sincronización incremental del calendario del dashboard
+# ====================================
+#
+# FullCalendar vuelve a pedir el rango visible tras cada navegación y cada
+# edición. En modo sync, DashboardCalendarView devuelve un sync_token; con él,
+# la siguiente petición del mismo rango solo recibe las citas creadas o
+# modificadas (updated_at) y las que salieron del rango o del staff
+# (AppointmentTombstone) desde entonces.
+
+from django.utils import timezone
+from datetime import datetime, timedelta, timezone as dt_timezone
+import logging
+
+from .models import Appointment, AppointmentTombstone
+
+logger = logging.getLogger(__name__)
+
+# updated_at se fija al guardar, antes del commit: un token algo anterior al
+# momento de la consulta no pierde transacciones que terminan justo después
+SYNC_OVERLAP = timedelta(seconds=30)
+# Tokens más antiguos (y sus rastros) ya no valen: el cliente recarga el rango
+TOMBSTONE_TTL = timedelta(days=7)
+
+
+def make_sync_token(now=None):
+    return ((now or timezone.now()) - SYNC_OVERLAP).astimezone(dt_timezone.utc).isoformat()
+
+
+def parse_sync_token(token):
+    """Instante del token, o None si no es válido o ya caducó"""
+    try:
+        since = datetime.fromisoformat(token)
+    except (TypeError, ValueError):
+        return None
+    if timezone.is_naive(since) or since < timezone.now() - TOMBSTONE_TTL:
+        return None
+    return since
+
+
+def record_tombstones(rows):
+    """Guarda rastros (appointment_id, staff_id, fecha) y purga los caducados"""
+    AppointmentTombstone.objects.filter(deleted_at__lt=timezone.now() - TOMBSTONE_TTL).delete()
+    AppointmentTombstone.objects.bulk_create([
+        AppointmentTombstone(appointment_id=appointment_id, staff_id=staff_id, date=date)
+        for appointment_id, staff_id, date in rows
+    ])
+
+
+def calendar_changes(staff_id, start, end, since):
+    """
+    Citas del rango modificadas desde `since` (queryset) e ids de las que
+    hay que quitar. `staff_id` None es la vista global.
+    """
+    changed = Appointment.objects.filter(updated_at__gte=since, date__range=(start, end))
+    removed = AppointmentTombstone.objects.filter(deleted_at__gte=since, date__range=(start, end))
+    if staff_id is not None:
+        changed = changed.filter(staff_id=staff_id)
+        removed = removed.filter(staff_id=staff_id)
+    return changed, sorted(set(removed.values_list('appointment_id', flat=True)))
@@ -0,0 +1,31 @@
+# visits/checks.py
+# ====================================
+# Comprobaciones de configuración
+# ====================================
+
+from django.conf import settings
+from django.core.checks import Warning, register
+
+PER_PROCESS_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Las versiones que invalidan el acceso de las sesiones y las cachés del
+    calendario y del dashboard tienen que verlas todos los workers.
+    """
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend in PER_PROCESS_CACHES:
+        return [Warning(
+            f'La caché por defecto ({backend}) no se comparte entre procesos.',
+            hint=(
+                'Con varios workers, un cambio de rol o de etapas no se vería en los demás '
+                'hasta ACCESS_MAX_AGE. Usa DatabaseCache, Redis o Memcached.'
+            ),
+            id='visits.W001',
+        )]
+    return []
@@ -0,0 +1,99 @@
+# visits/dashboard_cache.py
+# ====================================
+# Caché de las respuestas del dashboard
+# ====================================
+#
+# dashboard.html y appointments_crud.js piden estadísticas y calendario tras
+# cada alta, cambio o borrado, y varios supervisores suelen mirar a la vez la
+# vista global. Las respuestas se guardan unos segundos por (vista, rol,
+# ámbito, parámetros). Cada staff tiene una generación, y la vista global otra:
+# un cambio en las citas de un staff renueva su generación y la global, así que
+# las claves antiguas dejan de usarse sin tener que buscarlas. Generaciones y
+# respuestas están en la caché compartida: un cambio atendido por un worker
+# invalida las respuestas de todos. El TTL cubre lo que no pasa por las citas
+# (nombres de etapas, staff, permisos...).
+
+from django.core.cache import cache, caches
+from django.db import transaction
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DASHBOARD_TIMEOUT = 30
+GLOBAL_SCOPE = 'global'
+HITS_KEY = 'visits:dashboard:hits'
+MISSES_KEY = 'visits:dashboard:misses'
+
+
+def _generation_key(scope):
+    return f'visits:dashboard:generation:{scope}'
+
+
+def _count(key):
+    # Contadores del proceso (caché 'local'): no cuestan una escritura compartida
+    counters = caches['local']
+    if not counters.add(key, 1, timeout=None):
+        counters.incr(key)
+
+
+def _generation(scope):
+    """
+    Generación actual del ámbito. Si falta (aún sin cambios, o descartada por
+    la caché) se crea una nueva: nunca coincide con la de entradas anteriores.
+    cache.add hace que todos los workers se queden con la misma.
+    """
+    key = _generation_key(scope)
+    generation = cache.get(key)
+    if generation is None:
+        generation = time.time_ns()
+        if not cache.add(key, generation, timeout=None):
+            generation = cache.get(key, generation)
+    return generation
+
+
+def get_dashboard_data(view, role, scope, params, compute):
+    """
+    Devuelve los datos de `view` para (rol, ámbito, parámetros) desde la caché,
+    o los calcula con `compute()` y los guarda. `scope` es el id del staff o
+    GLOBAL_SCOPE.
+    """
+    generation = _generation(scope)
+    key = f"visits:dashboard:{view}:{role}:{scope}:{generation}:{':'.join(str(param) for param in params)}"
+
+    data = cache.get(key)
+    if data is not None:
+        _count(HITS_KEY)
+        return data
+
+    _count(MISSES_KEY)
+    data = compute()
+    cache.set(key, data, DASHBOARD_TIMEOUT)
+    return data
+
+
+def invalidate_dashboards(staff_ids):
+    """Renueva, tras el commit, la generación de esos staff y la de la vista global"""
+    scopes = {staff_id for staff_id in staff_ids if staff_id is not None}
+    if not scopes:
+        return
+    scopes.add(GLOBAL_SCOPE)
+
+    def bump():
+        generation = time.time_ns()
+        cache.set_many({_generation_key(scope): generation for scope in scopes}, timeout=None)
+        logger.debug(f"Dashboards invalidados: {sorted(map(str, scopes))}")
+
+    transaction.on_commit(bump)
+
+
+def dashboard_cache_stats():
+    counters = caches['local']
+    hits = counters.get(HITS_KEY, 0)
+    misses = counters.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / total, 3) if total else None,
+    }
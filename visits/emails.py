@@ -1,104 +1,588 @@
 # visits/emails.py
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template.loader import get_template
+from django.core.signals import setting_changed
 from django.conf import settings
+from django.db import transaction, connection
 from django.utils import timezone
 from django.urls import reverse
 from datetime import datetime, timedelta, time
+from smtplib import SMTPServerDisconnected
+from functools import partial, lru_cache
 import logging
+import queue
+import threading
+import time as time_module
+import uuid
 
 logger = logging.getLogger(__name__)
 
-def send_appointment_confirmation(appointment):
-    """Envía emails de confirmación al visitante y al staff"""
+# ====================================
+# RENDERIZADO DE EMAILS
+# ====================================
+# Las plantillas se compilan una vez por proceso y el contexto del colegio se
+# construye una sola vez: por cada email solo cambian los datos de la cita.
+
+# Token ficticio para construir una sola vez la URL de cancelación
+CANCEL_TOKEN_PLACEHOLDER = str(uuid.UUID(int=0))
+
+
+@lru_cache(maxsize=None)
+def get_email_template(template_name):
+    """Plantilla de email ya compilada (se carga la primera vez que se usa)"""
+    return get_template(template_name)
+
+
+@lru_cache(maxsize=None)
+def school_context():
+    """Parte fija del contexto de todos los emails"""
+    return {
+        'school_name': settings.SCHOOL_CONFIG['name'],
+        'school_address': settings.SCHOOL_CONFIG['address'],
+        'school_phone': settings.SCHOOL_CONFIG['phone'],
+    }
+
+
+@lru_cache(maxsize=None)
+def _cancel_url_pattern():
+    path = reverse('cancel_appointment', kwargs={'token': CANCEL_TOKEN_PLACEHOLDER})
+    return f"{settings.SCHOOL_CONFIG['base_url']}{path}"
+
+
+def cancel_url_for(appointment):
+    """URL pública de cancelación de la cita"""
+    return _cancel_url_pattern().replace(CANCEL_TOKEN_PLACEHOLDER, str(appointment.cancellation_token))
+
+
+def appointment_context(appointment):
+    """Variables de la cita comunes a los emails de familia y staff"""
+    return {
+        'appointment': appointment,
+        'visitor_name': appointment.visitor_name,
+        'date': appointment.date,
+        'staff_name': appointment.staff.user.get_full_name(),
+    }
+
+
+def render_email(template_name, context):
+    """Como render_to_string, pero con la plantilla precompilada y el contexto del colegio ya hecho"""
+    return get_email_template(template_name).render({
+        **school_context(),
+        'year': timezone.now().year,
+        **context
+    })
+
+
+def clear_email_caches(**kwargs):
+    """Descarta plantillas y contexto memorizados (p. ej. al cambiar settings en tests)"""
+    get_email_template.cache_clear()
+    school_context.cache_clear()
+    _cancel_url_pattern.cache_clear()
+
+
+setting_changed.connect(clear_email_caches)
+
+
+# ====================================
+# ENVÍO CON CONEXIÓN SMTP REUTILIZADA
+# ====================================
+
+# Errores que indican que el servidor cerró la conexión: se reconecta y se reintenta
+CONNECTION_ERRORS = (SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+class MailDispatcher:
+    """
+    Envía muchos mensajes por una única conexión autenticada en lugar de abrir
+    una sesión SMTP (con TLS y login) por email. Si el servidor corta la
+    conexión a mitad de lote, reconecta y reintenta el mensaje una vez.
     
-    try:
-        # Generar URL de cancelación
-        cancel_url = f"{settings.SCHOOL_CONFIG['base_url']}{reverse('cancel_appointment', kwargs={'token': appointment.cancellation_token})}"
-        
-        # Contexto común
-        base_context = {
-            'appointment': appointment,
-            'visitor_name': appointment.visitor_name,
-            'date': appointment.date,
-            'staff_name': appointment.staff.user.get_full_name(),
-            'year': timezone.now().year,
-            'school_name': settings.SCHOOL_CONFIG['name'],
-            'school_address': settings.SCHOOL_CONFIG['address'],
-            'school_phone': settings.SCHOOL_CONFIG['phone'],
-            'cancel_url': cancel_url
+        with MailDispatcher() as dispatcher:
+            for message in messages:
+                dispatcher.send(message)
+    """
+    
+    def __init__(self):
+        self.connection = get_connection(fail_silently=False)
+        self.sent = 0
+        self.failed = 0
+        self.reconnects = 0
+        self.started = None
+        self.finished = None
+    
+    def __enter__(self):
+        self.started = time_module.perf_counter()
+        try:
+            self.connection.open()
+        except Exception as e:
+            # Cada send() lo volverá a intentar y el error quedará en su mensaje
+            logger.warning(f"No se pudo abrir la conexión SMTP: {str(e)}")
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finished = time_module.perf_counter()
+        try:
+            self.connection.close()
+        except Exception as e:
+            logger.warning(f"Error cerrando la conexión SMTP: {str(e)}")
+        if self.sent or self.failed:
+            stats = self.stats()
+            logger.info(
+                f"Lote de emails: {stats['sent']} enviados, {stats['failed']} fallidos "
+                f"en {stats['seconds']:.2f}s ({stats['per_second']:.1f} emails/s, "
+                f"{stats['reconnects']} reconexiones)"
+            )
+        return False
+    
+    def _reconnect(self):
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+        self.connection.open()
+        self.reconnects += 1
+    
+    def send(self, message):
+        """Envía un mensaje por la conexión abierta; lanza la excepción si falla"""
+        message.connection = self.connection
+        try:
+            try:
+                self.connection.send_messages([message])
+            except CONNECTION_ERRORS as e:
+                logger.warning(f"Conexión SMTP perdida ({str(e)}), reconectando")
+                self._reconnect()
+                self.connection.send_messages([message])
+        except Exception:
+            self.failed += 1
+            raise
+        self.sent += 1
+    
+    def send_many(self, messages):
+        """Envía todos los mensajes; devuelve la lista de (mensaje, error) fallidos"""
+        errors = []
+        for message in messages:
+            try:
+                self.send(message)
+            except Exception as e:
+                errors.append((message, e))
+        return errors
+    
+    def stats(self):
+        """Contadores del lote y ritmo de envío (emails por segundo)"""
+        if self.started is None:
+            seconds = 0
+        else:
+            seconds = (self.finished or time_module.perf_counter()) - self.started
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'reconnects': self.reconnects,
+            'seconds': seconds,
+            'per_second': self.sent / seconds if seconds else 0.0,
         }
-        
-        # Email al visitante
-        visitor_subject = f'Confirmación de visita - {appointment.stage.name}'
-        visitor_html = render_to_string('emails/appointment_confirmation.html', base_context)
-        
-        send_mail(
-            subject=visitor_subject,
-            message='',
-            html_message=visitor_html,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[appointment.visitor_email],
-            fail_silently=False
+
+
+def dispatch_message(message, dispatcher=None):
+    """Envía por el dispatcher del lote, o por una conexión propia si no hay lote"""
+    if dispatcher is not None:
+        dispatcher.send(message)
+        return
+    with MailDispatcher() as own_dispatcher:
+        own_dispatcher.send(message)
+
+
+# ====================================
+# ENVÍO CONCURRENTE CON LÍMITE DE RITMO
+# ====================================
+
+class RateLimiter:
+    """Espacia los envíos para no pasar de `per_minute` emails por minuto (0 = sin límite)"""
+    
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute else 0
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+    
+    def wait(self):
+        if not self.interval:
+            return
+        # Cada hilo reserva su hueco bajo el lock y espera fuera de él
+        with self._lock:
+            now = time_module.monotonic()
+            slot = max(now, self._next_at)
+            self._next_at = slot + self.interval
+        if slot > now:
+            time_module.sleep(slot - now)
+
+
+class ParallelMailDispatcher:
+    """
+    Renderiza y envía emails en `workers` hilos, cada uno con su propia
+    conexión SMTP (MailDispatcher), sin superar `per_minute` emails por minuto
+    entre todos. Así una respuesta lenta del servidor no retrasa al resto.
+    
+    Cada trabajo es una tupla (clave, función que construye el mensaje). La
+    función se ejecuta en el hilo, por lo que no debe consultar la BD: el
+    contexto tiene que llegar ya cargado (select_related).
+    """
+    
+    # Resultados que se entregan juntos a on_batch (ver run)
+    RESULTS_BATCH_SIZE = 50
+    
+    def __init__(self, workers=None, per_minute=None):
+        if workers is None:
+            workers = settings.REMINDER_EMAIL_WORKERS
+        if per_minute is None:
+            per_minute = settings.REMINDER_EMAILS_PER_MINUTE
+        self.workers = max(1, workers)
+        self.per_minute = per_minute
+        self.limiter = RateLimiter(per_minute)
+        self.dispatchers = []
+        self.results = {}
+        self.seconds = 0
+    
+    def run(self, jobs, on_batch=None):
+        """
+        Procesa los trabajos; devuelve {clave: None si se envió, o la excepción}.
+        
+        Con `on_batch`, el hilo que llama recibe los resultados a medida que
+        terminan, en lotes de RESULTS_BATCH_SIZE ({clave: error}): puede
+        guardarlos en la BD sin esperar al final del envío.
+        """
+        pending = queue.Queue()
+        for job in jobs:
+            pending.put(job)
+        finished = queue.Queue()
+        
+        started = time_module.perf_counter()
+        threads = [
+            threading.Thread(target=self._worker, args=(pending, finished), name=f'email-sender-{i}')
+            for i in range(min(self.workers, pending.qsize()))
+        ]
+        for thread in threads:
+            thread.start()
+        
+        batch = {}
+        while any(thread.is_alive() for thread in threads) or not finished.empty():
+            try:
+                key, error = finished.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            batch[key] = error
+            if len(batch) >= self.RESULTS_BATCH_SIZE:
+                if on_batch is not None:
+                    on_batch(batch)
+                batch = {}
+        if batch and on_batch is not None:
+            on_batch(batch)
+        
+        for thread in threads:
+            thread.join()
+        self.seconds = time_module.perf_counter() - started
+        
+        return self.results
+    
+    def _worker(self, pending, finished):
+        try:
+            with MailDispatcher() as dispatcher:
+                self.dispatchers.append(dispatcher)
+                while True:
+                    try:
+                        key, build = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        message = build()
+                        self.limiter.wait()
+                        dispatcher.send(message)
+                        self.results[key] = None
+                    except Exception as e:
+                        self.results[key] = e
+                    finished.put((key, self.results[key]))
+        finally:
+            connection.close()
+    
+    def stats(self):
+        """Totales de todos los hilos y ritmo de envío"""
+        sent = sum(dispatcher.sent for dispatcher in self.dispatchers)
+        return {
+            'sent': sent,
+            'failed': sum(1 for error in self.results.values() if error is not None),
+            'reconnects': sum(dispatcher.reconnects for dispatcher in self.dispatchers),
+            'workers': len(self.dispatchers),
+            'per_minute': self.per_minute,
+            'seconds': self.seconds,
+            'per_second': sent / self.seconds if self.seconds else 0.0,
+        }
+
+
+# ====================================
+# OUTBOX: EMAILS TRANSACCIONALES
+# ====================================
+# Confirmaciones, cancelaciones y modificaciones no se envían al momento: se
+# guardan ya renderizadas en EmailOutbox dentro de la transacción de la cita
+# y se envían tras el commit, fuera de ella.
+
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_MAX_ATTEMPTS = 5
+# Un email 'sending' más antiguo que esto es de un worker caído: se reintenta
+OUTBOX_LOCK_TIMEOUT = timedelta(minutes=10)
+
+
+def queue_email(kind, to, subject, html_message, appointment=None):
+    """
+    Guarda un email en el outbox. Si la transacción se confirma, un hilo en
+    segundo plano lo envía (ver EMAIL_OUTBOX_DRAIN_ON_COMMIT); si no, el
+    comando process_email_outbox.
+    """
+    # Solo importar aquí para evitar import circular
+    from .models import EmailOutbox
+    
+    # Savepoint propio: un fallo aquí no deja rota la transacción de la cita
+    with transaction.atomic():
+        email = EmailOutbox.objects.create(
+            kind=kind,
+            appointment=appointment,
+            to=to,
+            subject=subject,
+            html_body=html_message
         )
+    
+    if getattr(settings, 'EMAIL_OUTBOX_DRAIN_ON_COMMIT', True):
+        transaction.on_commit(drain_outbox_in_background)
+    
+    logger.info(f"Email '{kind}' para {to} encolado (outbox {email.id})")
+    return email
+
+
+def queue_emails(emails):
+    """
+    Como queue_email para varios emails a la vez: recibe tuplas
+    (kind, to, subject, html_message, appointment) y los guarda con un solo INSERT.
+    """
+    # Solo importar aquí para evitar import circular
+    from .models import EmailOutbox
+    
+    if not emails:
+        return []
+    
+    with transaction.atomic():
+        created = EmailOutbox.objects.bulk_create([
+            EmailOutbox(kind=kind, to=to, subject=subject, html_body=html_message, appointment=appointment)
+            for kind, to, subject, html_message, appointment in emails
+        ])
+    
+    if getattr(settings, 'EMAIL_OUTBOX_DRAIN_ON_COMMIT', True):
+        transaction.on_commit(drain_outbox_in_background)
+    
+    logger.info(f"{len(created)} emails encolados en el outbox")
+    return created
+
+
+def build_message(subject, html_message, to):
+    """Mismo mensaje que send_mail(message='', html_message=...)"""
+    message = EmailMultiAlternatives(
+        subject=subject,
+        body='',
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[to]
+    )
+    message.attach_alternative(html_message, 'text/html')
+    return message
+
+
+def _claim_outbox_batch(limit):
+    """Marca como 'sending' hasta `limit` emails listos y devuelve los reclamados"""
+    from .models import EmailOutbox
+    
+    now = timezone.now()
+    EmailOutbox.objects.filter(
+        status='sending',
+        locked_at__lt=now - OUTBOX_LOCK_TIMEOUT
+    ).update(status='pending', locked_at=None)
+    
+    candidate_ids = list(EmailOutbox.objects.filter(
+        status='pending',
+        next_attempt_at__lte=now
+    ).values_list('id', flat=True)[:limit])
+    
+    # Actualización condicional por fila: si otro worker la reclamó antes, no es nuestra
+    claimed_ids = [
+        email_id for email_id in candidate_ids
+        if EmailOutbox.objects.filter(id=email_id, status='pending').update(status='sending', locked_at=now)
+    ]
+    return list(EmailOutbox.objects.filter(id__in=claimed_ids))
+
+
+def process_email_outbox(limit=OUTBOX_BATCH_SIZE):
+    """
+    Envía un lote de emails pendientes del outbox.
+    
+    Los fallos se reintentan con espera exponencial (1, 2, 4, 8... minutos)
+    hasta OUTBOX_MAX_ATTEMPTS intentos; después quedan como 'failed'.
+    """
+    result = {'sent': 0, 'retried': 0, 'failed': 0}
+    batch = _claim_outbox_batch(limit)
+    if not batch:
+        return result
+    
+    with MailDispatcher() as dispatcher:
+        for email in batch:
+            _send_outbox_email(email, dispatcher, result)
+    
+    return result
+
+
+def _send_outbox_email(email, dispatcher, result):
+    """Envía un email reclamado y guarda el resultado (enviado, reintento o fallido)"""
+    email.attempts += 1
+    try:
+        dispatcher.send(build_message(email.subject, email.html_body, email.to))
+        email.status = 'sent'
+        email.sent_at = timezone.now()
+        email.last_error = ''
+        result['sent'] += 1
+        logger.info(f"Email '{email.kind}' enviado a {email.to} (outbox {email.id})")
+    except Exception as e:
+        email.last_error = str(e)
+        if email.attempts >= OUTBOX_MAX_ATTEMPTS:
+            email.status = 'failed'
+            result['failed'] += 1
+            logger.error(f"Email '{email.kind}' a {email.to} descartado tras {email.attempts} intentos: {str(e)}")
+        else:
+            email.status = 'pending'
+            email.next_attempt_at = timezone.now() + timedelta(minutes=2 ** (email.attempts - 1))
+            result['retried'] += 1
+            logger.warning(f"Error enviando email '{email.kind}' a {email.to}, se reintentará: {str(e)}")
+    email.locked_at = None
+    email.save(update_fields=['status', 'attempts', 'last_error', 'next_attempt_at', 'locked_at', 'sent_at'])
+
+
+_drain_lock = threading.Lock()
+_drain_requested = threading.Event()
+
+
+def drain_outbox_in_background():
+    """Vacía el outbox en un hilo; si ya hay uno trabajando, este lo repasa al acabar"""
+    _drain_requested.set()
+    if _drain_lock.acquire(blocking=False):
+        threading.Thread(target=_drain_outbox, name='email-outbox', daemon=True).start()
+
+
+def _drain_pending():
+    """
+    Lotes de process_email_outbox hasta que no quede ninguno listo: un alta
+    masiva encola muchos más emails que OUTBOX_BATCH_SIZE. Los reintentos
+    esperan a su next_attempt_at, así que no se vuelven a coger aquí.
+    """
+    while True:
+        result = process_email_outbox()
+        if result['sent'] + result['retried'] + result['failed'] == 0:
+            return
+
+
+def _drain_outbox():
+    try:
+        while True:
+            while _drain_requested.is_set():
+                _drain_requested.clear()
+                _drain_pending()
+            _drain_lock.release()
+            # Un email encolado justo al terminar: seguir si nadie más lo ha cogido
+            if not (_drain_requested.is_set() and _drain_lock.acquire(blocking=False)):
+                return
+    except Exception as e:
+        _drain_lock.release()
+        logger.error(f"Error vaciando el outbox de emails: {str(e)}", exc_info=True)
+    finally:
+        connection.close()
+
+# ====================================
+# EMAILS DE CITAS
+# ====================================
+
+def confirmation_emails(appointment):
+    """Emails de confirmación al visitante y al staff, como tuplas para queue_email"""
+    # Contexto común
+    base_context = {
+        **appointment_context(appointment),
+        'cancel_url': cancel_url_for(appointment)
+    }
+    
+    # Email al visitante
+    visitor_subject = f'Confirmación de visita - {appointment.stage.name}'
+    visitor_html = render_email('emails/appointment_confirmation.html', base_context)
+    emails = [('confirmation', appointment.visitor_email, visitor_subject, visitor_html, appointment)]
+    
+    # Email al staff (solo si tiene notificaciones activas)
+    if appointment.staff.notify_new_appointment:
+        staff_subject = f'Nueva visita programada - {appointment.stage.name}'
+        staff_context = {
+            **base_context,
+            'visitor_email': appointment.visitor_email,
+            'visitor_phone': appointment.visitor_phone,
+        }
         
-        logger.info(f"Email de confirmación enviado a {appointment.visitor_email}")
+        staff_html = render_email('emails/staff_notification.html', staff_context)
+        emails.append(('staff_notification', appointment.staff.user.email, staff_subject, staff_html, appointment))
+    
+    return emails
 
-        # Email al staff (solo si tiene notificaciones activas)
-        if appointment.staff.notify_new_appointment:
-            staff_subject = f'Nueva visita programada - {appointment.stage.name}'
-            staff_context = {
-                **base_context,
-                'visitor_email': appointment.visitor_email,
-                'visitor_phone': appointment.visitor_phone,
-            }
-            
-            staff_html = render_to_string('emails/staff_notification.html', staff_context)
-            
-            send_mail(
-                subject=staff_subject,
-                message='',
-                html_message=staff_html,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=[appointment.staff.user.email],
-                fail_silently=False
-            )
-            
-            logger.info(f"Email de notificación enviado al staff {appointment.staff.user.email}")
+def send_appointment_confirmation(appointment):
+    """Encola los emails de confirmación al visitante y al staff"""
+    
+    try:
+        for email in confirmation_emails(appointment):
+            queue_email(*email)
 
     except Exception as e:
-        logger.error(f"Error enviando emails de confirmación para cita {appointment.id}: {str(e)}", exc_info=True)
+        logger.error(f"Error encolando emails de confirmación para cita {appointment.id}: {str(e)}", exc_info=True)
         raise
 
-def send_appointment_reminder(appointment):
+def send_appointment_confirmations(appointments):
+    """Encola de una vez las confirmaciones de un lote de citas"""
+    
+    try:
+        return queue_emails([email for appointment in appointments for email in confirmation_emails(appointment)])
+    
+    except Exception as e:
+        logger.error(f"Error encolando emails de confirmación de {len(appointments)} citas: {str(e)}", exc_info=True)
+        raise
+
+def mark_reminders_sent(appointment_ids):
+    """
+    Marca reminder_sent con un único UPDATE. No pasa por Appointment.save():
+    el flag no afecta a la agenda, así que no hace falta repetir full_clean()
+    ni avisar a la disponibilidad por cada cita.
+    """
+    # Solo importar aquí para evitar import circular
+    from .models import Appointment
+    
+    if not appointment_ids:
+        return 0
+    with transaction.atomic():
+        return Appointment.objects.filter(id__in=list(appointment_ids)).update(reminder_sent=True)
+
+def build_appointment_reminder(appointment):
+    """Renderiza el recordatorio 24h antes de la cita para la familia"""
+    context = {
+        **appointment_context(appointment),
+        'cancel_url': cancel_url_for(appointment)
+    }
+    
+    html_message = render_email('emails/appointment_reminder.html', context)
+    
+    return build_message(
+        f'Recordatorio: Visita escolar mañana - {appointment.stage.name}',
+        html_message,
+        appointment.visitor_email
+    )
+
+def send_appointment_reminder(appointment, dispatcher=None):
     """Envía recordatorio 24h antes de la cita - DEPRECADO: Usar send_daily_reminders()"""
     
     try:
-        # Generar URL de cancelación
-        cancel_url = f"{settings.SCHOOL_CONFIG['base_url']}{reverse('cancel_appointment', kwargs={'token': appointment.cancellation_token})}"
-        
-        context = {
-            'appointment': appointment,
-            'visitor_name': appointment.visitor_name,
-            'date': appointment.date,
-            'staff_name': appointment.staff.user.get_full_name(),
-            'year': timezone.now().year,
-            'school_name': settings.SCHOOL_CONFIG['name'],
-            'school_address': settings.SCHOOL_CONFIG['address'],
-            'school_phone': settings.SCHOOL_CONFIG['phone'],
-            'cancel_url': cancel_url
-        }
-        
-        html_message = render_to_string('emails/appointment_reminder.html', context)
-        
-        send_mail(
-            subject=f'Recordatorio: Visita escolar mañana - {appointment.stage.name}',
-            message='',
-            html_message=html_message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[appointment.visitor_email],
-            fail_silently=False
-        )
+        dispatch_message(build_appointment_reminder(appointment), dispatcher)
         
         logger.info(f"Recordatorio enviado a {appointment.visitor_email} para cita {appointment.id}")
         
@@ -107,35 +591,19 @@ def send_appointment_reminder(appointment):
         raise
 
 def send_appointment_cancellation(appointment, cancelled_by='family'):
-    """Envía notificación de cancelación a ambas partes"""
+    """Encola la notificación de cancelación a ambas partes"""
     
     try:
         base_context = {
-            'appointment': appointment,
-            'visitor_name': appointment.visitor_name,
-            'date': appointment.date,
-            'staff_name': appointment.staff.user.get_full_name(),
-            'year': timezone.now().year,
-            'school_name': settings.SCHOOL_CONFIG['name'],
-            'school_address': settings.SCHOOL_CONFIG['address'],
-            'school_phone': settings.SCHOOL_CONFIG['phone'],
+            **appointment_context(appointment),
             'cancelled_by': cancelled_by
         }
         
         # Email a la familia
         family_subject = f'Cita cancelada - {appointment.stage.name}'
-        family_html = render_to_string('emails/appointment_cancelled_family.html', base_context)
-        
-        send_mail(
-            subject=family_subject,
-            message='',
-            html_message=family_html,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[appointment.visitor_email],
-            fail_silently=False
-        )
+        family_html = render_email('emails/appointment_cancelled_family.html', base_context)
         
-        logger.info(f"Email de cancelación enviado a familia {appointment.visitor_email}")
+        queue_email('cancellation_family', appointment.visitor_email, family_subject, family_html, appointment)
 
         # Email al staff
         staff_subject = f'Cita cancelada - {appointment.stage.name}'
@@ -145,105 +613,68 @@ def send_appointment_cancellation(appointment, cancelled_by='family'):
             'visitor_phone': appointment.visitor_phone,
         }
         
-        staff_html = render_to_string('emails/appointment_cancelled_staff.html', staff_context)
+        staff_html = render_email('emails/appointment_cancelled_staff.html', staff_context)
         
-        send_mail(
-            subject=staff_subject,
-            message='',
-            html_message=staff_html,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[appointment.staff.user.email],
-            fail_silently=False
-        )
-        
-        logger.info(f"Email de cancelación enviado al staff {appointment.staff.user.email}")
+        queue_email('cancellation_staff', appointment.staff.user.email, staff_subject, staff_html, appointment)
 
     except Exception as e:
-        logger.error(f"Error enviando emails de cancelación para cita {appointment.id}: {str(e)}", exc_info=True)
+        logger.error(f"Error encolando emails de cancelación para cita {appointment.id}: {str(e)}", exc_info=True)
         raise
 
 def send_appointment_modification(appointment, old_date=None):
-    """Envía notificación de modificación solo a la familia"""
+    """Encola la notificación de modificación solo a la familia"""
     
     try:
-        # Generar nueva URL de cancelación
-        cancel_url = f"{settings.SCHOOL_CONFIG['base_url']}{reverse('cancel_appointment', kwargs={'token': appointment.cancellation_token})}"
-        
         context = {
-            'appointment': appointment,
-            'visitor_name': appointment.visitor_name,
-            'date': appointment.date,
+            **appointment_context(appointment),
             'old_date': old_date,
-            'staff_name': appointment.staff.user.get_full_name(),
-            'year': timezone.now().year,
-            'school_name': settings.SCHOOL_CONFIG['name'],
-            'school_address': settings.SCHOOL_CONFIG['address'],
-            'school_phone': settings.SCHOOL_CONFIG['phone'],
-            'cancel_url': cancel_url
+            'cancel_url': cancel_url_for(appointment)
         }
         
         subject = f'Cita modificada - {appointment.stage.name}'
-        html_message = render_to_string('emails/appointment_modified.html', context)
+        html_message = render_email('emails/appointment_modified.html', context)
         
-        send_mail(
-            subject=subject,
-            message='',
-            html_message=html_message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[appointment.visitor_email],
-            fail_silently=False
-        )
-        
-        logger.info(f"Email de modificación enviado a {appointment.visitor_email}")
+        queue_email('modification', appointment.visitor_email, subject, html_message, appointment)
 
     except Exception as e:
-        logger.error(f"Error enviando email de modificación para cita {appointment.id}: {str(e)}", exc_info=True)
+        logger.error(f"Error encolando email de modificación para cita {appointment.id}: {str(e)}", exc_info=True)
         raise
 
 # ====================================
 # SISTEMA DE RECORDATORIOS DIARIOS PARA STAFF - CORREGIDO
 # ====================================
 
-def send_staff_daily_reminder(staff_profile, appointments_tomorrow):
+def build_staff_daily_reminder(staff_profile, appointments_tomorrow):
+    """Renderiza el resumen diario del STAFF con todas las familias que debe atender mañana"""
+    context = {
+        'staff_name': staff_profile.user.get_full_name(),
+        'staff_email': staff_profile.user.email,
+        'appointments': appointments_tomorrow,
+        'total_appointments': len(appointments_tomorrow),
+        'date': appointments_tomorrow[0].date.date(),
+    }
+    
+    # Asunto dependiendo del número de citas
+    if len(appointments_tomorrow) == 1:
+        subject = f'Recordatorio: 1 visita mañana - {appointments_tomorrow[0].stage.name}'
+    else:
+        subject = f'Recordatorio: {len(appointments_tomorrow)} visitas mañana'
+    
+    html_message = render_email('emails/staff_daily_reminder.html', context)
+    
+    return build_message(subject, html_message, staff_profile.user.email)
+
+def send_staff_daily_reminder(staff_profile, appointments_tomorrow, dispatcher=None):
     """Envía recordatorio diario al STAFF con todas las familias que debe atender mañana"""
     
     try:
         if not appointments_tomorrow or not staff_profile.notify_reminder:
             return
         
-        context = {
-            'staff_name': staff_profile.user.get_full_name(),
-            'staff_email': staff_profile.user.email,
-            'appointments': appointments_tomorrow,
-            'total_appointments': len(appointments_tomorrow),
-            'date': appointments_tomorrow[0].date.date(),
-            'year': timezone.now().year,
-            'school_name': settings.SCHOOL_CONFIG['name'],
-            'school_address': settings.SCHOOL_CONFIG['address'],
-            'school_phone': settings.SCHOOL_CONFIG['phone'],
-        }
-        
-        # Asunto dependiendo del número de citas
-        if len(appointments_tomorrow) == 1:
-            subject = f'Recordatorio: 1 visita mañana - {appointments_tomorrow[0].stage.name}'
-        else:
-            subject = f'Recordatorio: {len(appointments_tomorrow)} visitas mañana'
-        
-        html_message = render_to_string('emails/staff_daily_reminder.html', context)
-        
-        send_mail(
-            subject=subject,
-            message='',
-            html_message=html_message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[staff_profile.user.email],
-            fail_silently=False
-        )
+        dispatch_message(build_staff_daily_reminder(staff_profile, appointments_tomorrow), dispatcher)
         
         # Marcar citas como recordatorio enviado
-        for appointment in appointments_tomorrow:
-            appointment.reminder_sent = True
-            appointment.save()
+        mark_reminders_sent([appointment.id for appointment in appointments_tomorrow])
         
         logger.info(f"Recordatorio diario enviado al staff {staff_profile.user.email} para {len(appointments_tomorrow)} citas")
         
@@ -251,12 +682,16 @@ def send_staff_daily_reminder(staff_profile, appointments_tomorrow):
         logger.error(f"Error enviando recordatorio diario al staff {staff_profile.user.email}: {str(e)}", exc_info=True)
         raise
 
-def send_daily_reminders():
+def send_daily_reminders(workers=None, per_minute=None):
     """
     Función para enviar recordatorios diarios:
     - A FAMILIAS: 1 email por cita 24h antes
     - A STAFF: 1 email con todas sus citas del día (solo si notify_reminder=True)
     
+    Los emails se renderizan y envían en paralelo (ver ParallelMailDispatcher);
+    `workers` y `per_minute` sustituyen a REMINDER_EMAIL_WORKERS y
+    REMINDER_EMAILS_PER_MINUTE.
+    
     Llamar desde comando Django o tarea programada
     """
     
@@ -286,24 +721,13 @@ def send_daily_reminders():
         # ==========================================
         # PARTE 1: RECORDATORIOS A FAMILIAS
         # ==========================================
-        family_emails_sent = 0
-        family_emails_failed = 0
-        
-        for appointment in appointments_tomorrow:
-            # Solo enviar si no se ha enviado antes
-            if not appointment.reminder_sent:
-                try:
-                    send_appointment_reminder(appointment)
-                    appointment.reminder_sent = True
-                    appointment.save()
-                    family_emails_sent += 1
-                    logger.info(f"Recordatorio enviado a familia: {appointment.visitor_email}")
-                except Exception as e:
-                    family_emails_failed += 1
-                    logger.error(f"Error enviando recordatorio a familia {appointment.visitor_email}: {str(e)}")
-                    continue
         
-        logger.info(f"Recordatorios a familias: {family_emails_sent} enviados, {family_emails_failed} fallidos")
+        # Solo enviar si no se ha enviado antes
+        family_appointments = [appointment for appointment in appointments_tomorrow if not appointment.reminder_sent]
+        jobs = [
+            (('family', appointment.id), partial(build_appointment_reminder, appointment))
+            for appointment in family_appointments
+        ]
         
         # ==========================================
         # PARTE 2: RECORDATORIOS A STAFF
@@ -320,35 +744,83 @@ def send_daily_reminders():
                 }
             appointments_by_staff[staff_id]['appointments'].append(appointment)
         
-        # Enviar 1 email por staff con todas sus citas
-        staff_emails_sent = 0
+        # 1 email por staff con todas sus citas, solo si tiene recordatorios activados
         staff_emails_skipped = 0
-        
         for staff_id, data in appointments_by_staff.items():
             staff_profile = data['staff_profile']
-            appointments = data['appointments']
-            
-            # Solo enviar si el staff tiene recordatorios activados
             if staff_profile.notify_reminder:
-                try:
-                    send_staff_daily_reminder(staff_profile, appointments)
-                    staff_emails_sent += 1
-                    logger.info(f"Recordatorio enviado a staff: {staff_profile.user.email} ({len(appointments)} citas)")
-                except Exception as e:
-                    logger.error(f"Error enviando recordatorio al staff {staff_profile.user.email}: {str(e)}")
-                    continue
+                jobs.append((('staff', staff_id), partial(build_staff_daily_reminder, staff_profile, data['appointments'])))
             else:
                 staff_emails_skipped += 1
                 logger.info(f"Staff {staff_profile.user.email} tiene recordatorios desactivados - no se envía")
         
+        # ==========================================
+        # PARTE 3: ENVÍO EN PARALELO Y RESULTADOS
+        # ==========================================
+        # Citas que cubre cada email: se marcan con un UPDATE por lote de
+        # resultados, así un proceso interrumpido solo repite el último lote
+        appointment_ids_by_job = {('family', appointment.id): [appointment.id] for appointment in family_appointments}
+        for staff_id, data in appointments_by_staff.items():
+            appointment_ids_by_job[('staff', staff_id)] = [appointment.id for appointment in data['appointments']]
+        
+        def mark_batch(batch):
+            mark_reminders_sent({
+                appointment_id
+                for key, error in batch.items() if error is None
+                for appointment_id in appointment_ids_by_job[key]
+            })
+        
+        dispatcher = ParallelMailDispatcher(workers, per_minute)
+        results = dispatcher.run(jobs, on_batch=mark_batch)
+        
+        family_emails_sent = 0
+        family_emails_failed = 0
+        
+        for appointment in family_appointments:
+            error = results.get(('family', appointment.id))
+            if error is None:
+                family_emails_sent += 1
+                logger.info(f"Recordatorio enviado a familia: {appointment.visitor_email}")
+            else:
+                family_emails_failed += 1
+                logger.error(f"Error enviando recordatorio a familia {appointment.visitor_email}: {str(error)}")
+        
+        logger.info(f"Recordatorios a familias: {family_emails_sent} enviados, {family_emails_failed} fallidos")
+        
+        staff_emails_sent = 0
+        
+        for staff_id, data in appointments_by_staff.items():
+            staff_profile = data['staff_profile']
+            appointments = data['appointments']
+            if not staff_profile.notify_reminder:
+                continue
+            
+            error = results.get(('staff', staff_id))
+            if error is None:
+                staff_emails_sent += 1
+                logger.info(f"Recordatorio enviado a staff: {staff_profile.user.email} ({len(appointments)} citas)")
+            else:
+                logger.error(f"Error enviando recordatorio al staff {staff_profile.user.email}: {str(error)}")
+        
         logger.info(f"Recordatorios a staff: {staff_emails_sent} enviados, {staff_emails_skipped} omitidos por configuración")
         
+        send_stats = dispatcher.stats()
+        logger.info(
+            f"Recordatorios: {send_stats['sent']} emails en {send_stats['seconds']:.2f}s "
+            f"({send_stats['per_second']:.1f} emails/s, {send_stats['workers']} conexiones)"
+        )
+        
         return {
             'staff_emails': staff_emails_sent,
             'staff_emails_skipped': staff_emails_skipped,
             'family_emails': family_emails_sent,
             'family_emails_failed': family_emails_failed,
-            'total_appointments': appointments_tomorrow.count()
+            'total_appointments': appointments_tomorrow.count(),
+            'seconds': send_stats['seconds'],
+            'emails_per_second': send_stats['per_second'],
+            'workers': send_stats['workers'],
+            'per_minute': send_stats['per_minute'],
+            'reconnects': send_stats['reconnects']
         }
         
     except Exception as e:
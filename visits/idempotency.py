@@ -0,0 +1,149 @@
+# visits/idempotency.py
+# ====================================
+# Claves de idempotencia para las reservas
+# ====================================
+#
+# Un doble clic en "Reservar" o un reintento de la red móvil repite el POST.
+# Si llega con la misma clave (cabecera Idempotency-Key o campo
+# idempotency_key del formulario), se devuelve la respuesta guardada sin volver
+# a comprobar solapes ni encolar emails.
+
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from datetime import timedelta
+from functools import wraps
+from urllib.parse import urlencode
+import hashlib
+import logging
+
+from .models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_FIELD = 'idempotency_key'
+IDEMPOTENCY_TTL = timedelta(hours=24)
+# Una clave sin respuesta más antigua que esto es de un worker caído: la
+# repetición de la misma petición la reclama en vez de recibir un 409
+IDEMPOTENCY_LOCK_TIMEOUT = timedelta(minutes=1)
+MAX_KEY_LENGTH = 255
+FORM_CONTENT_TYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+
+
+def _request_key(request):
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if not key and request.content_type in FORM_CONTENT_TYPES:
+        key = request.POST.get(IDEMPOTENCY_FIELD)
+    return (key or '').strip()
+
+
+def _request_hash(request):
+    """Huella de la petición para detectar una clave reutilizada con otros datos"""
+    if request.content_type in FORM_CONTENT_TYPES:
+        # El boundary del multipart cambia en cada envío: se usan los campos ya parseados
+        payload = urlencode(sorted(request.POST.lists()), doseq=True).encode()
+    else:
+        payload = request.body
+    return hashlib.sha256(payload).hexdigest()
+
+
+def _replay(record):
+    response = HttpResponse(record.response_body, status=record.status_code, content_type=record.content_type)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _reserve(scope, key, request_hash):
+    """
+    Crea la fila de la clave. Devuelve None si es nueva (o se reclamó una en
+    curso abandonada), o la fila existente si ya se usó (terminada o todavía
+    en curso).
+    """
+    now = timezone.now()
+    # Camino de la repetición: una sola consulta
+    existing = IdempotencyKey.objects.filter(scope=scope, key=key, expires_at__gt=now).first()
+    if existing is not None:
+        if (
+            existing.status_code is None
+            and existing.request_hash == request_hash
+            and existing.created_at < now - IDEMPOTENCY_LOCK_TIMEOUT
+        ):
+            # Solo una de las repeticiones simultáneas consigue reclamarla
+            reclaimed = IdempotencyKey.objects.filter(
+                pk=existing.pk,
+                status_code__isnull=True,
+                created_at=existing.created_at
+            ).update(created_at=now, expires_at=now + IDEMPOTENCY_TTL)
+            if reclaimed:
+                logger.warning(f"Clave de idempotencia {key} abandonada desde {existing.created_at}: se reclama ({scope})")
+                return None
+            return IdempotencyKey.objects.filter(pk=existing.pk).first() or existing
+        return existing
+    
+    # Evicción por TTL: las claves caducadas se borran al reservar una nueva
+    IdempotencyKey.objects.filter(expires_at__lte=now).delete()
+    try:
+        with transaction.atomic():
+            IdempotencyKey.objects.create(
+                scope=scope,
+                key=key,
+                request_hash=request_hash,
+                expires_at=now + IDEMPOTENCY_TTL
+            )
+        return None
+    except IntegrityError:
+        # Otra petición con la misma clave se adelantó
+        return IdempotencyKey.objects.filter(scope=scope, key=key).first()
+
+
+def idempotent(view):
+    """
+    Hace idempotente un POST con clave. Solo se guardan las respuestas 2xx: un
+    error (horario ocupado, teléfono inválido...) libera la clave para que el
+    cliente pueda corregir y reintentar con ella.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'POST':
+            return view(request, *args, **kwargs)
+
+        key = _request_key(request)
+        if not key:
+            return view(request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return JsonResponse({'error': 'Idempotency-Key demasiado larga'}, status=400)
+
+        scope = f"{request.path}:{request.user.pk or ''}"
+        request_hash = _request_hash(request)
+
+        existing = _reserve(scope, key, request_hash)
+        if existing is not None:
+            if existing.request_hash != request_hash:
+                return JsonResponse({
+                    'error': 'La Idempotency-Key ya se usó con otra petición'
+                }, status=422)
+            if existing.status_code is None:
+                return JsonResponse({
+                    'error': 'La petición original todavía se está procesando'
+                }, status=409)
+            logger.info(f"Respuesta repetida para la clave de idempotencia {key} ({scope})")
+            return _replay(existing)
+
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            IdempotencyKey.objects.filter(scope=scope, key=key).delete()
+            raise
+
+        if 200 <= response.status_code < 300 and not response.streaming:
+            IdempotencyKey.objects.filter(scope=scope, key=key).update(
+                status_code=response.status_code,
+                content_type=response.get('Content-Type', ''),
+                response_body=response.content.decode(response.charset)
+            )
+        else:
+            IdempotencyKey.objects.filter(scope=scope, key=key).delete()
+        return response
+
+    return wrapper
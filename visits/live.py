@@ -0,0 +1,131 @@
+# visits/live.py
+# ====================================
+# Cambios de disponibilidad en vivo (SSE)
+# ====================================
+#
+# La página de reserva de cada etapa abre un EventSource contra
+# stage_availability_stream. Cuando cambian citas o slots de un staff, tras
+# el commit se publica para cada etapa con suscriptores un evento `day` con
+# los huecos actuales de la fecha afectada, y el cliente parchea su vista.
+#
+# El broadcaster vive en el proceso: solo llegan los cambios hechos en el
+# mismo proceso que sirve el stream (ASGI con un único worker, o un backend
+# compartido en el futuro).
+
+from django.db import transaction
+from datetime import datetime
+import asyncio
+import json
+import logging
+import threading
+
+from .models import StaffProfile
+from .scheduling import stage_day_slots
+from .serializers import serialize_slots
+
+logger = logging.getLogger(__name__)
+
+# Eventos pendientes por cliente antes de pedirle que recargue todo
+QUEUE_SIZE = 100
+
+
+def format_sse(event, data):
+    """Un mensaje SSE con nombre de evento y datos en JSON"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class Broadcaster:
+    """
+    Reparte eventos por etapa entre las colas de los streams abiertos.
+
+    Se publica desde cualquier hilo (las vistas síncronas corren en hilos bajo
+    ASGI); cada cola se alimenta en el bucle de eventos de su suscriptor.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, stage_id):
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(stage_id, set()).add((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, stage_id, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(stage_id, set())
+            subscribers.difference_update({entry for entry in subscribers if entry[1] is queue})
+            if not subscribers:
+                self._subscribers.pop(stage_id, None)
+
+    def stages(self):
+        """Etapas con algún stream abierto"""
+        with self._lock:
+            return set(self._subscribers)
+
+    def publish(self, stage_id, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(stage_id, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(self._deliver, queue, (event, data))
+
+    @staticmethod
+    def _deliver(queue, message):
+        if queue.full():
+            # Cliente demasiado lento: se descarta lo pendiente y recarga entero
+            while not queue.empty():
+                queue.get_nowait()
+            message = ('refresh', {})
+        queue.put_nowait(message)
+
+
+broadcaster = Broadcaster()
+
+
+def _watched_stage_ids(staff_id, stage_ids=None):
+    """Etapas del staff (o `stage_ids`) que tienen algún stream abierto"""
+    watched = broadcaster.stages()
+    if not watched:
+        return []
+    if stage_ids is None:
+        stage_ids = StaffProfile.allowed_stages.through.objects.filter(
+            staffprofile_id=staff_id
+        ).values_list('schoolstage_id', flat=True)
+    return [stage_id for stage_id in stage_ids if stage_id in watched]
+
+
+def publish_day_changes(staff_id, days, stage_ids=None):
+    """
+    Tras el commit, publica los huecos actuales de esas fechas en las etapas
+    del staff (o en `stage_ids`)
+    """
+    def publish():
+        today = datetime.now().date()
+        for stage_id in _watched_stage_ids(staff_id, stage_ids):
+            for day in sorted(days):
+                if day < today:
+                    continue
+                slots = stage_day_slots(stage_id, day)
+                broadcaster.publish(stage_id, 'day', {
+                    'date': day.isoformat(),
+                    'slots': serialize_slots(slots),
+                    'summary': {
+                        'slots': len(slots),
+                        'first': slots[0].start_time.strftime('%H:%M'),
+                        'last': slots[-1].start_time.strftime('%H:%M'),
+                    } if slots else None,
+                })
+
+    if broadcaster.stages():
+        transaction.on_commit(publish)
+
+
+def publish_refresh(staff_id):
+    """Tras el commit, pide a los clientes de las etapas del staff que recarguen"""
+    def publish():
+        for stage_id in _watched_stage_ids(staff_id):
+            broadcaster.publish(stage_id, 'refresh', {})
+
+    if broadcaster.stages():
+        transaction.on_commit(publish)
@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+from visits.emails import build_appointment_reminder, clear_email_caches
+from visits.models import SchoolStage, StaffProfile, Appointment
+from datetime import datetime, timedelta, time
+import time as time_module
+
+
+class Command(BaseCommand):
+    help = 'Mide cuántos recordatorios por segundo se renderizan, sin y con plantillas precompiladas (no escribe en la BD)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000, help='Número de citas del lote')
+
+    def handle(self, *args, **options):
+        appointments = self.fake_appointments(options['count'])
+
+        self.stdout.write(f'Lote: {len(appointments)} recordatorios | DEBUG: {settings.DEBUG}')
+        self.stdout.write(f'{"Método":<30}{"Tiempo (ms)":>14}{"Renders/s":>14}')
+
+        elapsed = self.measure(appointments, self.render_uncached)
+        self.write_row('render_to_string', len(appointments), elapsed)
+
+        # La primera pasada incluye compilar la plantilla, como en un proceso recién arrancado
+        clear_email_caches()
+        elapsed = self.measure(appointments, build_appointment_reminder)
+        self.write_row('plantilla precompilada', len(appointments), elapsed)
+
+    def fake_appointments(self, count):
+        """Citas en memoria con sus relaciones ya cargadas, como con select_related"""
+        stage = SchoolStage(name='Educación Primaria', description='')
+        staff = StaffProfile(user=User(first_name='Ana', last_name='García', email='ana@example.com'))
+        first = timezone.make_aware(datetime.combine(timezone.localdate() + timedelta(days=1), time(9, 0)))
+
+        return [
+            Appointment(
+                stage=stage,
+                staff=staff,
+                visitor_name=f'Familia {number}',
+                visitor_email=f'familia{number}@example.com',
+                visitor_phone='600000000',
+                date=first + timedelta(minutes=15 * (number % 40)),
+                duration=30
+            )
+            for number in range(count)
+        ]
+
+    def render_uncached(self, appointment):
+        """Lo que hacía cada recordatorio antes: contexto completo, reverse y render_to_string"""
+        cancel_url = f"{settings.SCHOOL_CONFIG['base_url']}{reverse('cancel_appointment', kwargs={'token': appointment.cancellation_token})}"
+        context = {
+            'appointment': appointment,
+            'visitor_name': appointment.visitor_name,
+            'date': appointment.date,
+            'staff_name': appointment.staff.user.get_full_name(),
+            'year': timezone.now().year,
+            'school_name': settings.SCHOOL_CONFIG['name'],
+            'school_address': settings.SCHOOL_CONFIG['address'],
+            'school_phone': settings.SCHOOL_CONFIG['phone'],
+            'cancel_url': cancel_url
+        }
+        return render_to_string('emails/appointment_reminder.html', context)
+
+    def measure(self, appointments, render):
+        started = time_module.perf_counter()
+        for appointment in appointments:
+            render(appointment)
+        return (time_module.perf_counter() - started) * 1000
+
+    def write_row(self, label, count, elapsed):
+        per_second = count / (elapsed / 1000) if elapsed else 0
+        self.stdout.write(f'{label:<30}{elapsed:>14.2f}{per_second:>14.1f}')
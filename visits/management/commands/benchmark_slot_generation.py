@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from visits.models import StaffProfile, AvailabilitySlot
+from datetime import datetime, timedelta, time
+import time as time_module
+
+
+class Command(BaseCommand):
+    help = 'Mide consultas y tiempo de generación de slots diarios para ventanas de tamaño creciente (no escribe en la BD)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--staff', type=int, help='ID del StaffProfile (por defecto, el primero con etapas)')
+        parser.add_argument('--date', help='Fecha YYYY-MM-DD (por defecto, mañana)')
+        parser.add_argument('--duration', type=int, default=30, help='Duración de cada slot en minutos')
+
+    def handle(self, *args, **options):
+        staff_profiles = StaffProfile.objects.filter(allowed_stages__isnull=False).distinct()
+        if options['staff']:
+            staff_profiles = staff_profiles.filter(id=options['staff'])
+        staff_profile = staff_profiles.first()
+        if staff_profile is None:
+            raise CommandError('No hay ningún StaffProfile con etapas asignadas')
+
+        if options['date']:
+            day = datetime.strptime(options['date'], '%Y-%m-%d').date()
+        else:
+            day = timezone.localdate() + timedelta(days=1)
+
+        self.stdout.write(f'Staff: {staff_profile} | Fecha: {day} | Duración: {options["duration"]} min')
+        self.stdout.write(f'{"Ventana":<15}{"Slots":>8}{"Consultas":>12}{"Tiempo (ms)":>14}')
+
+        for hours in (1, 2, 4, 8, 12):
+            end_time = time(8 + hours, 0)
+            base_slot = AvailabilitySlot(
+                staff=staff_profile,
+                date=day,
+                start_time=time(8, 0),
+                end_time=end_time,
+                duration=options['duration'],
+                repeat_type='once'
+            )
+
+            started = time_module.perf_counter()
+            with CaptureQueriesContext(connection) as queries:
+                slots = base_slot.generate_slots()
+            elapsed = (time_module.perf_counter() - started) * 1000
+
+            window = f'08:00-{end_time.strftime("%H:%M")}'
+            self.stdout.write(f'{window:<15}{len(slots):>8}{len(queries):>12}{elapsed:>14.2f}')
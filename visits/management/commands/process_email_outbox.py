@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from visits.emails import process_email_outbox, OUTBOX_BATCH_SIZE
+from visits.models import EmailOutbox
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Envía los emails pendientes del outbox (confirmaciones, cancelaciones, modificaciones)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Seguir ejecutándose y revisar el outbox periódicamente'
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=30,
+            help='Segundos entre revisiones con --loop (por defecto 30)'
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=OUTBOX_BATCH_SIZE,
+            help=f'Emails por lote (por defecto {OUTBOX_BATCH_SIZE})'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('=' * 70)
+        self.stdout.write(self.style.SUCCESS('📤 OUTBOX DE EMAILS'))
+        self.stdout.write(f'📅 Fecha: {timezone.now().strftime("%d/%m/%Y %H:%M")}')
+        self.stdout.write('=' * 70)
+
+        try:
+            while True:
+                totals = {'sent': 0, 'retried': 0, 'failed': 0}
+                # Lotes hasta vaciar lo que está listo para enviarse
+                while True:
+                    result = process_email_outbox(limit=options['limit'])
+                    for key in totals:
+                        totals[key] += result[key]
+                    if sum(result.values()) < options['limit']:
+                        break
+
+                if any(totals.values()) or not options['loop']:
+                    self.stdout.write(
+                        f'   ✉️  Enviados: {totals["sent"]} | 🔁 Reintentos: {totals["retried"]} | '
+                        f'❌ Fallidos: {totals["failed"]} | ⏳ Pendientes: '
+                        f'{EmailOutbox.objects.filter(status="pending").count()}'
+                    )
+
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('\n⏹️  Detenido'))
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(f'❌ ERROR CRÍTICO: {str(e)}'))
+            logger.error(f'Error en comando process_email_outbox: {str(e)}', exc_info=True)
+            raise
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from django.utils import timezone
+from visits.models import Appointment, AppointmentRollup
+from visits.rollups import rebuild_rollups
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Recalcula desde las citas el resumen que usan las estadísticas del dashboard'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--staff',
+            type=int,
+            help='ID del StaffProfile a recalcular (por defecto, todos)'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('=' * 70)
+        self.stdout.write(self.style.SUCCESS('📊 RESUMEN DE CITAS DEL DASHBOARD'))
+        self.stdout.write(f'📅 Fecha: {timezone.now().strftime("%d/%m/%Y %H:%M")}')
+        self.stdout.write('=' * 70)
+
+        staff_id = options['staff']
+        appointments = Appointment.objects.all()
+        rollups = AppointmentRollup.objects.all()
+        if staff_id is not None:
+            appointments = appointments.filter(staff_id=staff_id)
+            rollups = rollups.filter(staff_id=staff_id)
+
+        try:
+            before = rollups.aggregate(total=Sum('count'))['total'] or 0
+            started = time.perf_counter()
+            rows = rebuild_rollups(staff_id)
+            elapsed = time.perf_counter() - started
+
+            self.stdout.write(f'   🗂️  Filas: {rows} | 📋 Citas: {appointments.count()} | ⏱️  Tiempo: {elapsed:.2f}s')
+            if before != appointments.count():
+                self.stdout.write(self.style.WARNING(f'   ⚠️  El resumen contaba {before} citas antes de recalcular'))
+            self.stdout.write(self.style.SUCCESS('✅ Resumen recalculado'))
+
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(f'❌ ERROR CRÍTICO: {str(e)}'))
+            logger.error(f'Error en comando rebuild_appointment_rollups: {str(e)}', exc_info=True)
+            raise
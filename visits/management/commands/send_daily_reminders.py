@@ -14,6 +14,16 @@ class Command(BaseCommand):
             action='store_true',
             help='Mostrar qué se haría sin enviar emails realmente'
         )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            help='Conexiones SMTP en paralelo (por defecto REMINDER_EMAIL_WORKERS)'
+        )
+        parser.add_argument(
+            '--per-minute',
+            type=int,
+            help='Máximo de emails por minuto, 0 = sin límite (por defecto REMINDER_EMAILS_PER_MINUTE)'
+        )
 
     def handle(self, *args, **options):
         dry_run = options['dry_run']
@@ -107,7 +117,10 @@ class Command(BaseCommand):
                 
             else:
                 # ENVÍO REAL
-                result = send_daily_reminders()
+                result = send_daily_reminders(
+                    workers=options['workers'],
+                    per_minute=options['per_minute']
+                )
                 
                 self.stdout.write('')
                 self.stdout.write(self.style.SUCCESS('✅ RECORDATORIOS ENVIADOS:'))
@@ -120,6 +133,10 @@ class Command(BaseCommand):
                     self.stdout.write(f'   ℹ️  Staff omitidos (desactivado): {result["staff_emails_skipped"]}')
                 
                 self.stdout.write(f'   📋 Total citas mañana: {result.get("total_appointments", 0)}')
+                if result.get("emails_per_second"):
+                    per_minute = f'{result["per_minute"]} emails/min' if result['per_minute'] else 'sin límite'
+                    self.stdout.write(f'   ⏱️  Enviados en {result["seconds"]:.2f}s ({result["emails_per_second"]:.1f} emails/s)')
+                    self.stdout.write(f'   🔌 Conexiones: {result["workers"]} | Tope: {per_minute} | Reconexiones: {result["reconnects"]}')
                 self.stdout.write('')
                 
                 if result.get('error'):
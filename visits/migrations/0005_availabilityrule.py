@@ -0,0 +1,34 @@
+# Generated by Django 5.2.4 on 2026-10-16 23:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visits', '0004_populate_cancellation_tokens'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AvailabilityRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('month', models.IntegerField(choices=[(1, 'Enero'), (2, 'Febrero'), (3, 'Marzo'), (4, 'Abril'), (5, 'Mayo'), (6, 'Junio'), (7, 'Julio'), (8, 'Agosto'), (9, 'Septiembre'), (10, 'Octubre'), (11, 'Noviembre'), (12, 'Diciembre')])),
+                ('weekday', models.IntegerField(choices=[(0, 'Lunes'), (1, 'Martes'), (2, 'Miércoles'), (3, 'Jueves'), (4, 'Viernes'), (5, 'Sábado'), (6, 'Domingo')])),
+                ('start_time', models.TimeField()),
+                ('end_time', models.TimeField()),
+                ('duration', models.IntegerField(help_text='Duración de cada slot en minutos')),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('staff', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='availability_rules', to='visits.staffprofile')),
+                ('stages', models.ManyToManyField(related_name='availability_rules', to='visits.schoolstage')),
+            ],
+            options={
+                'ordering': ['year', 'month', 'weekday', 'start_time'],
+                'indexes': [models.Index(fields=['year', 'month', 'is_active'], name='visits_avai_year_28859b_idx'), models.Index(fields=['staff', 'is_active'], name='visits_avai_staff_i_7fe375_idx')],
+            },
+        ),
+    ]
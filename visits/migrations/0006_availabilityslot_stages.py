@@ -0,0 +1,75 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def merge_stage_copies(apps, schema_editor):
+    """Agrupa las copias por etapa de cada franja en una sola fila con varias etapas"""
+    AvailabilitySlot = apps.get_model('visits', 'AvailabilitySlot')
+    Through = AvailabilitySlot.stages.through
+
+    groups = {}
+    for slot in AvailabilitySlot.objects.order_by('id'):
+        key = (slot.staff_id, slot.date, slot.start_time, slot.end_time, slot.duration,
+               slot.is_active, slot.repeat_type, slot.month, slot.weekday)
+        groups.setdefault(key, []).append(slot)
+
+    links = []
+    duplicate_ids = []
+    for slots in groups.values():
+        keeper = slots[0]
+        stage_ids = {slot.stage_id for slot in slots if slot.stage_id}
+        links.extend(Through(availabilityslot_id=keeper.id, schoolstage_id=stage_id) for stage_id in stage_ids)
+        duplicate_ids.extend(slot.id for slot in slots[1:])
+
+    Through.objects.bulk_create(links, batch_size=500)
+    AvailabilitySlot.objects.filter(id__in=duplicate_ids).delete()
+
+
+def split_stage_copies(apps, schema_editor):
+    """Vuelve a una fila por etapa"""
+    AvailabilitySlot = apps.get_model('visits', 'AvailabilitySlot')
+
+    for slot in AvailabilitySlot.objects.prefetch_related('stages').order_by('id'):
+        stage_ids = sorted(stage.id for stage in slot.stages.all())
+        if not stage_ids:
+            continue
+        slot.stage_id = stage_ids[0]
+        slot.save(update_fields=['stage'])
+        for stage_id in stage_ids[1:]:
+            AvailabilitySlot.objects.create(
+                staff_id=slot.staff_id,
+                stage_id=stage_id,
+                date=slot.date,
+                start_time=slot.start_time,
+                end_time=slot.end_time,
+                duration=slot.duration,
+                is_active=slot.is_active,
+                repeat_type=slot.repeat_type,
+                month=slot.month,
+                weekday=slot.weekday,
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visits', '0005_availabilityrule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='availabilityslot',
+            name='stages',
+            field=models.ManyToManyField(related_name='availability_slots', to='visits.schoolstage'),
+        ),
+        migrations.AlterField(
+            model_name='availabilityslot',
+            name='stage',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='visits.schoolstage'),
+        ),
+        migrations.RunPython(merge_stage_copies, split_stage_copies),
+        migrations.RemoveField(
+            model_name='availabilityslot',
+            name='stage',
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.4 on 2026-10-16 23:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils.timezone import localtime
+
+
+def quarter_mask(start, end):
+    # Cuartos de hora entre 8:00 y 20:00 (ver scheduling.quarter_mask)
+    first, last = max(start, 480), min(end, 1200)
+    if first >= last:
+        return 0
+    low = (first - 480) // 15
+    high = -(-(last - 480) // 15)
+    return ((1 << (high - low)) - 1) << low
+
+
+def build_occupancy(apps, schema_editor):
+    Appointment = apps.get_model('visits', 'Appointment')
+    AvailabilitySlot = apps.get_model('visits', 'AvailabilitySlot')
+    OccupancyDay = apps.get_model('visits', 'OccupancyDay')
+
+    masks = {}
+    for staff_id, apt_date, duration in Appointment.objects.values_list('staff_id', 'date', 'duration'):
+        apt_local = localtime(apt_date)
+        start = apt_local.hour * 60 + apt_local.minute
+        entry = masks.setdefault((staff_id, apt_local.date()), [0, 0])
+        entry[0] |= quarter_mask(start, start + duration)
+
+    slots = AvailabilitySlot.objects.filter(
+        date__isnull=False,
+        is_active=True
+    ).values_list('staff_id', 'date', 'start_time', 'end_time')
+    for staff_id, day, start_time, end_time in slots:
+        entry = masks.setdefault((staff_id, day), [0, 0])
+        entry[1] |= quarter_mask(
+            start_time.hour * 60 + start_time.minute,
+            end_time.hour * 60 + end_time.minute
+        )
+
+    OccupancyDay.objects.bulk_create(
+        [
+            OccupancyDay(staff_id=staff_id, date=day, booked=booked, available=available)
+            for (staff_id, day), (booked, available) in masks.items()
+        ],
+        batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visits', '0006_availabilityslot_stages'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OccupancyDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('booked', models.BigIntegerField(default=0)),
+                ('available', models.BigIntegerField(default=0)),
+                ('staff', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='occupancy_days', to='visits.staffprofile')),
+            ],
+            options={
+                'unique_together': {('staff', 'date')},
+            },
+        ),
+        migrations.RunPython(build_occupancy, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-16 23:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visits', '0007_occupancyday'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schoolstage',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.4 on 2026-10-16 23:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils.timezone import localtime
+
+
+def build_rollups(apps, schema_editor):
+    Appointment = apps.get_model('visits', 'Appointment')
+    AppointmentRollup = apps.get_model('visits', 'AppointmentRollup')
+
+    counts = {}
+    for staff_id, stage_id, apt_date, status in Appointment.objects.values_list('staff_id', 'stage_id', 'date', 'status'):
+        apt_local = localtime(apt_date)
+        key = (staff_id, stage_id, apt_local.date(), apt_local.hour, status)
+        counts[key] = counts.get(key, 0) + 1
+
+    AppointmentRollup.objects.bulk_create(
+        [
+            AppointmentRollup(staff_id=staff_id, stage_id=stage_id, date=day, hour=hour, status=status, count=count)
+            for (staff_id, stage_id, day, hour, status), count in counts.items()
+        ],
+        batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visits', '0010_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('hour', models.PositiveSmallIntegerField()),
+                ('status', models.CharField(max_length=20)),
+                ('count', models.IntegerField(default=0)),
+                ('staff', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='appointment_rollups', to='visits.staffprofile')),
+                ('stage', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='appointment_rollups', to='visits.schoolstage')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date'], name='visits_appo_date_db4ceb_idx')],
+                'unique_together': {('staff', 'stage', 'date', 'hour', 'status')},
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
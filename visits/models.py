@@ -3,7 +3,7 @@
 # ====================================
 
 import uuid
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
@@ -22,9 +22,27 @@ logger = logging.getLogger(__name__)
 class SchoolStage(models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField()
+    # Cambia con cada modificación de slots, citas, cursos o staff de la etapa;
+    # es la base del ETag de los endpoints públicos
+    version = models.PositiveIntegerField(default=0, editable=False)
     
     def __str__(self):
         return self.name
+    
+    @classmethod
+    def bump_versions(cls, stage_ids=None, staff_id=None, user_id=None):
+        """
+        Incrementa con un único UPDATE la versión de las etapas indicadas o de
+        todas las etapas del staff (por su id o el de su usuario).
+        """
+        stages = cls.objects.all()
+        if stage_ids is not None:
+            stages = stages.filter(id__in=stage_ids)
+        if staff_id is not None:
+            stages = stages.filter(staffprofile=staff_id)
+        if user_id is not None:
+            stages = stages.filter(staffprofile__user=user_id)
+        stages.update(version=models.F('version') + 1)
 
 class Course(models.Model):
     """Modelo para los cursos específicos dentro de cada etapa"""
@@ -50,72 +68,18 @@ class StaffProfile(models.Model):
 
     def has_overlapping_slots(self, date, start_time, end_time, exclude_id=None):
         """
-        CORRECCIÓN COMPLETA: Verificar solapamientos de slots con manejo correcto de límites exactos
+        Verificar solapamientos de slots (los límites exactos están permitidos)
         """
-        logger.debug(f"Verificando solapamientos de slots para {self} en {date} de {start_time} a {end_time}")
-        
-        overlapping = AvailabilitySlot.objects.filter(
-            staff=self,
-            date=date,
-            is_active=True
-        )
-        
-        if exclude_id:
-            overlapping = overlapping.exclude(id=exclude_id)
-        
-        for slot in overlapping:
-            logger.debug(f"Comparando con slot existente: {slot.start_time} - {slot.end_time}")
-            
-            # CORRECCIÓN: Verificar solapamiento real (sin límites exactos)
-            # Hay solapamiento si: start1 < end2 AND end1 > start2
-            # PERO permitir límites exactos: end1 == start2 OR start1 == end2
-            if start_time < slot.end_time and end_time > slot.start_time:
-                # Permitir límites exactos
-                if end_time == slot.start_time or start_time == slot.end_time:
-                    logger.debug(f"Límite exacto permitido con slot {slot.id}")
-                    continue
-                
-                logger.warning(f"Slot solapado encontrado: {slot.id}")
-                return True
-        
-        logger.debug("No se encontraron solapamientos de slots")
-        return False
+        # Importar aquí para evitar import circular
+        from .scheduling import has_slot_conflict
+        return has_slot_conflict(self, date, start_time, end_time, exclude_id=exclude_id)
 
     def has_appointments_in_timeframe(self, date, start_time, end_time):
         """
-        CORRECCIÓN COMPLETA: Verificar citas que se solapen con manejo correcto de zonas horarias
+        Verificar citas que se solapen con el horario local indicado
         """
-        logger.debug(f"Verificando citas para {self} en {date} de {start_time} a {end_time}")
-        
-        # Buscar citas del mismo día
-        appointments_same_day = Appointment.objects.filter(
-            staff=self,
-            date__date=date
-        )
-        
-        logger.debug(f"Encontradas {appointments_same_day.count()} citas en {date}")
-        
-        for appointment in appointments_same_day:
-            # CORRECCIÓN: Convertir la cita a hora local para comparación
-            apt_local = localtime(appointment.date)
-            apt_start_time = apt_local.time()
-            apt_end_time = (apt_local + timedelta(minutes=appointment.duration)).time()
-            
-            logger.debug(f"Comparando con cita {appointment.id}: {apt_start_time} - {apt_end_time}")
-            
-            # CORRECCIÓN: Verificar solapamiento con times (no datetimes)
-            # Hay solapamiento si: start1 < end2 AND end1 > start2
-            if start_time < apt_end_time and end_time > apt_start_time:
-                # Permitir límites exactos
-                if end_time == apt_start_time or start_time == apt_end_time:
-                    logger.debug(f"Límite exacto permitido con cita {appointment.id}")
-                    continue
-                
-                logger.warning(f"Cita solapada encontrada: {appointment.id} ({apt_start_time} - {apt_end_time})")
-                return True
-        
-        logger.debug("No se encontraron solapamientos con citas")
-        return False
+        from .scheduling import has_appointment_conflict, local_interval
+        return has_appointment_conflict(self, *local_interval(date, start_time, end_time))
 
 # ====================================
 # Part 3: Appointment Management - CORREGIDO CON TOKEN
@@ -138,6 +102,7 @@ class Appointment(models.Model):
     date = models.DateTimeField()
     duration = models.PositiveIntegerField(default=60)  # Duración en minutos
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True, help_text="Última modificación (sincronización del calendario)")
     comments = models.TextField(blank=True, null=True)
     status = models.CharField(
         max_length=20, 
@@ -151,6 +116,13 @@ class Appointment(models.Model):
     # TOKEN ÚNICO PARA CANCELACIÓN
     cancellation_token = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     
+    # Campos que afectan a la agenda. Si ninguno cambia desde que se cargó la
+    # cita (estado, notas, recordatorio...), save() no repite las validaciones
+    # con consultas ni se recalcula la disponibilidad.
+    SCHEDULING_FIELDS = ('date', 'duration', 'staff_id', 'stage_id', 'course_id')
+    # Campos que deciden en qué fila de AppointmentRollup cuenta la cita
+    ROLLUP_FIELDS = ('staff_id', 'stage_id', 'date', 'status')
+    
     class Meta:
         ordering = ['-date']
         indexes = [
@@ -182,71 +154,135 @@ class Appointment(models.Model):
                 'staff': _('Este miembro del staff no puede atender citas de esta etapa.')
             })
         
-        # Validar formato del teléfono
-        if self.visitor_phone and (not self.visitor_phone.isdigit() or len(self.visitor_phone) != 9):
-            logger.warning(f"Formato de teléfono inválido: {self.visitor_phone}")
-            raise ValidationError({
-                'visitor_phone': _('El teléfono debe contener exactamente 9 dígitos.')
-            })
+        self.clean_phone()
         
         # CORRECCIÓN PRINCIPAL: Validar solapamientos con zona horaria correcta
         if self.date and self.staff and self.duration:
-            # Convertir a hora local para comparaciones Y mensajes
-            appointment_local = localtime(self.date)
-            appointment_date = appointment_local.date()
-            appointment_start_time = appointment_local.time()
-            appointment_end_time = (appointment_local + timedelta(minutes=self.duration)).time()
-            
-            logger.debug(f"Validando cita: {appointment_date} {appointment_start_time} - {appointment_end_time}")
+            from .scheduling import find_appointment_conflict, describe_conflict
             
-            # Buscar citas existentes del mismo staff en el mismo día
-            existing_appointments = Appointment.objects.filter(
-                staff=self.staff,
-                date__date=appointment_date
+            conflict = find_appointment_conflict(
+                self.staff,
+                self.date,
+                self.date + timedelta(minutes=self.duration),
+                exclude_id=self.pk
             )
-            
-            # Excluir la cita actual si estamos editando
-            if self.pk:
-                existing_appointments = existing_appointments.exclude(pk=self.pk)
-                logger.debug(f"Excluyendo cita actual (ID: {self.pk}) de la validación")
-            
-            logger.debug(f"Encontradas {existing_appointments.count()} citas existentes para validar")
-            
-            # Verificar solapamientos cita por cita
-            for existing_apt in existing_appointments:
-                # CORRECCIÓN: Convertir cita existente a hora local PARA COMPARACIÓN Y MENSAJE
-                existing_local = localtime(existing_apt.date)
-                existing_start_time = existing_local.time()
-                existing_end_time = (existing_local + timedelta(minutes=existing_apt.duration)).time()
-                
-                logger.debug(f"Comparando con cita {existing_apt.id}:")
-                logger.debug(f"  Existente: {existing_start_time} - {existing_end_time}")
-                logger.debug(f"  Nueva:     {appointment_start_time} - {appointment_end_time}")
-                
-                # CORRECCIÓN: Verificar solapamiento con times locales y permitir límites exactos
-                if appointment_start_time < existing_end_time and appointment_end_time > existing_start_time:
-                    # Permitir límites exactos
-                    if appointment_end_time == existing_start_time or appointment_start_time == existing_end_time:
-                        logger.debug(f"Límite exacto permitido con cita {existing_apt.id}")
-                        continue
-                    
-                    logger.warning("Cita solapada encontrada")
-                    
-                    # CORRECCIÓN: Mensaje con horas locales
-                    raise ValidationError(
-                        f'Ya existe una cita de {existing_apt.visitor_name} '
-                        f'programada de {existing_start_time.strftime("%H:%M")} a {existing_end_time.strftime("%H:%M")} '  
-                        f'el {existing_local.strftime("%d/%m/%Y")}'
-                    )
-                else:
-                    logger.debug(f"No hay solapamiento con cita {existing_apt.id}")
+            if conflict:
+                # Mensaje con horas locales
+                details = describe_conflict(conflict)
+                raise ValidationError(
+                    f'Ya existe una cita de {details["visitor_name"]} '
+                    f'programada de {details["start"].strftime("%H:%M")} a {details["end"].strftime("%H:%M")} '
+                    f'el {details["start"].strftime("%d/%m/%Y")}'
+                )
         
         logger.info(f"Cita para {self.visitor_name} validada correctamente")
     
+    @classmethod
+    def create_batch(cls, appointments):
+        """
+        Guarda citas ya validadas con un solo bulk_create (ver
+        BulkAppointmentAPIView). bulk_create no llama a save() ni envía señales,
+        así que la disponibilidad y el dashboard (resumen y caché) se actualizan aquí.
+        """
+        # Importar aquí para evitar import circular
+        from .signals import availability_changed
+        from .rollups import adjust_rollups, count_keys
+        from .dashboard_cache import invalidate_dashboards
+        
+        created = cls.objects.bulk_create(appointments, batch_size=100)
+        adjust_rollups(count_keys(appointment._rollup_state() for appointment in created))
+        invalidate_dashboards({appointment.staff_id for appointment in created})
+        
+        days_by_staff = {}
+        for appointment in created:
+            days_by_staff.setdefault(appointment.staff_id, set()).add(localtime(appointment.date).date())
+        for staff_id, days in days_by_staff.items():
+            availability_changed(staff_id, days)
+        return created
+    
+    @classmethod
+    def bulk_set_status(cls, queryset, status):
+        """
+        Pone `status` a las citas del queryset con un único UPDATE y devuelve
+        cuántas cambiaron. La disponibilidad no depende del estado; el resumen
+        y la caché del dashboard sí, y se actualizan aquí porque update() no
+        envía señales (ni rellena updated_at).
+        """
+        # Importar aquí para evitar import circular
+        from .rollups import adjust_rollups, count_keys
+        from .dashboard_cache import invalidate_dashboards
+        
+        if status not in dict(cls.STATUS_CHOICES):
+            raise ValueError(f"Estado de cita inválido: {status}")
+        
+        with transaction.atomic():
+            changing = queryset.exclude(status=status)
+            rows = list(changing.order_by().values_list('pk', 'staff_id', 'stage_id', 'date', 'status'))
+            if not rows:
+                return 0
+            updated = cls.objects.filter(pk__in=[row[0] for row in rows]).update(
+                status=status,
+                updated_at=timezone.now()
+            )
+            
+            deltas = {}
+            for key, count in count_keys(row[1:] for row in rows).items():
+                deltas[key] = deltas.get(key, 0) - count
+            for key, count in count_keys(row[1:4] + (status,) for row in rows).items():
+                deltas[key] = deltas.get(key, 0) + count
+            adjust_rollups(deltas)
+            invalidate_dashboards({row[1] for row in rows})
+        return updated
+    
+    def clean_phone(self):
+        """Validar formato del teléfono"""
+        if self.visitor_phone and (not self.visitor_phone.isdigit() or len(self.visitor_phone) != 9):
+            logger.warning(f"Formato de teléfono inválido: {self.visitor_phone}")
+            raise ValidationError({
+                'visitor_phone': _('El teléfono debe contener exactamente 9 dígitos.')
+            })
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_scheduling = instance._scheduling_state()
+        instance._loaded_rollup = instance._rollup_state()
+        return instance
+    
+    def _rollup_state(self):
+        """(staff, etapa, fecha, estado) con los que la cita cuenta en AppointmentRollup"""
+        if any(field not in self.__dict__ for field in self.ROLLUP_FIELDS):
+            return None
+        return tuple(self.__dict__[field] for field in self.ROLLUP_FIELDS)
+    
+    def _scheduling_state(self):
+        # Con .only()/.defer() puede faltar algún campo: entonces se valida todo
+        if any(field not in self.__dict__ for field in self.SCHEDULING_FIELDS):
+            return None
+        return tuple(self.__dict__[field] for field in self.SCHEDULING_FIELDS)
+    
+    def scheduling_changed(self):
+        """True si la cita es nueva o cambió fecha, duración, staff, etapa o curso"""
+        loaded = getattr(self, '_loaded_scheduling', None)
+        return self._state.adding or loaded is None or loaded != self._scheduling_state()
+    
     def save(self, *args, **kwargs):
-        self.full_clean()
+        # Lo consultan las señales tras el guardado (ver signals.py)
+        self._scheduling_dirty = self.scheduling_changed()
+        if self._scheduling_dirty:
+            self.full_clean()
+        else:
+            # Agenda intacta: solapes, etapas del staff y curso siguen siendo válidos
+            self.clean_fields(exclude=['stage', 'course', 'staff'])
+            self.clean_phone()
+        if self.pk is not None and getattr(self, '_loaded_rollup', None) is None:
+            # Cita no cargada de la BD (o con campos diferidos): el resumen del
+            # dashboard necesita saber dónde contaba antes del guardado
+            self._loaded_rollup = type(self).objects.filter(pk=self.pk).values_list(*self.ROLLUP_FIELDS).first()
         logger.debug(f"Guardando cita para {self.visitor_name} a las {self.date}")
         super().save(*args, **kwargs)
+        self._loaded_scheduling = self._scheduling_state()
+        self._loaded_rollup = self._rollup_state()
     
     def is_past(self):
         """Verifica si la cita ya pasó"""
@@ -271,7 +307,8 @@ class AvailabilitySlot(models.Model):
     ]
     
     staff = models.ForeignKey(StaffProfile, on_delete=models.CASCADE)
-    stage = models.ForeignKey(SchoolStage, on_delete=models.CASCADE)
+    # Una franja horaria es una sola fila, válida para varias etapas
+    stages = models.ManyToManyField(SchoolStage, related_name='availability_slots')
     date = models.DateField(null=True, blank=True)
     start_time = models.TimeField()
     end_time = models.TimeField()
@@ -310,10 +347,6 @@ class AvailabilitySlot(models.Model):
             logger.warning("La duración debe ser un valor positivo")
             raise ValidationError({'duration': 'La duración debe ser positiva'})
         
-        if self.stage not in self.staff.allowed_stages.all():
-            logger.warning("El profesor no está autorizado para atender esta etapa")
-            raise ValidationError({'stage': 'Este miembro del staff no puede atender esta etapa'})
-        
         # Validar según tipo de repetición
         if self.repeat_type == 'once':
             if not self.date:
@@ -372,118 +405,152 @@ class AvailabilitySlot(models.Model):
             logger.debug("El slot no está activo")
             return False
         
-        # Verificar si hay citas que se solapen con este slot
-        appointments = Appointment.objects.filter(
-            stage=self.stage,
-            staff=self.staff,
-            date__date=self.date
-        )
-        
-        for apt in appointments:
-            apt_local = localtime(apt.date)
-            apt_start_time = apt_local.time()
-            apt_end_time = (apt_local + timedelta(minutes=apt.duration)).time()
-            
-            # Verificar solapamiento con límites exactos permitidos
-            if self.start_time < apt_end_time and self.end_time > apt_start_time:
-                # Permitir límites exactos
-                if self.end_time == apt_start_time or self.start_time == apt_end_time:
-                    continue
-                
-                logger.debug("El slot no está disponible debido a una cita existente")
-                return False
+        # Verificar si hay citas del staff que se solapen con este slot
+        from .scheduling import has_appointment_conflict, local_interval
+        if has_appointment_conflict(self.staff, *local_interval(self.date, self.start_time, self.end_time)):
+            logger.debug("El slot no está disponible debido a una cita existente")
+            return False
         
         logger.debug("El slot está disponible")
         return True
 
     def generate_slots(self):
         """
-        CORRECCIÓN COMPLETA: Genera slots con manejo correcto
+        Genera los slots (sin guardarlos) de la franja; las etapas se asignan
+        al guardarlos con create_with_stages.
         """
         logger.info(f"Generando slots para {self.staff} con tipo '{self.repeat_type}'")
         if self.repeat_type == 'once':
             return self._generate_day_slots()
         return self._generate_monthly_slots()
 
-    def _generate_day_slots(self):
+    def _build_slots(self, date, starts):
+        """Instancia los slots de una fecha a partir de los inicios libres (en minutos)"""
+        from .scheduling import from_minutes
+        
+        return [
+            AvailabilitySlot(
+                staff=self.staff,
+                date=date,
+                start_time=from_minutes(start),
+                end_time=from_minutes(start + self.duration),
+                duration=self.duration,
+                is_active=True,
+                repeat_type='once'
+            )
+            for start in starts
+        ]
+
+    @classmethod
+    def create_with_stages(cls, slots, stages):
         """
-        CORRECCIÓN COMPLETA: Genera slots individuales para un día específico
+        Guarda los slots con bulk_create y les asigna las etapas en una sola
+        inserción. bulk_create no envía señales, así que lo que depende de
+        la disponibilidad se actualiza aquí (ver signals.availability_changed).
         """
-        slots = []
-        current_dt = datetime.combine(self.date, self.start_time)
-        end_dt = datetime.combine(self.date, self.end_time)
+        # Importar aquí para evitar import circular
+        from .signals import availability_changed
         
-        # Redondear al próximo intervalo de 15 minutos si es necesario
-        minutes = current_dt.minute
-        if minutes % 15 != 0:
-            minutes = ((minutes // 15) + 1) * 15
-            current_dt = current_dt.replace(minute=minutes)
+        created = cls.objects.bulk_create(slots, batch_size=100)
+        through = cls.stages.through
+        through.objects.bulk_create(
+            [
+                through(availabilityslot_id=slot.id, schoolstage_id=stage.id)
+                for slot in created
+                for stage in stages
+            ],
+            batch_size=500
+        )
         
-        # Generar slots mientras haya espacio para la duración completa
-        while current_dt + timedelta(minutes=self.duration) <= end_dt:
-            slot_start = current_dt.time()
-            slot_end = (current_dt + timedelta(minutes=self.duration)).time()
-            
-            # CORRECCIÓN: Verificar si existe una cita programada en este intervalo
-            if not self.staff.has_appointments_in_timeframe(self.date, slot_start, slot_end):
-                slot = AvailabilitySlot(
-                    staff=self.staff,
-                    stage=self.stage,
-                    date=self.date,
-                    start_time=slot_start,
-                    end_time=slot_end,
-                    duration=self.duration,
-                    is_active=True,
-                    repeat_type='once'
-                )
-                slots.append(slot)
-                logger.debug(f"Slot generado: {slot_start} - {slot_end} para {self.date}")
-            
-            # Avanzar 15 minutos
-            current_dt += timedelta(minutes=15)
+        days_by_staff = {}
+        for slot in created:
+            days_by_staff.setdefault(slot.staff_id, set()).add(slot.date)
+        stage_ids = [stage.id for stage in stages]
+        for staff_id, days in days_by_staff.items():
+            availability_changed(staff_id, days, stage_ids)
+        return created
+
+    @classmethod
+    def delete_batch(cls, queryset, refresh=True):
+        """
+        Borra los slots del queryset con un DELETE para sus etapas y otro para
+        los slots. delete() cargaría cada fila y enviaría post_delete una vez
+        por slot (ver signals.refresh_slot_occupancy); aquí lo que depende de
+        la disponibilidad se actualiza una vez por staff. Con refresh=False lo
+        hace quien llama (p. ej. Appointment.create_batch, que refresca los
+        mismos días). Devuelve cuántos slots se borraron.
+        """
+        # Importar aquí para evitar import circular
+        from .signals import availability_changed
+
+        rows = list(queryset.order_by().values_list('id', 'staff_id', 'date'))
+        if not rows:
+            return 0
+
+        ids = [slot_id for slot_id, _, _ in rows]
+        through = cls.stages.through.objects.filter(availabilityslot_id__in=ids)
+        stages_by_slot = {}
+        if refresh:
+            for slot_id, stage_id in through.values_list('availabilityslot_id', 'schoolstage_id'):
+                stages_by_slot.setdefault(slot_id, set()).add(stage_id)
+        with transaction.atomic():
+            through._raw_delete(queryset.db)
+            deleted = cls.objects.filter(id__in=ids)._raw_delete(queryset.db)
+
+        if refresh:
+            # Días y etapas (las de los propios slots) por staff
+            changes = {}
+            for slot_id, staff_id, day in rows:
+                if day is not None:
+                    days, stage_ids = changes.setdefault(staff_id, (set(), set()))
+                    days.add(day)
+                    stage_ids.update(stages_by_slot.get(slot_id, ()))
+            for staff_id, (days, stage_ids) in changes.items():
+                availability_changed(staff_id, days, sorted(stage_ids))
+        return deleted
+
+    def _generate_day_slots(self, busy=None):
+        """
+        Genera slots individuales para un día específico.
+
+        Las citas del día se cargan una sola vez (o se reciben ya cargadas en
+        `busy`, ver scheduling.busy_intervals_by_date) y los huecos libres se
+        calculan en un único barrido.
+        """
+        from .scheduling import busy_intervals, free_slot_starts
+        
+        if busy is None:
+            busy = busy_intervals(self.staff, self.date)
+        
+        starts = free_slot_starts(self.start_time, self.end_time, self.duration, busy)
+        slots = self._build_slots(self.date, starts)
         
         logger.info(f"Generados {len(slots)} slots diarios para {self.date}")
         return slots
 
     def _generate_monthly_slots(self):
         """
-        CORRECCIÓN COMPLETA: Genera slots para todas las ocurrencias del día de la semana
+        Genera slots para todas las ocurrencias del día de la semana en el mes.
+
+        Las citas de todo el mes se leen con una única consulta de rango y se
+        agrupan por fecha local.
         """
-        slots = []
-        year = datetime.now().year
-        c = calendar.monthcalendar(year, self.month)
+        from .scheduling import busy_intervals_by_date, free_slot_starts, month_weekday_dates
         
-        for week in c:
-            if week[self.weekday] != 0:
-                date_obj = datetime(year, self.month, week[self.weekday]).date()
-                if date_obj >= datetime.now().date():
-                    current_dt = datetime.combine(date_obj, self.start_time)
-                    end_dt = datetime.combine(date_obj, self.end_time)
-                    
-                    # Redondear al próximo intervalo de 15 minutos
-                    minutes = current_dt.minute
-                    if minutes % 15 != 0:
-                        minutes = ((minutes // 15) + 1) * 15
-                        current_dt = current_dt.replace(minute=minutes)
-                    
-                    while current_dt + timedelta(minutes=self.duration) <= end_dt:
-                        slot_start = current_dt.time()
-                        slot_end = (current_dt + timedelta(minutes=self.duration)).time()
-                        
-                        # CORRECCIÓN: Verificación correcta de solapamientos
-                        if not self.staff.has_appointments_in_timeframe(date_obj, slot_start, slot_end):
-                            slot = AvailabilitySlot(
-                                staff=self.staff,
-                                stage=self.stage,
-                                date=date_obj,
-                                start_time=slot_start,
-                                end_time=slot_end,
-                                duration=self.duration,
-                                is_active=True,
-                                repeat_type='once'
-                            )
-                            slots.append(slot)
-                        current_dt += timedelta(minutes=15)
+        today = datetime.now().date()
+        dates = [
+            date_obj for date_obj in month_weekday_dates(datetime.now().year, self.month, self.weekday)
+            if date_obj >= today
+        ]
+        if not dates:
+            return []
+        
+        busy_by_date = busy_intervals_by_date(self.staff, dates[0], dates[-1])
+        
+        slots = []
+        for date_obj in dates:
+            starts = free_slot_starts(self.start_time, self.end_time, self.duration, busy_by_date.get(date_obj, []))
+            slots.extend(self._build_slots(date_obj, starts))
         
         logger.info(f"Generados {len(slots)} slots mensuales para el mes {self.month}")
         return slots
@@ -514,6 +581,207 @@ class AvailabilitySlot(models.Model):
         count = old_slots.count()
         if count > 0:
             logger.info(f"Limpiando {count} slots antiguos sin citas asignadas")
-            old_slots.delete()
+            cls.delete_batch(old_slots)
         
-        return count
\ No newline at end of file
+        return count
+
+class AvailabilityRule(models.Model):
+    """
+    Disponibilidad semanal guardada como una sola regla.
+
+    No se materializa en AvailabilitySlot: los huecos se calculan bajo demanda
+    para el rango de fechas consultado, descontando las citas ya reservadas
+    (ver scheduling.expand_rules).
+    """
+    WEEKDAY_CHOICES = [
+        (0, 'Lunes'),
+        (1, 'Martes'),
+        (2, 'Miércoles'),
+        (3, 'Jueves'),
+        (4, 'Viernes'),
+        (5, 'Sábado'),
+        (6, 'Domingo'),
+    ]
+    MONTH_CHOICES = [
+        (1, 'Enero'), (2, 'Febrero'), (3, 'Marzo'), (4, 'Abril'),
+        (5, 'Mayo'), (6, 'Junio'), (7, 'Julio'), (8, 'Agosto'),
+        (9, 'Septiembre'), (10, 'Octubre'), (11, 'Noviembre'), (12, 'Diciembre'),
+    ]
+    
+    staff = models.ForeignKey(StaffProfile, on_delete=models.CASCADE, related_name='availability_rules')
+    stages = models.ManyToManyField(SchoolStage, related_name='availability_rules')
+    year = models.IntegerField()
+    month = models.IntegerField(choices=MONTH_CHOICES)
+    weekday = models.IntegerField(choices=WEEKDAY_CHOICES)
+    start_time = models.TimeField()
+    end_time = models.TimeField()
+    duration = models.IntegerField(help_text='Duración de cada slot en minutos')
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['year', 'month', 'weekday', 'start_time']
+        indexes = [
+            models.Index(fields=['year', 'month', 'is_active']),
+            models.Index(fields=['staff', 'is_active']),
+        ]
+    
+    def clean(self):
+        if self.start_time < time(8, 0) or self.end_time > time(20, 0):
+            raise ValidationError(_('Los horarios deben estar entre 8:00 y 20:00'))
+        if self.end_time <= self.start_time:
+            raise ValidationError({'end_time': 'La hora de fin debe ser posterior a la hora de inicio'})
+        if self.duration <= 0:
+            raise ValidationError({'duration': 'La duración debe ser positiva'})
+    
+    def save(self, *args, **kwargs):
+        self.full_clean()
+        logger.debug(f"Guardando regla semanal para {self.staff}: {self}")
+        super().save(*args, **kwargs)
+    
+    def dates(self):
+        """Fechas del mes en las que aplica la regla"""
+        from .scheduling import month_weekday_dates
+        return month_weekday_dates(self.year, self.month, self.weekday)
+    
+    def __str__(self):
+        return (
+            f"{self.get_weekday_display()} ({self.get_month_display().lower()} {self.year}) "
+            f"{self.start_time.strftime('%H:%M')} - {self.end_time.strftime('%H:%M')}"
+        )
+
+class OccupancyDay(models.Model):
+    """
+    Índice compacto de ocupación de un staff en un día local.
+
+    Cada bit es un cuarto de hora del horario de atención (8:00 a 20:00, 48
+    bits; el bit 0 es 8:00-8:15). `booked` marca los cuartos tocados por
+    citas y `available` los cubiertos por slots activos. Un bit a 0 garantiza
+    que no hay nada en ese cuarto; un bit a 1 solo indica que puede haberlo,
+    y la respuesta exacta se consulta después (ver scheduling.refresh_occupancy).
+    """
+    staff = models.ForeignKey(StaffProfile, on_delete=models.CASCADE, related_name='occupancy_days')
+    date = models.DateField()
+    booked = models.BigIntegerField(default=0)
+    available = models.BigIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['staff', 'date']
+    
+    def __str__(self):
+        return f"{self.staff} - {self.date}"
+
+# ====================================
+# Part 5: Email Outbox
+# ====================================
+
+class EmailOutbox(models.Model):
+    """
+    Email ya renderizado pendiente de envío.
+
+    Se guarda en la misma transacción que el cambio de la cita, así el SMTP
+    nunca corre dentro de ella; lo envía después process_email_outbox (desde
+    un hilo tras el commit o desde el comando del mismo nombre), con
+    reintentos espaciados si el servidor falla.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pendiente'),
+        ('sending', 'Enviando'),
+        ('sent', 'Enviado'),
+        ('failed', 'Fallido'),
+    ]
+    
+    kind = models.CharField(max_length=50, help_text='Tipo de email (confirmación, cancelación...)')
+    appointment = models.ForeignKey(Appointment, on_delete=models.SET_NULL, null=True, blank=True, related_name='emails')
+    to = models.EmailField()
+    subject = models.CharField(max_length=255)
+    html_body = models.TextField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.kind} - {self.to} ({self.get_status_display()})"
+
+# ====================================
+# Part 6: Idempotency Keys
+# ====================================
+
+class IdempotencyKey(models.Model):
+    """
+    Respuesta guardada de una petición con cabecera Idempotency-Key: si el
+    cliente la repite (doble clic, reintento de red), se devuelve tal cual.
+    Sin respuesta todavía significa que la petición original está en curso.
+    """
+    scope = models.CharField(max_length=255, help_text='Ruta y usuario de la petición')
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    response_body = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    
+    class Meta:
+        unique_together = ['scope', 'key']
+    
+    def __str__(self):
+        return f"{self.scope} - {self.key}"
+
+# ====================================
+# Part 7: Appointment Rollups
+# ====================================
+
+class AppointmentRollup(models.Model):
+    """
+    Número de citas por staff, etapa, día local, hora local y estado.
+
+    Lo mantienen las señales de Appointment (y las operaciones masivas que no
+    las envían); las estadísticas del dashboard leen estas filas en lugar de
+    recorrer todas las citas. Se reconstruye con rebuild_appointment_rollups.
+    """
+    staff = models.ForeignKey(StaffProfile, on_delete=models.CASCADE, related_name='appointment_rollups')
+    stage = models.ForeignKey(SchoolStage, on_delete=models.CASCADE, related_name='appointment_rollups')
+    date = models.DateField()
+    hour = models.PositiveSmallIntegerField()
+    status = models.CharField(max_length=20)
+    count = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['staff', 'stage', 'date', 'hour', 'status']
+        indexes = [
+            models.Index(fields=['date']),
+        ]
+    
+    def __str__(self):
+        return f"{self.staff} - {self.stage} - {self.date} {self.hour:02d}h {self.status}: {self.count}"
+
+# ====================================
+# Part 8: Appointment Tombstones
+# ====================================
+
+class AppointmentTombstone(models.Model):
+    """
+    Rastro de una cita que ya no está donde el calendario del dashboard la
+    vio por última vez: borrada, o movida a otro staff u otra fecha. Con
+    updated_at de Appointment permite devolver solo los cambios desde el
+    último sync_token (ver calendar_sync.py). Se borran pasado TOMBSTONE_TTL.
+    """
+    appointment_id = models.BigIntegerField()
+    # Sin FK: el rastro tiene que sobrevivir al borrado del staff
+    staff_id = models.BigIntegerField()
+    date = models.DateTimeField(help_text="Fecha que tenía la cita")
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    def __str__(self):
+        return f"Cita {self.appointment_id} ({self.date}) - {self.deleted_at}"
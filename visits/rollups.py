@@ -0,0 +1,92 @@
+# visits/rollups.py
+# ====================================
+# Resumen de citas para el dashboard
+# ====================================
+#
+# AppointmentRollup guarda cuántas citas hay por (staff, etapa, día local, hora
+# local, estado). Cada alta, cambio o borrado de una cita suma o resta en las
+# filas afectadas; rebuild_rollups lo recalcula todo desde las citas.
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.timezone import localtime
+import logging
+
+from .models import Appointment, AppointmentRollup
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_FIELDS = ('staff_id', 'stage_id', 'date', 'hour', 'status')
+
+
+def rollup_key(staff_id, stage_id, date, status):
+    """Clave (staff, etapa, día local, hora local, estado) de una cita"""
+    date_local = localtime(date)
+    return (staff_id, stage_id, date_local.date(), date_local.hour, status)
+
+
+def adjust_rollups(deltas):
+    """
+    Aplica {clave: incremento} a las filas del resumen. Las filas que no
+    existen se crean al sumar; las que bajan a 0 se quedan (no suman nada).
+    """
+    for key, delta in deltas.items():
+        if not delta:
+            continue
+        lookup = dict(zip(ROLLUP_FIELDS, key))
+        if AppointmentRollup.objects.filter(**lookup).update(count=F('count') + delta):
+            continue
+        if delta < 0:
+            # La fila ya no existe (borrada en cascada con la etapa): nada que restar
+            continue
+        try:
+            with transaction.atomic():
+                AppointmentRollup.objects.create(**lookup, count=delta)
+        except IntegrityError:
+            # Otra petición creó la fila entre el UPDATE y el INSERT
+            AppointmentRollup.objects.filter(**lookup).update(count=F('count') + delta)
+
+
+def appointment_changed(old_key, new_key):
+    """Mueve una cita de la clave `old_key` a `new_key` (None = no existía / ya no existe)"""
+    if old_key == new_key:
+        return
+    deltas = {}
+    if old_key is not None:
+        deltas[old_key] = deltas.get(old_key, 0) - 1
+    if new_key is not None:
+        deltas[new_key] = deltas.get(new_key, 0) + 1
+    adjust_rollups(deltas)
+
+
+def count_keys(rows):
+    """{clave: número de citas} para filas (staff_id, stage_id, date, status)"""
+    deltas = {}
+    for staff_id, stage_id, date, status in rows:
+        key = rollup_key(staff_id, stage_id, date, status)
+        deltas[key] = deltas.get(key, 0) + 1
+    return deltas
+
+
+def rebuild_rollups(staff_id=None):
+    """
+    Recalcula el resumen desde las citas (de un staff o de todos) y devuelve
+    cuántas filas escribe.
+    """
+    appointments = Appointment.objects.all()
+    rollups = AppointmentRollup.objects.all()
+    if staff_id is not None:
+        appointments = appointments.filter(staff_id=staff_id)
+        rollups = rollups.filter(staff_id=staff_id)
+
+    counts = count_keys(appointments.values_list('staff_id', 'stage_id', 'date', 'status').iterator())
+
+    with transaction.atomic():
+        rollups.delete()
+        AppointmentRollup.objects.bulk_create(
+            [AppointmentRollup(**dict(zip(ROLLUP_FIELDS, key)), count=count) for key, count in counts.items()],
+            batch_size=500
+        )
+
+    logger.info(f"Resumen de citas reconstruido ({'staff ' + str(staff_id) if staff_id else 'todos'}): {len(counts)} filas")
+    return len(counts)
@@ -0,0 +1,596 @@
+# visits/scheduling.py
+# ====================================
+# Motor de solapamientos de agenda
+# ====================================
+#
+# Punto único para responder "¿choca [start, end) con algo del staff X?".
+# Los límites exactos están permitidos: una cita que termina a las 10:00 no
+# se solapa con otra que empieza a las 10:00.
+
+from django.db.models import Q, Count, Min, Max
+from django.utils.timezone import make_aware, localtime
+from datetime import datetime, timedelta, time
+import calendar
+import logging
+import re
+
+from .models import Appointment, AvailabilitySlot, AvailabilityRule, OccupancyDay
+
+logger = logging.getLogger(__name__)
+
+# Los slots empiezan siempre en múltiplos de 15 minutos
+SLOT_STEP_MINUTES = 15
+
+# Horario cubierto por el índice de ocupación (minutos desde medianoche)
+OCCUPANCY_START = 8 * 60
+OCCUPANCY_END = 20 * 60
+
+
+def _staff_pk(staff):
+    """Acepta un StaffProfile o directamente su id"""
+    return getattr(staff, 'pk', staff)
+
+
+def local_day_start(day):
+    """Inicio (aware) del día local indicado"""
+    return make_aware(datetime.combine(day, time.min))
+
+
+def local_interval(day, start_time, end_time):
+    """Convierte una fecha local y dos horas en un intervalo aware [start, end)"""
+    return (
+        make_aware(datetime.combine(day, start_time)),
+        make_aware(datetime.combine(day, end_time)),
+    )
+
+
+def appointment_end(appointment):
+    return appointment.date + timedelta(minutes=appointment.duration)
+
+
+def to_minutes(value):
+    """Minutos desde medianoche de una hora"""
+    return value.hour * 60 + value.minute
+
+
+def from_minutes(minutes):
+    return time(minutes // 60, minutes % 60)
+
+
+def month_weekday_dates(year, month, weekday):
+    """Todas las fechas del mes que caen en el día de la semana indicado (0 = lunes)"""
+    return [
+        datetime(year, month, week[weekday]).date()
+        for week in calendar.monthcalendar(year, month)
+        if week[weekday] != 0
+    ]
+
+
+# ====================================
+# Citas
+# ====================================
+
+def overlapping_appointments(staff, start, end, exclude_id=None, lock=False):
+    """
+    Citas del staff que se solapan con [start, end).
+
+    Una sola consulta sobre el índice (staff, date): solo se leen las citas
+    del mismo día local que empiezan antes de `end`; el fin de cada una se
+    compara después en Python. Si el intervalo cae dentro del horario de
+    atención, antes se mira el bitmap del día y, si está libre, no se leen
+    citas. Con `lock` se consulta siempre la tabla de citas.
+    """
+    if not lock and not _booked_in_window(staff, start, end):
+        return []
+
+    queryset = Appointment.objects.filter(
+        staff_id=_staff_pk(staff),
+        date__gte=local_day_start(localtime(start).date()),
+        date__lt=end
+    )
+    if exclude_id:
+        queryset = queryset.exclude(pk=exclude_id)
+    if lock:
+        queryset = queryset.select_for_update()
+
+    return [apt for apt in queryset.order_by('date') if appointment_end(apt) > start]
+
+
+def _booked_in_window(staff, start, end):
+    """
+    False si el bitmap garantiza que no hay citas en [start, end).
+
+    Solo se usa para intervalos dentro de un único día y del horario de
+    atención; en cualquier otro caso devuelve True y se consulta la tabla.
+    """
+    start_local, end_local = localtime(start), localtime(end)
+    day = start_local.date()
+    start_minutes = to_minutes(start_local)
+    end_minutes = to_minutes(end_local) if end_local.date() == day else None
+    if end_minutes is None or start_minutes < OCCUPANCY_START or end_minutes > OCCUPANCY_END:
+        return True
+
+    booked = OccupancyDay.objects.filter(
+        staff_id=_staff_pk(staff),
+        date=day
+    ).values_list('booked', flat=True).first()
+    return bool((booked or 0) & quarter_mask(start_minutes, end_minutes))
+
+
+def find_appointment_conflict(staff, start, end, exclude_id=None, lock=False):
+    """Primera cita que se solapa con [start, end) o None"""
+    overlapping = overlapping_appointments(staff, start, end, exclude_id=exclude_id, lock=lock)
+    if overlapping:
+        logger.warning(f"Cita solapada encontrada: {overlapping[0].id}")
+        return overlapping[0]
+    return None
+
+
+def has_appointment_conflict(staff, start, end, exclude_id=None):
+    return find_appointment_conflict(staff, start, end, exclude_id=exclude_id) is not None
+
+
+def describe_conflict(appointment):
+    """Datos en hora local de una cita en conflicto, para los mensajes de error"""
+    start_local = localtime(appointment.date)
+    return {
+        'visitor_name': appointment.visitor_name,
+        'start': start_local,
+        'end': start_local + timedelta(minutes=appointment.duration),
+    }
+
+
+def find_batch_conflicts(items, lock=False):
+    """
+    Comprueba un lote de citas nuevas entre sí y contra las existentes.
+
+    `items` es una lista de (staff_id, inicio, duración, nombre) con inicio
+    aware. Lee las citas existentes de todos los staff y días con una sola
+    consulta de rango y recorre cada (staff, día) con un barrido ordenado por
+    inicio. Con `lock` bloquea esas citas, como find_appointment_conflict.
+    Devuelve {índice: describe_conflict} de las citas nuevas que solapan con
+    una existente o con otra del lote.
+    """
+    groups = {}
+    for index, (staff_id, start, duration, visitor_name) in enumerate(items):
+        start_local = localtime(start)
+        begin = to_minutes(start_local)
+        groups.setdefault((staff_id, start_local.date()), []).append(
+            (begin, begin + duration, index, visitor_name, start_local)
+        )
+    if not groups:
+        return {}
+
+    days = [day for _, day in groups]
+    existing = Appointment.objects.filter(
+        staff_id__in={staff_id for staff_id, _ in groups},
+        date__gte=local_day_start(min(days)),
+        date__lt=local_day_start(max(days) + timedelta(days=1))
+    )
+    if lock:
+        existing = existing.select_for_update()
+    for staff_id, apt_date, duration, visitor_name in existing.values_list('staff_id', 'date', 'duration', 'visitor_name'):
+        apt_local = localtime(apt_date)
+        key = (staff_id, apt_local.date())
+        if key in groups:
+            begin = to_minutes(apt_local)
+            groups[key].append((begin, begin + duration, None, visitor_name, apt_local))
+
+    conflicts = {}
+    for intervals in groups.values():
+        # A igual inicio, las existentes primero: la nueva es la que choca
+        intervals.sort(key=lambda interval: (interval[0], interval[2] is not None))
+        reach = None
+        for interval in intervals:
+            if reach is not None and interval[0] < reach[1]:
+                new, other = (interval, reach) if interval[2] is not None else (reach, interval)
+                if new[2] is not None:
+                    conflicts.setdefault(new[2], {
+                        'visitor_name': other[3],
+                        'start': other[4],
+                        'end': other[4] + timedelta(minutes=other[1] - other[0]),
+                    })
+            if reach is None or interval[1] > reach[1]:
+                reach = interval
+
+    return conflicts
+
+
+# ====================================
+# Slots de disponibilidad
+# ====================================
+
+def has_slot_conflict(staff, day, start_time, end_time, exclude_id=None):
+    """Comprueba en SQL si algún slot activo del staff se solapa con el horario"""
+    queryset = AvailabilitySlot.objects.filter(
+        staff_id=_staff_pk(staff),
+        date=day,
+        is_active=True,
+        start_time__lt=end_time,
+        end_time__gt=start_time
+    )
+    if exclude_id:
+        queryset = queryset.exclude(pk=exclude_id)
+    return queryset.exists() or _overlapping_rules(staff, start_time, end_time).filter(
+        year=day.year,
+        month=day.month,
+        weekday=day.weekday()
+    ).exists()
+
+
+def _overlapping_rules(staff, start_time, end_time):
+    return AvailabilityRule.objects.filter(
+        staff_id=_staff_pk(staff),
+        is_active=True,
+        start_time__lt=end_time,
+        end_time__gt=start_time
+    )
+
+
+def find_conflicting_dates(staff, dates, start_time, end_time):
+    """
+    Fechas de `dates` en las que el horario choca con slots o citas del staff.
+
+    Un número fijo de consultas, sea cual sea el número de fechas: primero
+    los bitmaps de ocupación de todo el rango y las reglas semanales; los
+    slots y las citas solo se leen para las fechas cuyo bitmap marca algo en
+    la ventana. Devuelve (fechas_con_slots, fechas_con_citas), ambas ordenadas.
+    """
+    dates = sorted(dates)
+    if not dates:
+        return [], []
+
+    window_start, window_end = to_minutes(start_time), to_minutes(end_time)
+    window = quarter_mask(window_start, window_end)
+    masks = occupancy_masks(staff, dates[0], dates[-1])
+    slot_candidates = [day for day in dates if masks.get(day, (0, 0))[1] & window]
+    booked_candidates = [day for day in dates if masks.get(day, (0, 0))[0] & window]
+
+    slot_dates = set()
+    if slot_candidates:
+        slot_dates.update(AvailabilitySlot.objects.filter(
+            staff_id=_staff_pk(staff),
+            date__in=slot_candidates,
+            is_active=True,
+            start_time__lt=end_time,
+            end_time__gt=start_time
+        ).values_list('date', flat=True))
+
+    rule_keys = set(_overlapping_rules(staff, start_time, end_time).filter(
+        _months_q(dates[0], dates[-1])
+    ).values_list('year', 'month', 'weekday'))
+    slot_dates.update(
+        day for day in dates if (day.year, day.month, day.weekday()) in rule_keys
+    )
+
+    appointment_dates = set()
+    if booked_candidates:
+        intervals = _appointment_intervals([_staff_pk(staff)], booked_candidates[0], booked_candidates[-1])
+        appointment_dates = {
+            day for day in booked_candidates
+            if any(start < window_end and end > window_start
+                   for start, end in intervals.get((_staff_pk(staff), day), []))
+        }
+
+    return sorted(slot_dates), sorted(appointment_dates)
+
+
+# ====================================
+# Generación de slots en lote
+# ====================================
+
+def _merge_intervals(intervals):
+    """Ordena y fusiona intervalos [inicio, fin) que se solapan"""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start < merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(interval) for interval in merged]
+
+
+def _appointment_intervals(staff_ids, start_date, end_date):
+    """
+    Intervalos exactos de las citas de varios staff entre dos fechas locales
+    (ambas incluidas), leídos con una sola consulta de rango.
+
+    Devuelve {(staff_id, fecha_local): [(inicio, fin), ...]} con los
+    intervalos en minutos desde medianoche, ordenados y fusionados.
+    """
+    appointments = Appointment.objects.filter(
+        staff_id__in=staff_ids,
+        date__gte=local_day_start(start_date),
+        date__lt=local_day_start(end_date + timedelta(days=1))
+    ).values_list('staff_id', 'date', 'duration')
+
+    by_key = {}
+    for staff_id, apt_date, duration in appointments:
+        apt_local = localtime(apt_date)
+        start = to_minutes(apt_local)
+        by_key.setdefault((staff_id, apt_local.date()), []).append((start, start + duration))
+
+    return {key: _merge_intervals(intervals) for key, intervals in by_key.items()}
+
+
+def busy_intervals_by_staff(staff_ids, start_date, end_date):
+    """
+    Intervalos ocupados de varios staff entre dos fechas locales (ambas incluidas).
+
+    Los bitmaps de ocupación indican qué días tienen citas en el horario de
+    atención; las citas solo se leen (con una consulta de rango) si hay
+    alguno. Los días sin citas entre 8:00 y 20:00 no aparecen en el resultado.
+    Devuelve {(staff_id, fecha_local): [(inicio, fin), ...]} como
+    _appointment_intervals.
+    """
+    busy_keys = set(OccupancyDay.objects.filter(
+        staff_id__in=staff_ids,
+        date__range=(start_date, end_date)
+    ).exclude(booked=0).values_list('staff_id', 'date'))
+    if not busy_keys:
+        return {}
+
+    busy_dates = [day for _, day in busy_keys]
+    intervals = _appointment_intervals(
+        {staff_id for staff_id, _ in busy_keys}, min(busy_dates), max(busy_dates)
+    )
+    return {key: value for key, value in intervals.items() if key in busy_keys}
+
+
+def busy_intervals_by_date(staff, start_date, end_date):
+    """Como busy_intervals_by_staff para un único staff: {fecha_local: intervalos}"""
+    return {
+        day: intervals
+        for (_, day), intervals in busy_intervals_by_staff([_staff_pk(staff)], start_date, end_date).items()
+    }
+
+
+def busy_intervals(staff, day):
+    return busy_intervals_by_date(staff, day, day).get(day, [])
+
+
+def free_slot_starts(start_time, end_time, duration, busy):
+    """
+    Inicios libres (en minutos) de slots de `duration` dentro de la ventana.
+
+    Recorre la ventana en pasos de 15 minutos en un único barrido lineal sobre
+    `busy`, que debe estar ordenado y fusionado (ver busy_intervals_by_date).
+    """
+    window_end = to_minutes(end_time)
+    # Redondear al próximo intervalo de 15 minutos si es necesario
+    current = -(-to_minutes(start_time) // SLOT_STEP_MINUTES) * SLOT_STEP_MINUTES
+
+    starts = []
+    index = 0
+    while current + duration <= window_end:
+        # Descartar los intervalos ocupados que ya terminaron
+        while index < len(busy) and busy[index][1] <= current:
+            index += 1
+        if index == len(busy) or busy[index][0] >= current + duration:
+            starts.append(current)
+        current += SLOT_STEP_MINUTES
+    return starts
+
+
+# ====================================
+# Índice de ocupación (bitmaps por staff y día)
+# ====================================
+
+def quarter_mask(start, end):
+    """
+    Bitmap de los cuartos de hora que toca [start, end) (en minutos), recortado
+    al horario de atención. Un intervalo que no empieza o acaba en un cuarto
+    exacto marca el cuarto entero.
+    """
+    first, last = max(start, OCCUPANCY_START), min(end, OCCUPANCY_END)
+    if first >= last:
+        return 0
+    low = (first - OCCUPANCY_START) // SLOT_STEP_MINUTES
+    high = -(-(last - OCCUPANCY_START) // SLOT_STEP_MINUTES)
+    return ((1 << (high - low)) - 1) << low
+
+
+def occupancy_masks(staff, start_date, end_date):
+    """{fecha: (booked, available)} del staff entre dos fechas (ambas incluidas)"""
+    return {
+        day: (booked, available)
+        for day, booked, available in OccupancyDay.objects.filter(
+            staff_id=_staff_pk(staff),
+            date__range=(start_date, end_date)
+        ).values_list('date', 'booked', 'available')
+    }
+
+
+def refresh_occupancy(staff, days):
+    """
+    Recalcula los bitmaps del staff para las fechas locales indicadas.
+
+    Se llama desde las señales de Appointment y AvailabilitySlot (y tras los
+    bulk_create de slots), dentro de la misma transacción que el cambio.
+    Lee las citas y slots de esas fechas con dos consultas y escribe todas
+    las filas con un único upsert.
+    """
+    staff_id = _staff_pk(staff)
+    days = sorted(set(days))
+    if not staff_id or not days:
+        return
+
+    booked = dict.fromkeys(days, 0)
+    available = dict.fromkeys(days, 0)
+
+    appointments = Appointment.objects.filter(
+        staff_id=staff_id,
+        date__gte=local_day_start(days[0]),
+        date__lt=local_day_start(days[-1] + timedelta(days=1))
+    ).values_list('date', 'duration')
+    for apt_date, duration in appointments:
+        apt_local = localtime(apt_date)
+        if apt_local.date() in booked:
+            start = to_minutes(apt_local)
+            booked[apt_local.date()] |= quarter_mask(start, start + duration)
+
+    slots = AvailabilitySlot.objects.filter(
+        staff_id=staff_id,
+        date__in=days,
+        is_active=True
+    ).values_list('date', 'start_time', 'end_time')
+    for day, start_time, end_time in slots:
+        available[day] |= quarter_mask(to_minutes(start_time), to_minutes(end_time))
+
+    OccupancyDay.objects.bulk_create(
+        [
+            OccupancyDay(staff_id=staff_id, date=day, booked=booked[day], available=available[day])
+            for day in days
+        ],
+        update_conflicts=True,
+        unique_fields=['staff', 'date'],
+        update_fields=['booked', 'available']
+    )
+
+
+# ====================================
+# Disponibilidad virtual (reglas semanales)
+# ====================================
+
+SLOT_REF_RE = re.compile(r'^r(?P<rule>\d+)-(?P<date>\d{8})-(?P<time>\d{4})$')
+
+
+class VirtualSlot:
+    """
+    Slot calculado a partir de una AvailabilityRule; no existe en la BD.
+
+    Expone los mismos atributos que AvailabilitySlot que usan las vistas y
+    plantillas de reserva. Su `id` es una referencia textual (ver SLOT_REF_RE).
+    """
+    is_active = True
+
+    def __init__(self, rule, date, start):
+        self.rule = rule
+        self.staff = rule.staff
+        self.date = date
+        self.start_time = from_minutes(start)
+        self.end_time = from_minutes(start + rule.duration)
+        self.duration = rule.duration
+
+    @property
+    def id(self):
+        return f"r{self.rule.id}-{self.date.strftime('%Y%m%d')}-{self.start_time.strftime('%H%M')}"
+
+
+def _months_q(start_date, end_date):
+    """Filtro (year, month) para todos los meses entre dos fechas"""
+    query = Q()
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        query |= Q(year=year, month=month)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return query
+
+
+def rules_for_range(start_date, end_date, stage_id=None):
+    """Reglas activas que pueden generar huecos entre las dos fechas"""
+    rules = AvailabilityRule.objects.filter(_months_q(start_date, end_date), is_active=True)
+    if stage_id is not None:
+        rules = rules.filter(stages=stage_id)
+    return rules.select_related('staff__user')
+
+
+def expand_rules(rules, start_date, end_date):
+    """
+    Genera los VirtualSlot libres de las reglas entre dos fechas (incluidas).
+
+    Las citas de todos los staff implicados se leen con una sola consulta y se
+    restan al vuelo con el mismo barrido que la generación de slots diarios.
+    """
+    rules = list(rules)
+    if not rules:
+        return
+
+    busy = busy_intervals_by_staff({rule.staff_id for rule in rules}, start_date, end_date)
+    for rule in rules:
+        for day in rule.dates():
+            if not start_date <= day <= end_date:
+                continue
+            day_busy = busy.get((rule.staff_id, day), [])
+            for start in free_slot_starts(rule.start_time, rule.end_time, rule.duration, day_busy):
+                yield VirtualSlot(rule, day, start)
+
+
+def stage_day_slots(stage_id, day):
+    """Huecos libres de la etapa en un día: slots guardados y de reglas, por hora de inicio"""
+    slots = list(AvailabilitySlot.objects.filter(
+        stages=stage_id,
+        date=day,
+        is_active=True,
+        start_time__gte=time(8, 0),
+        end_time__lte=time(20, 0)
+    ).select_related('staff', 'staff__user'))
+    slots.extend(expand_rules(rules_for_range(day, day, stage_id), day, day))
+    slots.sort(key=lambda slot: slot.start_time)
+    return slots
+
+
+def stage_calendar_summary(stage_id, start_date, end_date):
+    """
+    Resumen por fecha de los huecos libres de la etapa entre dos fechas:
+    {fecha: {'slots': n, 'first': hora, 'last': hora}}, con la primera y la
+    última hora de inicio.
+
+    Los slots guardados se agregan con una sola consulta GROUP BY; los huecos
+    de las reglas semanales se suman al recorrerlos.
+    """
+    summary = {
+        row['date']: {'slots': row['slots'], 'first': row['first'], 'last': row['last']}
+        for row in AvailabilitySlot.objects.filter(
+            stages=stage_id,
+            date__range=(start_date, end_date),
+            is_active=True,
+            start_time__gte=time(8, 0),
+            end_time__lte=time(20, 0)
+        ).order_by().values('date').annotate(
+            slots=Count('id'),
+            first=Min('start_time'),
+            last=Max('start_time')
+        )
+    }
+
+    for slot in expand_rules(rules_for_range(start_date, end_date, stage_id), start_date, end_date):
+        entry = summary.get(slot.date)
+        if entry is None:
+            summary[slot.date] = {'slots': 1, 'first': slot.start_time, 'last': slot.start_time}
+        else:
+            entry['slots'] += 1
+            entry['first'] = min(entry['first'], slot.start_time)
+            entry['last'] = max(entry['last'], slot.start_time)
+    return summary
+
+
+def get_rule_slot(stage_id, slot_ref):
+    """
+    Resuelve una referencia de VirtualSlot para una etapa.
+
+    Devuelve None si la referencia no corresponde a un hueco de una regla
+    activa de la etapa. No comprueba citas: eso se hace al reservar, con bloqueo.
+    """
+    match = SLOT_REF_RE.match(slot_ref or '')
+    if not match:
+        return None
+
+    try:
+        day = datetime.strptime(match['date'], '%Y%m%d').date()
+        start_time = datetime.strptime(match['time'], '%H%M').time()
+    except ValueError:
+        return None
+
+    rule = AvailabilityRule.objects.filter(
+        id=match['rule'],
+        stages=stage_id,
+        is_active=True
+    ).select_related('staff__user').first()
+    if rule is None or day < datetime.now().date() or day not in rule.dates():
+        return None
+
+    start = to_minutes(start_time)
+    if start not in free_slot_starts(rule.start_time, rule.end_time, rule.duration, []):
+        return None
+    return VirtualSlot(rule, day, start)
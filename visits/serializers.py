@@ -86,6 +86,19 @@ class AppointmentSerializer(serializers.ModelSerializer):
         return data
 
 
+class AppointmentBatchItemSerializer(AppointmentSerializer):
+    """
+    Validación de AppointmentSerializer para cada cita del alta masiva, sin
+    etapa, curso ni staff: la vista los resuelve con los objetos ya cargados
+    para no consultar la base de datos por cada cita.
+    """
+    class Meta(AppointmentSerializer.Meta):
+        fields = [
+            'visitor_name', 'visitor_email', 'visitor_phone', 'status', 'comments',
+            'date', 'duration', 'notes', 'follow_up_date'
+        ]
+
+
 class AvailabilitySlotSerializer(serializers.ModelSerializer):
     time = serializers.SerializerMethodField()
     available = serializers.SerializerMethodField()
@@ -115,6 +128,19 @@ class AvailabilitySlotSerializer(serializers.ModelSerializer):
         return f"{fecha} {hora}"
 
 
+class VirtualSlotSerializer(AvailabilitySlotSerializer):
+    """Mismo formato que AvailabilitySlotSerializer para slots de reglas semanales"""
+    id = serializers.CharField(read_only=True)
+
+
+def serialize_slots(slots):
+    """Serializa una lista mixta de AvailabilitySlot y VirtualSlot (ver scheduling.stage_day_slots)"""
+    return [
+        (AvailabilitySlotSerializer if isinstance(slot, AvailabilitySlot) else VirtualSlotSerializer)(slot).data
+        for slot in slots
+    ]
+
+
 class CalendarDaySerializer(serializers.Serializer):
     date = serializers.DateField()
     available = serializers.BooleanField(default=True)
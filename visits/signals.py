@@ -1,5 +1,16 @@
 from django.apps import AppConfig
-from django.db.models.signals import post_migrate
+from django.db.models.signals import post_migrate, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils.timezone import localtime
+from django.contrib.auth.models import User
+from .models import SchoolStage, Course, Appointment, AvailabilitySlot, AvailabilityRule, StaffProfile
+from .scheduling import refresh_occupancy
+from .calendar_cache import refresh_calendar_dates, invalidate_calendars
+from .live import publish_day_changes, publish_refresh
+from .rollups import rollup_key, appointment_changed
+from .dashboard_cache import invalidate_dashboards
+from .access import invalidate_staff_access
+from .calendar_sync import record_tombstones
 
 def cleanup_slots_on_startup(sender, **kwargs):
     from .models import AvailabilitySlot
@@ -12,4 +23,231 @@ class VisitsConfig(AppConfig):
     name = 'visits'
 
     def ready(self):
-        post_migrate.connect(cleanup_slots_on_startup, sender=self)
\ No newline at end of file
+        post_migrate.connect(cleanup_slots_on_startup, sender=self)
+
+# ====================================
+# Cambios de disponibilidad
+# ====================================
+# Índice de ocupación, calendario cacheado, versión de las etapas y stream en
+# vivo. Si una cita cambia de fecha o de staff se refrescan el día nuevo y el
+# que deja libre (con el staff anterior).
+
+def availability_changed(staff_id, days, stage_ids=None):
+    """
+    Actualiza todo lo que depende de la disponibilidad del staff en esas
+    fechas. Calendarios, versiones y stream son los de `stage_ids` si se
+    indican (las etapas de un slot); si no, los de las etapas del staff.
+    """
+    refresh_occupancy(staff_id, days)
+    refresh_calendar_dates(staff_id, days, stage_ids)
+    if stage_ids is None:
+        SchoolStage.bump_versions(staff_id=staff_id)
+    else:
+        SchoolStage.bump_versions(stage_ids=stage_ids)
+    publish_day_changes(staff_id, days, stage_ids)
+
+
+def _deleting_staff(origin):
+    """True si el borrado viene en cascada desde el staff (o su usuario)"""
+    return getattr(origin, 'model', type(origin)) in (StaffProfile, User)
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def refresh_appointment_occupancy(sender, instance, origin=None, **kwargs):
+    if _deleting_staff(origin):
+        return
+    # Guardado sin cambios de agenda (estado, notas, recordatorio): nada que refrescar
+    if kwargs['signal'] is post_save and not getattr(instance, '_scheduling_dirty', True):
+        return
+    days_by_staff = {instance.staff_id: {localtime(instance.date).date()}}
+
+    # Movida a otro día o a otro staff: el hueco que deja también cambia
+    loaded = getattr(instance, '_loaded_scheduling', None)
+    if kwargs['signal'] is post_save and loaded is not None:
+        old_date, _, old_staff_id = loaded[:3]
+        days_by_staff.setdefault(old_staff_id, set()).add(localtime(old_date).date())
+
+    for staff_id, days in days_by_staff.items():
+        availability_changed(staff_id, days)
+
+
+# ====================================
+# Resumen de citas del dashboard
+# ====================================
+# Cada cita cuenta en una fila de AppointmentRollup; al guardarla o borrarla se
+# resta de la fila anterior y se suma a la nueva. bulk_create y update() no
+# envían señales: Appointment.create_batch y bulk_set_status lo hacen ellos.
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def update_appointment_rollups(sender, instance, origin=None, created=False, **kwargs):
+    if _deleting_staff(origin):
+        # Las filas del staff se borran en cascada con él
+        return
+    
+    state = instance._rollup_state()
+    if kwargs['signal'] is post_delete:
+        appointment_changed(rollup_key(*state) if state else None, None)
+        return
+    
+    # Estado anterior: el cargado de la BD, o el que leyó save() antes de guardar
+    # (None si la fila no existía)
+    loaded = None if created else getattr(instance, '_loaded_rollup', None)
+    if state is None:
+        # Campos diferidos: se lee lo que quedó guardado
+        state = Appointment.objects.filter(pk=instance.pk).values_list(*Appointment.ROLLUP_FIELDS).first()
+    appointment_changed(rollup_key(*loaded) if loaded else None, rollup_key(*state))
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def invalidate_appointment_dashboards(sender, instance, origin=None, **kwargs):
+    # Cualquier campo puede salir en el calendario del dashboard; si cambió el
+    # staff, también se invalida el anterior
+    if not _deleting_staff(origin):
+        loaded = getattr(instance, '_loaded_rollup', None)
+        invalidate_dashboards([instance.staff_id, loaded[0] if loaded else None])
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def record_appointment_tombstone(sender, instance, **kwargs):
+    # Rastro para la sincronización del calendario: también en los borrados en
+    # cascada del staff, que la vista global sigue mostrando
+    if kwargs['signal'] is post_delete:
+        record_tombstones([(instance.pk, instance.staff_id, instance.date)])
+        return
+    loaded = getattr(instance, '_loaded_scheduling', None)
+    if loaded is None:
+        return
+    date, _, staff_id = loaded[:3]
+    if (date, staff_id) != (instance.date, instance.staff_id):
+        # Movida: desaparece de donde estaba (y updated_at la trae a donde está)
+        record_tombstones([(instance.pk, staff_id, date)])
+
+
+@receiver(pre_delete, sender=AvailabilitySlot)
+def remember_slot_stages(sender, instance, origin=None, **kwargs):
+    # Las filas de etapas se borran antes que el slot: en post_delete ya no están
+    if instance.date and not _deleting_staff(origin):
+        instance._stage_ids = list(instance.stages.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=AvailabilitySlot)
+@receiver(post_delete, sender=AvailabilitySlot)
+def refresh_slot_occupancy(sender, instance, origin=None, **kwargs):
+    # Calendarios y versiones de las etapas del propio slot, no las del staff:
+    # pueden ser otras (slots fusionados en la migración 0006, etapas retiradas)
+    if instance.date and not _deleting_staff(origin):
+        stage_ids = getattr(instance, '_stage_ids', None)
+        if stage_ids is None:
+            stage_ids = list(instance.stages.values_list('id', flat=True))
+        availability_changed(instance.staff_id, [instance.date], stage_ids)
+
+
+@receiver(m2m_changed, sender=AvailabilitySlot.stages.through)
+def refresh_slot_stages(sender, instance, action, reverse, pk_set, **kwargs):
+    # Etapas añadidas o quitadas de un slot (admin, edición en el CRUD)
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        slots = [instance]
+        stage_ids = pk_set if pk_set is not None else instance.stages.values_list('id', flat=True)
+    else:
+        # Cambio hecho desde la etapa (stage.availability_slots)
+        slots = AvailabilitySlot.objects.filter(id__in=pk_set) if pk_set is not None else instance.availability_slots.all()
+        stage_ids = [instance.pk]
+
+    stage_ids = list(stage_ids)
+    days_by_staff = {}
+    for slot in slots:
+        if slot.date:
+            days_by_staff.setdefault(slot.staff_id, set()).add(slot.date)
+    for staff_id, days in days_by_staff.items():
+        availability_changed(staff_id, days, stage_ids)
+
+
+@receiver(post_save, sender=AvailabilityRule)
+@receiver(post_delete, sender=AvailabilityRule)
+def invalidate_rule_calendars(sender, instance, origin=None, **kwargs):
+    # Una regla afecta a todo un mes: se descartan los calendarios enteros
+    if not _deleting_staff(origin):
+        invalidate_calendars(instance.staff_id)
+        SchoolStage.bump_versions(staff_id=instance.staff_id)
+        publish_refresh(instance.staff_id)
+
+
+@receiver(post_save, sender=Course)
+@receiver(post_delete, sender=Course)
+def bump_course_stage_version(sender, instance, **kwargs):
+    SchoolStage.bump_versions(stage_ids=[instance.stage_id])
+
+
+@receiver(m2m_changed, sender=StaffProfile.allowed_stages.through)
+def bump_staff_stage_versions(sender, instance, action, reverse, pk_set, **kwargs):
+    # Cambia la lista de staff de las etapas afectadas (staff_by_stage)
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # Cambio hecho desde la etapa (stage.staffprofile_set)
+        SchoolStage.bump_versions(stage_ids=[instance.pk])
+    elif action == 'pre_clear':
+        SchoolStage.bump_versions(staff_id=instance.pk)
+    else:
+        SchoolStage.bump_versions(stage_ids=pk_set)
+
+
+@receiver(post_save, sender=StaffProfile)
+@receiver(pre_delete, sender=StaffProfile)
+def bump_profile_stage_versions(sender, instance, created=False, **kwargs):
+    # Al borrar el perfil sus etapas se pierden sin m2m_changed: antes del borrado
+    if not created:
+        SchoolStage.bump_versions(staff_id=instance.pk)
+
+
+# Campos del usuario que se ven en staff_by_stage
+STAFF_LIST_FIELDS = {'first_name', 'last_name', 'is_active'}
+
+@receiver(post_save, sender=User)
+def bump_user_stage_versions(sender, instance, created, update_fields=None, **kwargs):
+    # El login solo guarda last_login: no cambia la lista
+    if created or (update_fields is not None and not STAFF_LIST_FIELDS & set(update_fields)):
+        return
+    SchoolStage.bump_versions(user_id=instance.pk)
+
+
+# ====================================
+# Rol y perfil en la sesión
+# ====================================
+# request.staff_access se guarda en la sesión (ver access.py): cualquier cambio
+# de grupos, perfil o etapas hace que se vuelva a resolver para ese usuario.
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_group_access(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        invalidate_staff_access([instance.pk])
+    elif pk_set is not None:
+        # Cambio hecho desde el grupo (group.user_set)
+        invalidate_staff_access(pk_set)
+    else:
+        invalidate_staff_access(instance.user_set.values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=StaffProfile.allowed_stages.through)
+def invalidate_stage_access(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        invalidate_staff_access([instance.user_id])
+    else:
+        staff = StaffProfile.objects.filter(id__in=pk_set) if pk_set is not None else instance.staffprofile_set.all()
+        invalidate_staff_access(staff.values_list('user_id', flat=True))
+
+
+@receiver(post_save, sender=StaffProfile)
+@receiver(post_delete, sender=StaffProfile)
+def invalidate_profile_access(sender, instance, **kwargs):
+    invalidate_staff_access([instance.user_id])
@@ -753,7 +753,14 @@ function confirmDelete(id) {
                 if (typeof window.updateUpcomingAppointments === 'function') {
                     // Recargar estadísticas del dashboard
                     if (window.location.pathname.includes('/dashboard/')) {
-                        fetch('/dashboard/stats/')
+                        // Mismo ámbito (propio, staff o global) que el selector de vista
+                        const viewSelector = document.getElementById('viewSelector');
+                        const params = new URLSearchParams();
+                        if (viewSelector && viewSelector.value) {
+                            params.append('staff_id', viewSelector.value);
+                        }
+                        
+                        fetch(`/dashboard/stats/?${params.toString()}`)
                             .then(response => response.json())
                             .then(data => {
                                 // Actualizar contadores
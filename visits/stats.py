@@ -0,0 +1,86 @@
+# visits/stats.py
+# ====================================
+# Estadísticas del dashboard
+# ====================================
+#
+# Contadores, distribución por etapa y horas más populares de un conjunto de
+# citas (las del staff, las de otro staff o todas en la vista global). Lo usa
+# DashboardStatsView, al que llaman dashboard.html y appointments_crud.js.
+# Se leen de AppointmentRollup (ver rollups.py), no de las citas: los
+# contadores salen de una agregación y las distribuciones de un GROUP BY por
+# etapa y hora sobre filas ya resumidas.
+
+from django.db.models import Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+POPULAR_HOURS_LIMIT = 10
+
+
+def _count(filter=None):
+    return Coalesce(Sum('count', filter=filter), 0)
+
+
+def appointment_counts(rollups, today):
+    """Total, citas de hoy, realizadas y pendientes desde hoy en una consulta"""
+    return rollups.order_by().aggregate(
+        total_count=_count(),
+        today_count=_count(Q(date=today)),
+        confirmed_count=_count(Q(status='completed')),
+        pending_count=_count(Q(status='pending', date__gte=today)),
+    )
+
+
+def stage_and_hour_distribution(rollups, stages, today):
+    """
+    Citas por etapa (todas) y por hora local (desde hoy) con un solo GROUP BY.
+
+    `stages` son las etapas a mostrar, en orden; las que no tienen citas no
+    aparecen. Las horas se ordenan de más a menos citas.
+    """
+    rows = (
+        rollups
+        .order_by()
+        .values('stage_id', 'hour')
+        .annotate(
+            total=_count(),
+            upcoming=_count(Q(date__gte=today))
+        )
+    )
+
+    by_stage = {}
+    by_hour = {}
+    for row in rows:
+        by_stage[row['stage_id']] = by_stage.get(row['stage_id'], 0) + row['total']
+        if row['upcoming']:
+            by_hour[row['hour']] = by_hour.get(row['hour'], 0) + row['upcoming']
+
+    stages_distribution = [
+        {'stage': stage.name, 'count': by_stage[stage.id]}
+        for stage in stages
+        if by_stage.get(stage.id)
+    ]
+    popular_hours = [
+        {'hour': f"{hour:02d}:00", 'count': count}
+        for hour, count in sorted(by_hour.items(), key=lambda item: (-item[1], item[0]))[:POPULAR_HOURS_LIMIT]
+    ]
+    return stages_distribution, popular_hours
+
+
+def dashboard_stats(rollups, stages, now=None):
+    """
+    Estadísticas completas del dashboard para las filas de AppointmentRollup
+    de `rollups` (filtradas por staff, o todas en la vista global).
+
+    Devuelve los contadores (today_count, confirmed_count, pending_count,
+    stages_count, total_count), stages_distribution y popular_hours.
+    """
+    today = timezone.localtime(now or timezone.now()).date()
+    stages = list(stages)
+
+    stats = appointment_counts(rollups, today)
+    stats['stages_count'] = len(stages)
+    stats['stages_distribution'], stats['popular_hours'] = stage_and_hour_distribution(
+        rollups, stages, today
+    )
+    return stats
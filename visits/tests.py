@@ -1,3 +1,859 @@
 from django.test import TestCase
+from django.contrib.auth.models import User, Group
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.timezone import make_aware, localtime
+from datetime import datetime, timedelta, time
+from unittest import mock
+import hashlib
+import json
+import threading
 
-# Create your tests here.
+from .models import SchoolStage, StaffProfile, Appointment, AvailabilitySlot, AvailabilityRule, OccupancyDay, AppointmentRollup, IdempotencyKey, AppointmentTombstone, EmailOutbox
+from .rollups import rebuild_rollups
+from .scheduling import find_appointment_conflict, quarter_mask, free_slot_starts, busy_intervals, stage_day_slots
+from .checks import check_shared_cache
+from .signals import availability_changed
+from .calendar_cache import get_stage_calendar, refresh_calendar_dates
+from .emails import (
+    MailDispatcher, queue_email, process_email_outbox, drain_outbox_in_background, _drain_lock,
+    RateLimiter, ParallelMailDispatcher, build_message, mark_reminders_sent, send_daily_reminders,
+    OUTBOX_BATCH_SIZE, OUTBOX_MAX_ATTEMPTS, OUTBOX_LOCK_TIMEOUT
+)
+from .idempotency import IDEMPOTENCY_TTL, IDEMPOTENCY_LOCK_TIMEOUT
+from .calendar_sync import make_sync_token, TOMBSTONE_TTL
+from .dashboard_cache import _generation_key, GLOBAL_SCOPE
+
+
+def create_staff(username, stages=(), supervisor=False):
+    user = User.objects.create_user(username=username, password='secret', first_name=username.title(), email=f'{username}@example.com')
+    staff = StaffProfile.objects.create(user=user)
+    staff.allowed_stages.add(*stages)
+    if supervisor:
+        Group.objects.get_or_create(name='Supervisor')[0].user_set.add(user)
+    return staff
+
+
+def create_appointment(staff, stage, day, hour, minute=0, duration=60, **kwargs):
+    return Appointment.objects.create(
+        staff=staff,
+        stage=stage,
+        visitor_name=kwargs.pop('visitor_name', 'Familia Pérez'),
+        visitor_email='familia@example.com',
+        visitor_phone='600000000',
+        date=make_aware(datetime.combine(day, time(hour, minute))),
+        duration=duration,
+        **kwargs
+    )
+
+
+def appointment_item(stage, day, hour):
+    """Cita en el formato JSON de la API"""
+    return {
+        'visitor_name': 'Familia García',
+        'visitor_email': 'garcia@example.com',
+        'visitor_phone': '600000001',
+        'stage': stage.id,
+        'date': datetime.combine(day, time(hour)).isoformat(),
+        'duration': 30,
+    }
+
+
+class VisitsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.stage = SchoolStage.objects.create(name='Primaria', description='')
+        self.staff = create_staff('ana', [self.stage])
+        self.day = timezone.localdate() + timedelta(days=7)
+
+
+# ====================================
+# Cambio de estado masivo
+# ====================================
+
+class BulkStatusTests(VisitsTestCase):
+    url = '/api/appointments/bulk-status/'
+
+    def setUp(self):
+        super().setUp()
+        self.supervisor = create_staff('sonia', [self.stage], supervisor=True)
+        self.first = create_appointment(self.staff, self.stage, self.day, 9)
+        self.second = create_appointment(self.supervisor, self.stage, self.day + timedelta(days=1), 9)
+        self.client.login(username='sonia', password='secret')
+
+    def post(self, data):
+        return self.client.post(self.url, json.dumps(data), content_type='application/json')
+
+    def assert_untouched(self):
+        self.assertFalse(Appointment.objects.exclude(status='pending').exists())
+
+    def test_rejects_filters_without_a_recognised_value(self):
+        for filters in ({'foo': 1}, {'status': ''}, {'date': None, 'stage': ''}, {}, ['date']):
+            with self.subTest(filters=filters):
+                response = self.post({'status': 'completed', 'filters': filters})
+                self.assertEqual(response.status_code, 400)
+        self.assert_untouched()
+
+    def test_rejects_malformed_filter_values(self):
+        for filters in ({'date': '16/10/2026'}, {'status': 'bogus'}, {'stage': 'x'}, {'staff_id': 'all'}):
+            with self.subTest(filters=filters):
+                response = self.post({'status': 'completed', 'filters': filters})
+                self.assertEqual(response.status_code, 400)
+        self.assert_untouched()
+
+    def test_staff_id_alone_is_not_a_filter_for_staff(self):
+        self.client.login(username='ana', password='secret')
+        response = self.post({'status': 'completed', 'filters': {'staff_id': self.supervisor.id}})
+        self.assertEqual(response.status_code, 400)
+        self.assert_untouched()
+
+    def test_filters_by_date(self):
+        response = self.post({'status': 'completed', 'filters': {'date': self.day.isoformat()}})
+        self.assertEqual(response.json(), {'status': 'success', 'updated': 1})
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.assertEqual((self.first.status, self.second.status), ('completed', 'pending'))
+
+
+# ====================================
+# Alta masiva de citas
+# ====================================
+
+class BulkAppointmentTests(VisitsTestCase):
+    url = '/api/appointments/bulk/'
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='ana', password='secret')
+
+    def item(self, hour, **kwargs):
+        return {**appointment_item(self.stage, self.day, hour), **kwargs}
+
+    def post(self, items):
+        return self.client.post(self.url, json.dumps({'appointments': items}), content_type='application/json')
+
+    def test_creates_every_appointment(self):
+        response = self.post([self.item(9), self.item(10)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['created'], 2)
+        self.assertEqual(Appointment.objects.filter(staff=self.staff).count(), 2)
+
+    def test_conflicts_reject_the_whole_batch(self):
+        create_appointment(self.staff, self.stage, self.day, 9)
+        response = self.post([self.item(10), self.item(9, visitor_name='Familia Ruiz')])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['index'] for error in response.json()['errors']], [1])
+        self.assertEqual(Appointment.objects.count(), 1)
+
+    def test_items_go_through_the_serializer_validation(self):
+        response = self.post([self.item(9), self.item(10, visitor_name='x' * 201)])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('visitor_name', response.json()['errors'][0]['error'])
+        self.assertFalse(Appointment.objects.exists())
+
+    def test_malformed_items_are_a_bad_request(self):
+        supervisor = create_staff('sonia', [self.stage], supervisor=True)
+        self.client.login(username='sonia', password='secret')
+        for malformed in (
+            {'staff': [supervisor.id]},
+            {'staff': {'id': supervisor.id}},
+            {'stage': [self.stage.id]},
+            {'status': ['pending']},
+            {'duration': [30]},
+            {'visitor_phone': ['600000001']},
+            {'course': '²'},
+        ):
+            with self.subTest(malformed=malformed):
+                response = self.post([self.item(9, **malformed)])
+                self.assertEqual(response.status_code, 400)
+        self.assertFalse(Appointment.objects.exists())
+
+    def test_covered_slots_are_deleted_with_one_refresh_per_staff(self):
+        AvailabilitySlot.create_with_stages([
+            AvailabilitySlot(staff=self.staff, date=self.day, start_time=start, end_time=end, duration=15)
+            for start, end in ((time(9), time(9, 15)), (time(9, 15), time(9, 30)), (time(9, 30), time(9, 45)),
+                               (time(9, 45), time(10)), (time(11), time(11, 15)))
+        ], [self.stage])
+
+        with mock.patch('visits.signals.availability_changed') as availability_changed:
+            response = self.post([self.item(9), self.item(9, date=datetime.combine(self.day, time(9, 30)).isoformat())])
+        self.assertEqual(response.status_code, 200)
+        availability_changed.assert_called_once_with(self.staff.id, {self.day})
+        self.assertEqual(list(AvailabilitySlot.objects.values_list('start_time', flat=True)), [time(11)])
+        self.assertEqual(AvailabilitySlot.stages.through.objects.count(), 1)
+
+
+class BulkIdempotencyTests(VisitsTestCase):
+    url = BulkAppointmentTests.url
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='ana', password='secret')
+
+    def item(self, hour):
+        return appointment_item(self.stage, self.day, hour)
+
+    def post_with_key(self, body):
+        return self.client.post(self.url, body, content_type='application/json', HTTP_IDEMPOTENCY_KEY='alta-1')
+
+    def in_progress(self, body, age):
+        record = IdempotencyKey.objects.create(
+            scope=f'{self.url}:{self.staff.user.pk}',
+            key='alta-1',
+            request_hash=hashlib.sha256(body.encode()).hexdigest(),
+            expires_at=timezone.now() + IDEMPOTENCY_TTL
+        )
+        IdempotencyKey.objects.filter(pk=record.pk).update(created_at=timezone.now() - age)
+
+    def test_repeated_request_is_replayed(self):
+        body = json.dumps({'appointments': [self.item(9)]})
+        first = self.post_with_key(body)
+        second = self.post_with_key(body)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(Appointment.objects.count(), 1)
+
+    def test_request_in_progress_is_a_conflict(self):
+        body = json.dumps({'appointments': [self.item(9)]})
+        self.in_progress(body, timedelta(seconds=5))
+        self.assertEqual(self.post_with_key(body).status_code, 409)
+        self.assertFalse(Appointment.objects.exists())
+
+    def test_abandoned_request_is_reclaimed(self):
+        body = json.dumps({'appointments': [self.item(9)]})
+        self.in_progress(body, IDEMPOTENCY_LOCK_TIMEOUT + timedelta(seconds=1))
+        self.assertEqual(self.post_with_key(body).status_code, 200)
+        self.assertEqual(Appointment.objects.count(), 1)
+        self.assertEqual(IdempotencyKey.objects.get().status_code, 200)
+
+
+# ====================================
+# Motor de solapamientos e índice de ocupación
+# ====================================
+
+class ConflictEngineTests(VisitsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = create_staff('bea', [self.stage])
+
+    def interval(self, start, end, day=None):
+        day = day or self.day
+        return make_aware(datetime.combine(day, start)), make_aware(datetime.combine(day, end))
+
+    def conflicts(self, start, end, staff=None, day=None):
+        # Con el atajo del bitmap y consultando siempre la tabla: misma respuesta
+        staff = staff or self.staff
+        results = {
+            find_appointment_conflict(staff, *self.interval(start, end, day), lock=lock) is not None
+            for lock in (False, True)
+        }
+        self.assertEqual(len(results), 1, f'El bitmap y la tabla discrepan en {start}-{end}')
+        return results.pop()
+
+    def booked(self, staff, day):
+        return OccupancyDay.objects.filter(staff=staff, date=day).values_list('booked', flat=True).first() or 0
+
+    def test_quarter_mask(self):
+        self.assertEqual(quarter_mask(8 * 60, 8 * 60 + 15), 0b1)
+        self.assertEqual(quarter_mask(9 * 60, 10 * 60), 0b1111 << 4)
+        self.assertEqual(quarter_mask(9 * 60 + 10, 9 * 60 + 25), 0b11 << 4)
+        self.assertEqual(quarter_mask(7 * 60, 8 * 60 + 30), 0b11)
+        self.assertEqual(quarter_mask(19 * 60 + 45, 21 * 60), 1 << 47)
+        self.assertEqual(quarter_mask(20 * 60, 21 * 60), 0)
+
+    def test_adjacent_intervals_do_not_conflict(self):
+        create_appointment(self.staff, self.stage, self.day, 9)
+        self.assertFalse(self.conflicts(time(10), time(10, 30)))
+        self.assertFalse(self.conflicts(time(8, 30), time(9)))
+        self.assertFalse(self.conflicts(time(9), time(10), staff=self.other))
+
+    def test_overlapping_intervals_conflict(self):
+        create_appointment(self.staff, self.stage, self.day, 9)
+        for start, end in ((time(9, 45), time(10, 15)), (time(8, 45), time(9, 15)), (time(9, 15), time(9, 30)), (time(8), time(11))):
+            with self.subTest(start=start, end=end):
+                self.assertTrue(self.conflicts(start, end))
+
+    def test_appointment_crossing_a_quarter_boundary(self):
+        # 9:10-9:25 marca los cuartos de 9:00 y 9:15; la respuesta exacta sale de la tabla
+        create_appointment(self.staff, self.stage, self.day, 9, minute=10, duration=15)
+        self.assertEqual(self.booked(self.staff, self.day), 0b11 << 4)
+        self.assertFalse(self.conflicts(time(9), time(9, 10)))
+        self.assertFalse(self.conflicts(time(9, 25), time(9, 40)))
+        self.assertTrue(self.conflicts(time(9, 20), time(9, 30)))
+        self.assertTrue(self.conflicts(time(9, 5), time(9, 15)))
+        self.assertEqual(free_slot_starts(time(9), time(10), 15, busy_intervals(self.staff, self.day)), [9 * 60 + 30, 9 * 60 + 45])
+
+    def test_moving_refreshes_both_bitmaps(self):
+        appointment = create_appointment(self.staff, self.stage, self.day, 9)
+        next_day = self.day + timedelta(days=1)
+
+        appointment = Appointment.objects.get(pk=appointment.pk)
+        appointment.date = make_aware(datetime.combine(next_day, time(11)))
+        appointment.save()
+        self.assertEqual(self.booked(self.staff, self.day), 0)
+        self.assertEqual(self.booked(self.staff, next_day), 0b1111 << 12)
+        self.assertFalse(self.conflicts(time(9), time(10)))
+        self.assertTrue(self.conflicts(time(11), time(12), day=next_day))
+
+        appointment.staff = self.other
+        appointment.save()
+        self.assertEqual(self.booked(self.staff, next_day), 0)
+        self.assertEqual(self.booked(self.other, next_day), 0b1111 << 12)
+        self.assertFalse(self.conflicts(time(11), time(12), day=next_day))
+        self.assertTrue(self.conflicts(time(11), time(12), staff=self.other, day=next_day))
+
+
+class RuleSlotBookingTests(VisitsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.rule = AvailabilityRule.objects.create(
+            staff=self.staff,
+            year=self.day.year,
+            month=self.day.month,
+            weekday=self.day.weekday(),
+            start_time=time(9),
+            end_time=time(11),
+            duration=30
+        )
+        self.rule.stages.add(self.stage)
+        self.url = f'/stage/{self.stage.id}/book/r{self.rule.id}-{self.day:%Y%m%d}-0930/'
+
+    def book(self, name):
+        return self.client.post(self.url, {
+            'visitor_name': name,
+            'visitor_email': 'familia@example.com',
+            'visitor_phone': '600000000',
+        })
+
+    def test_virtual_slot_can_only_be_booked_once(self):
+        response = self.book('Familia Pérez')
+        self.assertEqual(response.status_code, 200)
+        appointment = Appointment.objects.get()
+        self.assertEqual((appointment.staff, localtime(appointment.date).time(), appointment.duration), (self.staff, time(9, 30), 30))
+
+        response = self.book('Familia Ruiz')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Appointment.objects.count(), 1)
+
+        # Los huecos de la regla ya no ofrecen el reservado
+        starts = [slot.start_time for slot in stage_day_slots(self.stage.id, self.day)]
+        self.assertEqual(starts, [time(9), time(10), time(10, 15), time(10, 30)])
+
+    def test_unknown_references_are_not_found(self):
+        for ref in (f'r{self.rule.id}-{self.day:%Y%m%d}-0940', f'r{self.rule.id}-{self.day + timedelta(days=1):%Y%m%d}-0930', 'r999-20261231-0900'):
+            with self.subTest(ref=ref):
+                self.assertEqual(self.client.get(f'/stage/{self.stage.id}/book/{ref}/').status_code, 404)
+
+
+# ====================================
+# Citas movidas: se refresca también el día que dejan
+# ====================================
+
+class MovedAppointmentTests(VisitsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = create_staff('bea', [self.stage])
+        self.appointment = create_appointment(self.staff, self.stage, self.day, 9)
+
+    def booked(self, staff, day):
+        row = OccupancyDay.objects.filter(staff=staff, date=day).first()
+        return row.booked if row else 0
+
+    def test_moving_to_another_day_frees_the_old_day(self):
+        self.assertNotEqual(self.booked(self.staff, self.day), 0)
+        version = SchoolStage.objects.get(pk=self.stage.pk).version
+
+        appointment = Appointment.objects.get(pk=self.appointment.pk)
+        appointment.date += timedelta(days=1)
+        appointment.save()
+
+        self.assertEqual(self.booked(self.staff, self.day), 0)
+        self.assertNotEqual(self.booked(self.staff, self.day + timedelta(days=1)), 0)
+        self.assertGreater(SchoolStage.objects.get(pk=self.stage.pk).version, version)
+
+    def test_moving_to_another_staff_frees_the_old_staff(self):
+        appointment = Appointment.objects.get(pk=self.appointment.pk)
+        appointment.staff = self.other
+        appointment.save()
+
+        self.assertEqual(self.booked(self.staff, self.day), 0)
+        self.assertNotEqual(self.booked(self.other, self.day), 0)
+
+
+# ====================================
+# ETag de los endpoints públicos de una etapa
+# ====================================
+
+class StageETagTests(VisitsTestCase):
+    def get_staff(self, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(f'/api/stage/{self.stage.id}/staff/', **headers)
+
+    def assert_refreshed(self, change):
+        etag = self.get_staff()['ETag']
+        self.assertEqual(self.get_staff(etag).status_code, 304)
+        change()
+        response = self.get_staff(etag)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_renaming_the_staff_changes_the_etag(self):
+        def rename():
+            self.staff.user.first_name = 'Anabel'
+            self.staff.user.save()
+        self.assertEqual(self.assert_refreshed(rename), [{'id': self.staff.id, 'name': 'Anabel'}])
+
+    def test_deactivating_the_staff_changes_the_etag(self):
+        def deactivate():
+            self.staff.user.is_active = False
+            self.staff.user.save(update_fields=['is_active'])
+        self.assert_refreshed(deactivate)
+
+    def test_deleting_the_profile_changes_the_etag(self):
+        self.assertEqual(self.assert_refreshed(self.staff.delete), [])
+
+    def test_login_keeps_the_etag(self):
+        etag = self.get_staff()['ETag']
+        self.client.login(username='ana', password='secret')
+        self.assertEqual(self.get_staff(etag).status_code, 304)
+
+
+# ====================================
+# Slots cubiertos por una cita
+# ====================================
+
+class CoveredSlotTests(VisitsTestCase):
+    def setUp(self):
+        super().setUp()
+        quarters = [time(9), time(9, 15), time(9, 30), time(9, 45), time(10)]
+        AvailabilitySlot.create_with_stages([
+            AvailabilitySlot(staff=self.staff, date=self.day, start_time=start, end_time=end, duration=15)
+            for start, end in zip(quarters, quarters[1:])
+        ], [self.stage])
+        self.client.login(username='ana', password='secret')
+
+    def test_one_refresh_for_all_covered_slots(self):
+        with mock.patch('visits.signals.availability_changed', wraps=availability_changed) as refresh:
+            item = appointment_item(self.stage, self.day, 9) | {'duration': 60}
+            response = self.client.post('/api/appointments/', json.dumps(item), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(AvailabilitySlot.objects.exists())
+        # La cita y el borrado de sus slots; no una vez por slot
+        self.assertEqual(refresh.call_count, 2)
+        self.assertEqual(OccupancyDay.objects.get(staff=self.staff, date=self.day).available, 0)
+
+    def test_delete_batch_refreshes_occupancy(self):
+        AvailabilitySlot.delete_batch(AvailabilitySlot.objects.all())
+        self.assertFalse(AvailabilitySlot.stages.through.objects.exists())
+        self.assertEqual(OccupancyDay.objects.get(staff=self.staff, date=self.day).available, 0)
+
+
+# ====================================
+# Calendario cacheado de cada etapa
+# ====================================
+
+class StageCalendarCacheTests(VisitsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.secondary = SchoolStage.objects.create(name='Secundaria', description='')
+        self.staff.allowed_stages.add(self.secondary)
+        self.slot, = AvailabilitySlot.create_with_stages([
+            AvailabilitySlot(staff=self.staff, date=self.day, start_time=time(9), end_time=time(10), duration=60)
+        ], [self.stage])
+
+    def cached_days(self, stage):
+        return cache.get(f'visits:stage_calendar:{stage.id}')['days']
+
+    def version(self, stage):
+        return SchoolStage.objects.get(pk=stage.pk).version
+
+    def test_changing_slot_stages_refreshes_their_calendars(self):
+        get_stage_calendar(self.secondary.id)
+        self.assertNotIn(self.day, self.cached_days(self.secondary))
+        version = self.version(self.secondary)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.slot.stages.add(self.secondary)
+        self.assertEqual(self.cached_days(self.secondary)[self.day]['slots'], 1)
+        self.assertGreater(self.version(self.secondary), version)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.slot.stages.clear()
+        self.assertNotIn(self.day, self.cached_days(self.secondary))
+
+    def test_slot_changes_refresh_the_slot_stages(self):
+        # Etapa que el staff ya no atiende, pero que el slot sigue ofreciendo
+        self.staff.allowed_stages.remove(self.secondary)
+        get_stage_calendar(self.secondary.id)
+        version = self.version(self.secondary)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            slot, = AvailabilitySlot.create_with_stages([
+                AvailabilitySlot(staff=self.staff, date=self.day, start_time=time(11), end_time=time(12), duration=60)
+            ], [self.secondary])
+        self.assertEqual(self.cached_days(self.secondary)[self.day]['slots'], 1)
+        self.assertGreater(self.version(self.secondary), version)
+
+        version = self.version(self.secondary)
+        with self.captureOnCommitCallbacks(execute=True):
+            slot.delete()
+        self.assertNotIn(self.day, self.cached_days(self.secondary))
+        self.assertGreater(self.version(self.secondary), version)
+
+    def test_busy_lock_discards_the_calendar(self):
+        get_stage_calendar(self.stage.id)
+        cache.add(f'visits:stage_calendar:lock:{self.stage.id}', 1)
+        with mock.patch('visits.calendar_cache.CALENDAR_LOCK_WAIT', 0), self.captureOnCommitCallbacks(execute=True):
+            refresh_calendar_dates(self.staff.id, [self.day])
+        self.assertIsNone(cache.get(f'visits:stage_calendar:{self.stage.id}'))
+
+    def test_patch_releases_the_lock(self):
+        get_stage_calendar(self.stage.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            AvailabilitySlot.delete_batch(AvailabilitySlot.objects.all())
+        self.assertNotIn(self.day, self.cached_days(self.stage))
+        self.assertIsNone(cache.get(f'visits:stage_calendar:lock:{self.stage.id}'))
+
+
+# ====================================
+# Resumen de citas del dashboard
+# ====================================
+
+class AppointmentRollupTests(VisitsTestCase):
+    def rollups(self):
+        return sorted(
+            AppointmentRollup.objects.filter(count__gt=0).values_list('staff_id', 'stage_id', 'date', 'hour', 'status', 'count')
+        )
+
+    def assert_matches_rebuild(self):
+        incremental = self.rollups()
+        rebuild_rollups()
+        self.assertEqual(incremental, self.rollups())
+        return incremental
+
+    def test_deltas_follow_every_change(self):
+        appointment = create_appointment(self.staff, self.stage, self.day, 9)
+        self.assertEqual(self.assert_matches_rebuild(), [(self.staff.id, self.stage.id, self.day, 9, 'pending', 1)])
+
+        appointment = Appointment.objects.get(pk=appointment.pk)
+        appointment.status = 'completed'
+        appointment.save()
+        appointment.date = make_aware(datetime.combine(self.day + timedelta(days=1), time(11)))
+        appointment.save()
+        self.assertEqual(self.assert_matches_rebuild(), [(self.staff.id, self.stage.id, self.day + timedelta(days=1), 11, 'completed', 1)])
+
+        Appointment.bulk_set_status(Appointment.objects.all(), 'cancelled')
+        self.assert_matches_rebuild()
+        Appointment.objects.get(pk=appointment.pk).delete()
+        self.assertEqual(self.assert_matches_rebuild(), [])
+
+    def test_instances_not_loaded_from_the_db_apply_a_delta(self):
+        appointment = create_appointment(self.staff, self.stage, self.day, 9)
+        other = create_appointment(self.staff, self.stage, self.day, 12)
+
+        # Instancia construida a mano y otra con campos diferidos: sin recontar toda la tabla
+        with CaptureQueriesContext(connection) as queries:
+            detached = Appointment(**{
+                field.attname: getattr(appointment, field.attname) for field in Appointment._meta.concrete_fields
+            })
+            detached._state.adding = False
+            detached.status = 'completed'
+            detached.save()
+            deferred = Appointment.objects.only('id', 'notes').get(pk=other.pk)
+            deferred.notes = 'Llamar antes'
+            deferred.save()
+        self.assertFalse([
+            query['sql'] for query in queries.captured_queries
+            if query['sql'].startswith('DELETE FROM "visits_appointmentrollup"')
+        ])
+
+        self.assertEqual(self.assert_matches_rebuild(), [
+            (self.staff.id, self.stage.id, self.day, 9, 'completed', 1),
+            (self.staff.id, self.stage.id, self.day, 12, 'pending', 1),
+        ])
+
+
+# ====================================
+# Sincronización incremental del calendario
+# ====================================
+
+class CalendarSyncTests(VisitsTestCase):
+    url = '/dashboard/calendar/'
+
+    def setUp(self):
+        super().setUp()
+        self.supervisor = create_staff('sonia', [self.stage], supervisor=True)
+        self.appointment = create_appointment(self.staff, self.stage, self.day, 9)
+        self.untouched = create_appointment(self.staff, self.stage, self.day, 12)
+        self.client.login(username='sonia', password='secret')
+        # Citas guardadas antes del token (más allá del solape de SYNC_OVERLAP)
+        Appointment.objects.update(updated_at=timezone.now() - timedelta(minutes=5))
+
+    def sync(self, staff, token=None, day=None):
+        day = day or self.day
+        params = {
+            'staff_id': staff.id,
+            'start': datetime.combine(day, time(0)).isoformat(),
+            'end': datetime.combine(day, time(23, 59)).isoformat(),
+        }
+        params.update({'sync_token': token} if token is not None else {'sync': 1})
+        return self.client.get(self.url, params).json()
+
+    def test_full_load_then_only_changes(self):
+        full = self.sync(self.staff)
+        self.assertTrue(full['full'])
+        self.assertEqual(sorted(event['id'] for event in full['events']), [self.appointment.id, self.untouched.id])
+
+        appointment = Appointment.objects.get(pk=self.appointment.pk)
+        appointment.status = 'completed'
+        appointment.save()
+        changes = self.sync(self.staff, full['sync_token'])
+        self.assertFalse(changes['full'])
+        self.assertEqual([event['id'] for event in changes['events']], [self.appointment.id])
+        self.assertEqual(changes['deleted'], [])
+
+    def test_deleted_appointment_leaves_a_tombstone(self):
+        token = self.sync(self.staff)['sync_token']
+        Appointment.objects.get(pk=self.appointment.pk).delete()
+        changes = self.sync(self.staff, token)
+        self.assertEqual((changes['events'], changes['deleted']), ([], [self.appointment.id]))
+
+    def test_moving_to_another_staff_removes_it_from_the_old_one(self):
+        old_token = self.sync(self.staff)['sync_token']
+        new_token = self.sync(self.supervisor)['sync_token']
+        appointment = Appointment.objects.get(pk=self.appointment.pk)
+        appointment.staff = self.supervisor
+        appointment.save()
+
+        old = self.sync(self.staff, old_token)
+        self.assertEqual((old['events'], old['deleted']), ([], [self.appointment.id]))
+        new = self.sync(self.supervisor, new_token)
+        self.assertEqual(([event['id'] for event in new['events']], new['deleted']), ([self.appointment.id], []))
+
+    def test_moving_to_another_day_removes_it_from_the_old_range(self):
+        token = self.sync(self.staff)['sync_token']
+        appointment = Appointment.objects.get(pk=self.appointment.pk)
+        appointment.date = make_aware(datetime.combine(self.day + timedelta(days=1), time(9)))
+        appointment.save()
+
+        changes = self.sync(self.staff, token)
+        self.assertEqual((changes['events'], changes['deleted']), ([], [self.appointment.id]))
+        moved = self.sync(self.staff, token, day=self.day + timedelta(days=1))
+        self.assertEqual([event['id'] for event in moved['events']], [self.appointment.id])
+
+    def test_expired_or_invalid_token_reloads_the_range(self):
+        expired = make_sync_token(timezone.now() - TOMBSTONE_TTL - timedelta(minutes=1))
+        for token in (expired, 'not-a-token', '2026-01-01T00:00:00'):
+            with self.subTest(token=token):
+                response = self.sync(self.staff, token)
+                self.assertTrue(response['full'])
+                self.assertEqual(len(response['events']), 2)
+
+    def test_expired_tombstones_are_purged(self):
+        Appointment.objects.get(pk=self.appointment.pk).delete()
+        AppointmentTombstone.objects.update(deleted_at=timezone.now() - TOMBSTONE_TTL - timedelta(minutes=1))
+        Appointment.objects.get(pk=self.untouched.pk).delete()
+        self.assertEqual(list(AppointmentTombstone.objects.values_list('appointment_id', flat=True)), [self.untouched.pk])
+
+
+# ====================================
+# Outbox de emails
+# ====================================
+
+class SynchronousThread:
+    """Sustituto de threading.Thread que ejecuta el hilo al arrancarlo"""
+
+    def __init__(self, target, **kwargs):
+        self.target = target
+
+    def start(self):
+        self.target()
+
+
+class EmailOutboxTests(TestCase):
+    def queue(self, count=1):
+        return [queue_email('test', f'familia{index}@example.com', 'Asunto', '<p>Hola</p>') for index in range(count)]
+
+    def test_pending_email_is_sent(self):
+        email, = self.queue()
+        self.assertEqual(process_email_outbox(), {'sent': 1, 'retried': 0, 'failed': 0})
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts, email.locked_at), ('sent', 1, None))
+        self.assertEqual(mail.outbox[0].to, ['familia0@example.com'])
+
+    def test_failure_is_retried_with_backoff(self):
+        email, = self.queue()
+        with mock.patch.object(MailDispatcher, 'send', side_effect=OSError('SMTP caído')):
+            self.assertEqual(process_email_outbox(), {'sent': 0, 'retried': 1, 'failed': 0})
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts, email.last_error), ('pending', 1, 'SMTP caído'))
+        self.assertAlmostEqual(email.next_attempt_at, timezone.now() + timedelta(minutes=1), delta=timedelta(seconds=5))
+        # Hasta next_attempt_at no se vuelve a coger
+        self.assertEqual(process_email_outbox(), {'sent': 0, 'retried': 0, 'failed': 0})
+
+    def test_last_attempt_marks_it_failed(self):
+        email, = self.queue()
+        EmailOutbox.objects.filter(pk=email.pk).update(attempts=OUTBOX_MAX_ATTEMPTS - 1)
+        with mock.patch.object(MailDispatcher, 'send', side_effect=OSError('SMTP caído')):
+            self.assertEqual(process_email_outbox(), {'sent': 0, 'retried': 0, 'failed': 1})
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), ('failed', OUTBOX_MAX_ATTEMPTS))
+
+    def test_stale_sending_email_is_reclaimed(self):
+        stale, fresh = self.queue(2)
+        EmailOutbox.objects.filter(pk=stale.pk).update(status='sending', locked_at=timezone.now() - OUTBOX_LOCK_TIMEOUT - timedelta(minutes=1))
+        EmailOutbox.objects.filter(pk=fresh.pk).update(status='sending', locked_at=timezone.now())
+        self.assertEqual(process_email_outbox()['sent'], 1)
+        self.assertEqual(EmailOutbox.objects.get(pk=stale.pk).status, 'sent')
+        self.assertEqual(EmailOutbox.objects.get(pk=fresh.pk).status, 'sending')
+
+    def test_background_drain_sends_every_batch(self):
+        self.queue(OUTBOX_BATCH_SIZE * 2 + 1)
+        with mock.patch('visits.emails.threading.Thread', SynchronousThread), mock.patch('visits.emails.connection'):
+            drain_outbox_in_background()
+        self.assertFalse(EmailOutbox.objects.exclude(status='sent').exists())
+        self.assertEqual(len(mail.outbox), OUTBOX_BATCH_SIZE * 2 + 1)
+        # El hilo terminó y soltó el cerrojo
+        self.assertTrue(_drain_lock.acquire(blocking=False))
+        _drain_lock.release()
+
+
+# ====================================
+# Recordatorios: envío en paralelo con límite de ritmo
+# ====================================
+
+class RateLimiterTests(TestCase):
+    def test_spaces_sends_by_reserved_slots(self):
+        limiter = RateLimiter(per_minute=60)
+        with mock.patch('visits.emails.time_module.monotonic', return_value=100.0), \
+                mock.patch('visits.emails.time_module.sleep') as sleep:
+            for _ in range(3):
+                limiter.wait()
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [1.0, 2.0])
+
+    def test_zero_means_no_limit(self):
+        with mock.patch('visits.emails.time_module.sleep') as sleep:
+            for _ in range(3):
+                RateLimiter(per_minute=0).wait()
+        sleep.assert_not_called()
+
+
+class ParallelMailDispatcherTests(TestCase):
+    def job(self, index):
+        def build():
+            if index == 3:
+                raise ValueError('plantilla rota')
+            return build_message(f'Aviso {index}', '<p>Hola</p>', f'familia{index}@example.com')
+        return index, build
+
+    def test_results_are_delivered_in_batches(self):
+        batches = []
+        dispatcher = ParallelMailDispatcher(workers=3, per_minute=0)
+        with mock.patch.object(ParallelMailDispatcher, 'RESULTS_BATCH_SIZE', 4):
+            results = dispatcher.run([self.job(index) for index in range(10)], on_batch=lambda batch: batches.append(dict(batch)))
+
+        self.assertEqual(sorted(len(batch) for batch in batches), [2, 4, 4])
+        self.assertEqual({key: error for batch in batches for key, error in batch.items()}, results)
+        self.assertEqual(dispatcher.stats()['failed'], 1)
+        self.assertIsInstance(results[3], ValueError)
+        self.assertEqual({key for key, error in results.items() if error is None}, set(range(10)) - {3})
+        self.assertEqual(len(mail.outbox), 9)
+
+
+class DailyReminderTests(VisitsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.staff.notify_reminder = False
+        self.staff.save()
+        tomorrow = timezone.now().date() + timedelta(days=1)
+        self.appointments = [create_appointment(self.staff, self.stage, tomorrow, hour) for hour in (9, 10, 11, 12, 13)]
+
+    def test_reminders_are_marked_as_each_batch_finishes(self):
+        with mock.patch.object(ParallelMailDispatcher, 'RESULTS_BATCH_SIZE', 2), \
+                mock.patch('visits.emails.mark_reminders_sent', wraps=mark_reminders_sent) as mark:
+            result = send_daily_reminders(workers=1, per_minute=0)
+
+        self.assertEqual(result['family_emails'], 5)
+        self.assertEqual([len(call.args[0]) for call in mark.call_args_list], [2, 2, 1])
+        self.assertFalse(Appointment.objects.filter(reminder_sent=False).exists())
+
+    def test_interrupted_run_keeps_finished_batches(self):
+        # El proceso muere al guardar el segundo lote: el primero ya quedó marcado
+        calls = []
+
+        def mark_then_die(appointment_ids):
+            if calls:
+                raise KeyboardInterrupt
+            calls.append(appointment_ids)
+            return mark_reminders_sent(appointment_ids)
+
+        with mock.patch.object(ParallelMailDispatcher, 'RESULTS_BATCH_SIZE', 2), \
+                mock.patch('visits.emails.mark_reminders_sent', side_effect=mark_then_die):
+            with self.assertRaises(KeyboardInterrupt):
+                send_daily_reminders(workers=1, per_minute=0)
+        self.assertEqual(Appointment.objects.filter(reminder_sent=True).count(), 2)
+
+        for thread in threading.enumerate():
+            if thread.name.startswith('email-sender'):
+                thread.join()
+        mail.outbox.clear()
+        self.assertEqual(send_daily_reminders(workers=1, per_minute=0)['family_emails'], 3)
+        self.assertEqual(len(mail.outbox), 3)
+
+
+# ====================================
+# Caché del dashboard
+# ====================================
+
+class DashboardCacheTests(VisitsTestCase):
+    def total(self):
+        return self.client.get('/dashboard/stats/').json()['total_count']
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='ana', password='secret')
+
+    def test_booking_invalidates_cached_stats(self):
+        self.assertEqual(self.total(), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            create_appointment(self.staff, self.stage, self.day, 10)
+        self.assertEqual(self.total(), 1)
+
+    def test_lost_generation_does_not_serve_old_entries(self):
+        self.assertEqual(self.total(), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            create_appointment(self.staff, self.stage, self.day, 10)
+        self.assertEqual(self.total(), 1)
+
+        # La caché descarta las generaciones: las entradas anteriores no vuelven
+        cache.delete_many([_generation_key(self.staff.id), _generation_key(GLOBAL_SCOPE)])
+        with self.captureOnCommitCallbacks(execute=False):
+            create_appointment(self.staff, self.stage, self.day, 12)
+        self.assertEqual(self.total(), 2)
+
+
+# ====================================
+# Rol y perfil en la sesión
+# ====================================
+
+class StaffAccessTests(VisitsTestCase):
+    def test_default_cache_is_shared_between_workers(self):
+        self.assertEqual(check_shared_cache(None), [])
+
+    def test_revoking_supervisor_is_seen_on_the_next_request(self):
+        supervisor = create_staff('sonia', [self.stage], supervisor=True)
+        self.client.login(username='sonia', password='secret')
+        self.assertTrue(self.client.get('/dashboard/').context['is_supervisor'])
+
+        # Otro worker quita el grupo: la versión está en la caché compartida
+        supervisor.user.groups.clear()
+        self.assertFalse(self.client.get('/dashboard/').context['is_supervisor'])
+
+    def test_stage_changes_are_seen_on_the_next_request(self):
+        self.client.login(username='ana', password='secret')
+        self.assertEqual(self.client.get('/dashboard/stats/').json()['stages_count'], 1)
+        self.staff.allowed_stages.add(SchoolStage.objects.create(name='Secundaria', description=''))
+        self.assertEqual(self.client.get('/dashboard/stats/').json()['stages_count'], 2)
@@ -26,6 +26,7 @@ urlpatterns = [
     path('', views.PublicBookingView.as_view(), name='public_booking'),
     path('stage/<int:stage_id>/', views.StageBookingView.as_view(), name='stage_booking'),
     path('stage/<int:stage_id>/book/<int:slot_id>/', views.book_appointment, name='book_appointment'),
+    path('stage/<int:stage_id>/book/<slug:slot_ref>/', views.book_appointment, name='book_rule_slot'),
     path('appointment/<int:appointment_id>/confirmation/', 
          views.AppointmentConfirmationView.as_view(), 
          name='appointment_confirmation'),
@@ -38,18 +39,24 @@ urlpatterns = [
     path('dashboard/', DashboardView.as_view(), name='dashboard'),
     path('dashboard/stats/', DashboardStatsView.as_view(), name='dashboard_stats'),
     path('dashboard/calendar/', DashboardCalendarView.as_view(), name='dashboard_calendar'),
+    path('dashboard/cache-stats/', views.DashboardCacheStatsView.as_view(), name='dashboard_cache_stats'),
     path('availability/', views.StaffAvailabilityView.as_view(), name='staff_availability'),
     path('appointments/', views.AppointmentsCRUDView.as_view(), name='appointments_crud'),
     
     # API endpoints
     path('api/stage/<int:stage_id>/availability/', views.get_stage_availability, name='stage_availability'),
+    path('api/stage/<int:stage_id>/availability/stream/', views.stage_availability_stream, name='stage_availability_stream'),
     path('api/stage/<int:stage_id>/staff/', views.staff_by_stage, name='staff_by_stage'),
     path('api/stage/<int:stage_id>/courses/', views.courses_by_stage, name='courses_by_stage'),
     path('api/availability/', views.StaffAvailabilityView.as_view(), name='api_availability'),
     path('api/availability/<int:slot_id>/', views.StaffAvailabilityView.as_view(), name='api_delete_availability'),
+    path('api/availability/rule/<int:rule_id>/', views.StaffAvailabilityView.as_view(), name='api_delete_availability_rule'),
+    path('api/availability/cache-stats/', views.CalendarCacheStatsView.as_view(), name='calendar_cache_stats'),
     
     # API Appointments
     path('api/appointments/', views.AppointmentAPIView.as_view(), name='api_appointments'),
+    path('api/appointments/bulk/', views.BulkAppointmentAPIView.as_view(), name='api_appointments_bulk'),
+    path('api/appointments/bulk-status/', views.AppointmentStatusBulkView.as_view(), name='api_appointments_bulk_status'),
     path('api/appointments/<int:appointment_id>/', views.AppointmentAPIView.as_view(), name='api_appointment_detail'),
     
     # Endpoints para exportación
@@ -9,29 +9,44 @@ from django.contrib.auth.models import User
 from django.utils import timezone
 from django.shortcuts import render, get_object_or_404, redirect
 from django.views.generic import TemplateView, View
-from django.http import JsonResponse, Http404
+from django.http import JsonResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
 from django.urls import reverse, reverse_lazy
 from django.contrib import messages
 from django.utils.timezone import make_aware, get_current_timezone
-from django.db.models import Q, Count
-from django.db.models.functions import ExtractHour
+from django.db.models import Q
 from django.utils.timezone import is_naive, make_aware, localtime
 from django.middleware.csrf import get_token
 from django.db import transaction
+from django.views.decorators.http import condition
+from django.views.decorators.cache import cache_control
+from django.utils.decorators import method_decorator
 
 # Importaciones de Python
 from datetime import datetime, timedelta, time
-import calendar
+import asyncio
 import json
 import logging
+import uuid
 
 logger = logging.getLogger(__name__)
 
 # Importaciones locales
-from .models import Appointment, SchoolStage, Course, StaffProfile, AvailabilitySlot
-from .serializers import AppointmentSerializer, AvailabilitySlotSerializer, CalendarDaySerializer
+from .models import Appointment, SchoolStage, Course, StaffProfile, AvailabilitySlot, AvailabilityRule, AppointmentRollup
+from .serializers import AppointmentSerializer, AppointmentBatchItemSerializer, CalendarDaySerializer, serialize_slots
 from .forms import StaffAuthenticationForm
-from .emails import send_appointment_confirmation, send_appointment_cancellation, send_appointment_modification
+from .emails import send_appointment_confirmation, send_appointment_confirmations, send_appointment_cancellation, send_appointment_modification
+from .calendar_cache import get_stage_calendar, calendar_cache_stats
+from .live import broadcaster, format_sse
+from .idempotency import idempotent
+from .stats import dashboard_stats
+from .dashboard_cache import get_dashboard_data, dashboard_cache_stats, GLOBAL_SCOPE
+from .calendar_sync import make_sync_token, parse_sync_token, calendar_changes
+from .scheduling import (
+    find_appointment_conflict, has_appointment_conflict, describe_conflict,
+    month_weekday_dates, find_conflicting_dates, stage_day_slots, get_rule_slot,
+    find_batch_conflicts
+)
 
 # ====================================
 # Part 1.1: Base Functions - CORREGIDO
@@ -39,31 +54,11 @@ from .emails import send_appointment_confirmation, send_appointment_cancellation
 
 def is_slot_available(staff, datetime_start, duration):
     """
-    CORRECCIÓN COMPLETA: Comprueba si un slot de tiempo está disponible
+    Comprueba si un slot de tiempo está disponible
     """
     logger.debug(f"Comprobando disponibilidad para {staff} a partir de {datetime_start} durante {duration} minutos")
     datetime_end = datetime_start + timedelta(minutes=duration)
-    
-    # Obtener citas del mismo día
-    existing_appointments = Appointment.objects.filter(
-        staff=staff,
-        date__date=datetime_start.date()
-    )
-    
-    # CORRECCIÓN: Verificar solapamiento con límites exactos permitidos
-    for existing_apt in existing_appointments:
-        existing_end = existing_apt.date + timedelta(minutes=existing_apt.duration)
-        
-        # Hay solapamiento si hay intersección real (no en límites exactos)
-        if existing_apt.date < datetime_end and existing_end > datetime_start:
-            # PERMITIR límites exactos: cita termina cuando empieza nueva o viceversa
-            if existing_end == datetime_start or existing_apt.date == datetime_end:
-                continue  # No es solapamiento, es límite exacto permitido
-            
-            logger.info(f"Cita solapada encontrada: {existing_apt.visitor_name} ({existing_apt.date} - {existing_end})")
-            return False
-
-    return True
+    return not has_appointment_conflict(staff, datetime_start, datetime_end)
 
 # ====================================
 # Part 1.2: Authentication Views
@@ -245,12 +240,29 @@ class StaffPasswordChangeView(LoginRequiredMixin, PasswordChangeView):
         messages.success(self.request, 'Contraseña actualizada correctamente')
         return super().form_valid(form)
 
+def _stage_etag(request, stage_id):
+    """
+    ETag de los endpoints públicos de una etapa: su versión y el día actual
+    (las ventanas de disponibilidad empiezan hoy). Una sola consulta, antes
+    de leer slots, citas o cursos.
+    """
+    version = SchoolStage.objects.filter(id=stage_id).values_list('version', flat=True).first()
+    if version is None:
+        return None
+    return f"{stage_id}-{version}-{datetime.now().date():%Y%m%d}"
+
+def stage_conditional(view):
+    """GET condicional por versión de la etapa; el navegador revalida siempre con If-None-Match"""
+    return cache_control(no_cache=True)(condition(etag_func=_stage_etag)(view))
+
+@stage_conditional
 def staff_by_stage(request, stage_id):
     logger.debug(f"Obteniendo profesores para la etapa con id {stage_id}")
     staff = StaffProfile.objects.filter(allowed_stages=stage_id)
     data = [{'id': s.id, 'name': s.user.get_full_name()} for s in staff]
     return JsonResponse(data, safe=False)
 
+@stage_conditional
 def courses_by_stage(request, stage_id):
     """Nueva función para obtener cursos por etapa"""
     logger.debug(f"Obteniendo cursos para la etapa con id {stage_id}")
@@ -262,46 +274,112 @@ def courses_by_stage(request, stage_id):
 # Part 3: Availability Functions
 # ====================================
 
+@stage_conditional
 def get_stage_availability(request, stage_id):
+    """
+    Disponibilidad de una etapa: slots guardados más los huecos calculados
+    al vuelo a partir de las reglas semanales.
+
+    Con ?date= devuelve los huecos del día; sin fecha, las fechas con huecos
+    de los próximos 90 días, y con ?view=calendar además el número de huecos
+    y la primera y última hora de cada fecha.
+    """
     try:
         date_param = request.GET.get('date')
         if date_param:
             try:
                 date = datetime.strptime(date_param, '%Y-%m-%d').date()
-                slots = AvailabilitySlot.objects.filter(
-                    stage_id=stage_id,
-                    date=date,
-                    is_active=True,
-                    start_time__gte=time(8, 0),
-                    end_time__lte=time(20, 0)
-                ).select_related('staff', 'staff__user')
-                serializer = AvailabilitySlotSerializer(slots, many=True)
-                return JsonResponse(serializer.data, safe=False)
+                return JsonResponse(serialize_slots(stage_day_slots(stage_id, date)), safe=False)
             except ValueError as e:
                 return JsonResponse([], safe=False)
         else:
-            start_date = datetime.now().date()
-            end_date = start_date + timedelta(days=90)
-            slots = AvailabilitySlot.objects.filter(
-                stage_id=stage_id,
-                date__range=(start_date, end_date),
-                is_active=True,
-                start_time__gte=time(8, 0),
-                end_time__lte=time(20, 0)
-            ).values('date').distinct()
-            available_dates = [{'date': slot['date'].isoformat(), 'available': True} for slot in slots]
+            # Calendario de 90 días, cacheado por etapa (ver calendar_cache)
+            days = get_stage_calendar(stage_id)
+            if request.GET.get('view') == 'calendar':
+                # Huecos libres y primera/última hora por fecha
+                available_dates = [
+                    {
+                        'date': date.isoformat(),
+                        'available': True,
+                        'slots': days[date]['slots'],
+                        'first': days[date]['first'].strftime('%H:%M'),
+                        'last': days[date]['last'].strftime('%H:%M'),
+                    }
+                    for date in sorted(days)
+                ]
+            else:
+                available_dates = [{'date': date.isoformat(), 'available': True} for date in sorted(days)]
             return JsonResponse(available_dates, safe=False)
     except Exception as e:
         logger.error(f"Error en get_stage_availability: {str(e)}", exc_info=True)
         return JsonResponse({'error': str(e)}, status=500)
 
+# Comentario SSE cada N segundos para que proxies y navegador no corten el stream
+STREAM_KEEPALIVE_SECONDS = 20
+
+async def stage_availability_stream(request, stage_id):
+    """
+    Stream SSE con los cambios de disponibilidad de la etapa (ver live.py).
+
+    Solo funciona bajo ASGI; con WSGI responde 204, que indica al EventSource
+    que no vuelva a conectar.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    if not await SchoolStage.objects.filter(id=stage_id).aexists():
+        raise Http404("Etapa no encontrada")
+
+    async def events():
+        queue = broadcaster.subscribe(stage_id)
+        logger.debug(f"Stream abierto para la etapa {stage_id}")
+        try:
+            yield format_sse('ready', {'stage_id': stage_id})
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                yield format_sse(event, data)
+        finally:
+            broadcaster.unsubscribe(stage_id, queue)
+            logger.debug(f"Stream cerrado para la etapa {stage_id}")
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+class CalendarCacheStatsView(LoginRequiredMixin, View):
+    """Aciertos y fallos de la caché del calendario público - Solo admin (del proceso que responde)"""
+    
+    def get(self, request):
+        if not request.user.is_superuser:
+            return JsonResponse({'error': 'Sin permisos'}, status=403)
+        return JsonResponse(calendar_cache_stats())
+
+class DashboardCacheStatsView(LoginRequiredMixin, View):
+    """Aciertos y fallos de la caché de estadísticas y calendario del dashboard - Solo admin (del proceso que responde)"""
+    
+    def get(self, request):
+        if not request.user.is_superuser:
+            return JsonResponse({'error': 'Sin permisos'}, status=403)
+        return JsonResponse(dashboard_cache_stats())
+
 # ====================================
 # Part 4: Booking Management - CORREGIDO
 # ====================================
 
-def book_appointment(request, stage_id, slot_id):
+@idempotent
+def book_appointment(request, stage_id, slot_id=None, slot_ref=None):
     stage = get_object_or_404(SchoolStage, id=stage_id)
-    slot = get_object_or_404(AvailabilitySlot, id=slot_id, stage_id=stage_id, is_active=True)
+    if slot_ref:
+        # Hueco calculado a partir de una regla semanal
+        slot = get_rule_slot(stage_id, slot_ref)
+        if slot is None:
+            raise Http404("Horario no disponible")
+    else:
+        slot = get_object_or_404(AvailabilitySlot, id=slot_id, stages=stage_id, is_active=True)
     
     if request.method == 'POST':
         try:
@@ -316,24 +394,13 @@ def book_appointment(request, stage_id, slot_id):
                 appointment_datetime = make_aware(appointment_datetime, get_current_timezone())
                 appointment_end = appointment_datetime + timedelta(minutes=slot.duration)
                 
-                # CORRECCIÓN: Verificar disponibilidad con la lógica correcta
-                # Obtener todas las citas del mismo día y staff
-                existing_appointments = Appointment.objects.select_for_update().filter(
-                    staff=slot.staff,
-                    date__date=appointment_datetime.date()
-                )
-                
-                # Verificar solapamiento cita por cita con límites exactos permitidos
-                has_overlap = False
-                for existing_apt in existing_appointments:
-                    existing_end = existing_apt.date + timedelta(minutes=existing_apt.duration)
-                    # Hay solapamiento si: existing_start < new_end AND existing_end > new_start
-                    if existing_apt.date < appointment_end and existing_end > appointment_datetime:
-                        # CORRECCIÓN: Permitir límites exactos
-                        if existing_end == appointment_datetime or existing_apt.date == appointment_end:
-                            continue  # No es solapamiento, es límite exacto
-                        has_overlap = True
-                        break
+                # Verificar disponibilidad bloqueando las citas del día del staff
+                has_overlap = find_appointment_conflict(
+                    slot.staff,
+                    appointment_datetime,
+                    appointment_end,
+                    lock=True
+                ) is not None
                 
                 if has_overlap:
                     return JsonResponse({
@@ -380,20 +447,20 @@ def book_appointment(request, stage_id, slot_id):
                     comments=request.POST.get('comments', '')
                 )
 
-                # Enviar email de confirmación
+                # Encolar emails de confirmación (se envían tras el commit)
                 try:
                     send_appointment_confirmation(appointment)
                 except Exception as e:
-                    logger.error(f"Error enviando email de confirmación: {str(e)}", exc_info=True)
+                    logger.error(f"Error encolando email de confirmación: {str(e)}", exc_info=True)
                     # No revertimos la creación de la cita si falla el email
                 
-                # Eliminar slots solapados
-                AvailabilitySlot.objects.filter(
+                # Eliminar slots solapados (una sola actualización de la disponibilidad)
+                AvailabilitySlot.delete_batch(AvailabilitySlot.objects.filter(
                     staff=slot.staff,
                     date=slot.date,
                     start_time__lt=appointment_end.time(),
                     end_time__gt=appointment_datetime.time()
-                ).delete()
+                ))
                 
                 return JsonResponse({
                     'status': 'success',
@@ -411,7 +478,8 @@ def book_appointment(request, stage_id, slot_id):
         'stage': stage,
         'slot': slot,
         'courses': courses,
-        'staff_name': slot.staff.user.get_full_name()
+        'staff_name': slot.staff.user.get_full_name(),
+        'idempotency_key': uuid.uuid4()
     }
     return render(request, 'visits/book_appointment.html', context)
 
@@ -419,6 +487,30 @@ def book_appointment(request, stage_id, slot_id):
 # Part 5: Staff Availability - CORREGIDO
 # ====================================
 
+def _slot_row(slot, stage_names):
+    """Fila de la tabla de disponibilidad para un slot"""
+    return {
+        'id': slot.id,
+        'date': slot.date.strftime('%d/%m/%Y') if slot.date else '',
+        'start_time': slot.start_time.strftime('%H:%M'),
+        'end_time': slot.end_time.strftime('%H:%M'),
+        'duration': slot.duration,
+        'stages': stage_names,
+        'delete_url': reverse('api_delete_availability', kwargs={'slot_id': slot.id})
+    }
+
+def _rule_row(rule):
+    """Fila de la tabla de disponibilidad para una regla semanal"""
+    return {
+        'id': f'rule-{rule.id}',
+        'date': f'Cada {rule.get_weekday_display().lower()} de {rule.get_month_display().lower()} {rule.year}',
+        'start_time': rule.start_time.strftime('%H:%M'),
+        'end_time': rule.end_time.strftime('%H:%M'),
+        'duration': rule.duration,
+        'stages': [stage.name for stage in rule.stages.all()],
+        'delete_url': reverse('api_delete_availability_rule', kwargs={'rule_id': rule.id})
+    }
+
 class StaffAvailabilityView(LoginRequiredMixin, View):
     template_name = 'visits/staff_availability.html'
     
@@ -429,24 +521,19 @@ class StaffAvailabilityView(LoginRequiredMixin, View):
             date__gte=datetime.now().date(),
             start_time__gte=time(8, 0),
             end_time__lte=time(20, 0)
-        ).select_related('stage')
+        ).prefetch_related('stages')
+        
+        slots_data = [_slot_row(slot, [stage.name for stage in slot.stages.all()]) for slot in slots]
+        
+        # Reglas semanales vigentes (una fila por regla)
+        today = datetime.now().date()
+        rules = AvailabilityRule.objects.filter(
+            Q(year__gt=today.year) | Q(year=today.year, month__gte=today.month),
+            staff=request.user.staffprofile,
+            is_active=True
+        ).prefetch_related('stages')
+        slots_data.extend(_rule_row(rule) for rule in rules)
         
-        grouped_slots = {}
-        for slot in slots:
-            key = (slot.date, slot.start_time, slot.end_time)
-            if key not in grouped_slots:
-                grouped_slots[key] = {
-                    'id': slot.id,
-                    'date': slot.date.strftime('%d/%m/%Y'),
-                    'start_time': slot.start_time.strftime('%H:%M'),
-                    'end_time': slot.end_time.strftime('%H:%M'),
-                    'duration': slot.duration,
-                    'stages': [slot.stage.name]
-                }
-            else:
-                grouped_slots[key]['stages'].append(slot.stage.name)
-                
-        slots_data = list(grouped_slots.values())
         context = {
             'slots_json': json.dumps(slots_data),
             'now': datetime.now().date()
@@ -484,28 +571,53 @@ class StaffAvailabilityView(LoginRequiredMixin, View):
                 year = datetime.now().year
                 
                 # Obtener todas las fechas del mes que coinciden con el día de la semana
-                month_dates = []
-                c = calendar.monthcalendar(year, month)
-                for week in c:
-                    if week[weekday] != 0:
-                        month_dates.append(datetime(year, month, week[weekday]).date())
+                month_dates = month_weekday_dates(year, month, weekday)
                 
-                # Verificar solapamientos para todas las fechas
-                for date_to_check in month_dates:
-                    if date_to_check < datetime.now().date():
-                        continue
-                        
-                    # CORRECCIÓN: Verificar solapamiento con otros slots
-                    if staff_profile.has_overlapping_slots(date_to_check, start_time, end_time):
-                        return JsonResponse({
-                            'error': f'Ya existen slots de disponibilidad que se solapan en {date_to_check.strftime("%d/%m/%Y")}'
-                        }, status=400)
-
-                    # CORRECCIÓN: Verificar solapamiento con citas
-                    if staff_profile.has_appointments_in_timeframe(date_to_check, start_time, end_time):
-                        return JsonResponse({
-                            'error': f'Hay una cita programada que se solapa en {date_to_check.strftime("%d/%m/%Y")}'
-                        }, status=400)
+                # Verificar de una vez los solapamientos de todas las fechas futuras
+                dates_to_check = [d for d in month_dates if d >= datetime.now().date()]
+                slot_conflicts, appointment_conflicts = find_conflicting_dates(
+                    staff_profile, dates_to_check, start_time, end_time
+                )
+                
+                if slot_conflicts or appointment_conflicts:
+                    errors = []
+                    if slot_conflicts:
+                        errors.append(
+                            'Ya existen slots de disponibilidad que se solapan en ' +
+                            ', '.join(d.strftime('%d/%m/%Y') for d in slot_conflicts)
+                        )
+                    if appointment_conflicts:
+                        errors.append(
+                            'Hay citas programadas que se solapan en ' +
+                            ', '.join(d.strftime('%d/%m/%Y') for d in appointment_conflicts)
+                        )
+                    return JsonResponse({
+                        'error': '. '.join(errors),
+                        'conflicting_dates': [
+                            d.isoformat() for d in sorted(set(slot_conflicts) | set(appointment_conflicts))
+                        ],
+                        'slot_conflicts': [d.isoformat() for d in slot_conflicts],
+                        'appointment_conflicts': [d.isoformat() for d in appointment_conflicts]
+                    }, status=400)
+                
+                if not dates_to_check:
+                    return JsonResponse({'error': 'No quedan fechas futuras para ese día en el mes elegido'}, status=400)
+                
+                # La regla se guarda una sola vez; los huecos se calculan al consultar
+                with transaction.atomic():
+                    rule = AvailabilityRule.objects.create(
+                        staff=staff_profile,
+                        year=year,
+                        month=month,
+                        weekday=weekday,
+                        start_time=start_time,
+                        end_time=end_time,
+                        duration=base_slot_data['duration']
+                    )
+                    rule.stages.set(staff_profile.allowed_stages.all())
+                
+                logger.info(f"Creada regla semanal {rule.id}: {rule}")
+                return JsonResponse({'slots': [_rule_row(rule)]})
                     
             else:
                 # Manejo de slots únicos
@@ -526,64 +638,30 @@ class StaffAvailabilityView(LoginRequiredMixin, View):
                         'error': 'Hay una cita programada que se solapa con este horario'
                     }, status=400)
 
-            # Crear slots si no hay solapamientos
+            # Crear slots si no hay solapamientos: una fila por franja, con
+            # todas las etapas del staff
             created_slots = []
-            for stage in staff_profile.allowed_stages.all():
-                base_slot = AvailabilitySlot(**base_slot_data, stage=stage)
-                slots_generated = base_slot.generate_slots()
-                
-                # CORRECCIÓN: bulk_create con update_fields para asegurar que devuelva IDs
-                # En SQLite esto funciona desde Django 3.2+
-                created = AvailabilitySlot.objects.bulk_create(
-                    slots_generated,
-                    batch_size=100
-                )
-                created_slots.extend(created)
-            
-            # Verificar que todos los slots tengan ID antes de continuar
-            if not all(slot.id for slot in created_slots):
-                logger.error("Algunos slots no tienen ID después de bulk_create")
-                # Recargar los slots desde la base de datos
-                created_slots = list(AvailabilitySlot.objects.filter(
-                    staff=staff_profile,
-                    date__in=[s.date for s in created_slots if s.date],
-                    start_time=start_time,
-                    end_time=end_time
-                ).order_by('id'))
-            
-            # CORRECCIÓN: Agrupar slots para la respuesta asegurando IDs válidos
-            grouped_slots = {}
-            for slot in created_slots:
-                key = (slot.date, slot.start_time, slot.end_time)
-                if key not in grouped_slots:
-                    # Guardar el ID del primer slot del grupo (siempre será válido)
-                    grouped_slots[key] = {
-                        'id': slot.id,  # ID del primer slot creado para esta combinación
-                        'date': slot.date.strftime('%d/%m/%Y') if slot.date else '',
-                        'start_time': slot.start_time.strftime('%H:%M'),
-                        'end_time': slot.end_time.strftime('%H:%M'),
-                        'duration': slot.duration,
-                        'stages': [slot.stage.name]
-                    }
-                else:
-                    # Añadir stages adicionales pero mantener el ID del primer slot
-                    grouped_slots[key]['stages'].append(slot.stage.name)
-            
-            logger.info(f"Creados {len(created_slots)} slots, agrupados en {len(grouped_slots)} entradas")
+            stages = list(staff_profile.allowed_stages.all())
+            if stages:
+                base_slot = AvailabilitySlot(**base_slot_data)
+                with transaction.atomic():
+                    created_slots = AvailabilitySlot.create_with_stages(base_slot.generate_slots(), stages)
             
-            # Debug: Verificar que todos los grupos tienen ID válido
-            for group_key, group_data in grouped_slots.items():
-                if not group_data.get('id'):
-                    logger.error(f"Grupo sin ID: {group_key} -> {group_data}")
+            stage_names = [stage.name for stage in stages]
+            slots_data = [_slot_row(slot, stage_names) for slot in created_slots]
+            logger.info(f"Creados {len(created_slots)} slots para {len(stages)} etapas")
             
-            return JsonResponse({'slots': list(grouped_slots.values())})
+            return JsonResponse({'slots': slots_data})
             
         except Exception as e:
             logger.error(f"Error creating availability slots: {str(e)}", exc_info=True)
             return JsonResponse({'error': str(e)}, status=500)
     
-    def delete(self, request, slot_id=None):
+    def delete(self, request, slot_id=None, rule_id=None):
         try:
+            if rule_id:
+                return self._delete_rule(request, rule_id)
+            
             if not slot_id:
                 data = json.loads(request.body)
                 slot_id = data.get('slot_id')
@@ -618,18 +696,10 @@ class StaffAvailabilityView(LoginRequiredMixin, View):
                     'error': 'No se puede eliminar un slot con citas programadas'
                 }, status=400)
             
-            # Eliminar todos los slots relacionados (mismo staff, fecha y horario)
-            slots_to_delete = AvailabilitySlot.objects.filter(
-                staff=base_slot.staff,
-                date=base_slot.date,
-                start_time=base_slot.start_time,
-                end_time=base_slot.end_time
-            )
-            
-            count = slots_to_delete.count()
-            logger.info(f"Eliminando {count} slots relacionados")
-            
-            slots_to_delete.delete()
+            # Cada franja es una sola fila, válida para todas sus etapas
+            base_slot.delete()
+            count = 1
+            logger.info(f"Eliminado slot {slot_id}")
             
             return JsonResponse({
                 'status': 'success', 
@@ -638,8 +708,28 @@ class StaffAvailabilityView(LoginRequiredMixin, View):
             })
             
         except Exception as e:
-            logger.error(f"Error deleting slot {slot_id}: {str(e)}", exc_info=True)
+            logger.error(f"Error deleting slot {slot_id or rule_id}: {str(e)}", exc_info=True)
             return JsonResponse({'error': str(e)}, status=500)
+    
+    def _delete_rule(self, request, rule_id):
+        """Elimina una regla semanal; las citas ya reservadas se mantienen"""
+        deleted, _ = AvailabilityRule.objects.filter(
+            id=rule_id,
+            staff=request.user.staffprofile
+        ).delete()
+        
+        if not deleted:
+            logger.error(f"Regla {rule_id} no encontrada o no pertenece al usuario")
+            return JsonResponse({
+                'error': 'Regla no encontrada o no tienes permisos para eliminarla'
+            }, status=404)
+        
+        logger.info(f"Eliminada regla semanal {rule_id}")
+        return JsonResponse({
+            'status': 'success',
+            'deleted_count': 1,
+            'message': 'Se eliminó la disponibilidad semanal correctamente'
+        })
 
 # ====================================
 # Part 6: Appointment Cancellation - NUEVO
@@ -687,12 +777,14 @@ class CancelAppointmentView(TemplateView):
             return redirect('cancel_appointment', token=token)
         
         try:
-            # Cambiar estado a cancelada
-            appointment.status = 'cancelled'
-            appointment.save()
+            # La cancelación y sus emails (outbox) en la misma transacción
+            with transaction.atomic():
+                # Cambiar estado a cancelada
+                appointment.status = 'cancelled'
+                appointment.save()
             
-            # Enviar emails de notificación
-            send_appointment_cancellation(appointment, cancelled_by='family')
+                # Enviar emails de notificación
+                send_appointment_cancellation(appointment, cancelled_by='family')
             
             # Mostrar página de confirmación
             context = {
@@ -754,10 +846,37 @@ class AppointmentsCRUDView(LoginRequiredMixin, UserPassesTestMixin, TemplateView
             })
         return context
 
+def _overlap_error_message(conflict):
+    """Mensaje de solapamiento con horas locales"""
+    return _conflict_message(describe_conflict(conflict))
+
+def _conflict_message(details):
+    return (
+        f'Ya existe una cita en este horario. Conflicto con cita de {details["visitor_name"]} '
+        f'de {details["start"].strftime("%H:%M")} a {details["end"].strftime("%H:%M")}'
+    )
+
+def _filter_appointments(queryset, params, is_supervisor):
+    """Filtros de etapa, fecha, estado y staff (solo supervisores) del listado de citas"""
+    stage = params.get('stage')
+    date = params.get('date')
+    status = params.get('status')
+    staff_id = str(params.get('staff_id') or '')
+
+    if stage:
+        queryset = queryset.filter(stage_id=stage)
+    if date:
+        queryset = queryset.filter(date__date=date)
+    if status:
+        queryset = queryset.filter(status=status)
+    if staff_id and is_supervisor and staff_id.isdigit():
+        queryset = queryset.filter(staff_id=staff_id)
+    return queryset
+
 class AppointmentAPIView(LoginRequiredMixin, View):
     def get(self, request, appointment_id=None):
         try:
-            is_supervisor = request.user.groups.filter(name='Supervisor').exists()
+            is_supervisor = request.staff_access.is_supervisor
             
             if appointment_id:
                 # Construir query base
@@ -770,7 +889,7 @@ class AppointmentAPIView(LoginRequiredMixin, View):
                     appointment = get_object_or_404(
                         appointment_query, 
                         id=appointment_id,
-                        staff=request.user.staffprofile
+                        staff_id=request.staff_access.staff_id
                     )
                 
                 serializer = AppointmentSerializer(appointment)
@@ -781,7 +900,7 @@ class AppointmentAPIView(LoginRequiredMixin, View):
             # Para listados, usar el mismo enfoque de permisos
             queryset = Appointment.objects.select_related('stage', 'course', 'staff__user')
             if not is_supervisor:
-                queryset = queryset.filter(staff=request.user.staffprofile)
+                queryset = queryset.filter(staff_id=request.staff_access.staff_id)
 
             # Total de registros SIN filtros
             total_records = queryset.count()
@@ -798,19 +917,7 @@ class AppointmentAPIView(LoginRequiredMixin, View):
                 )
 
             # Aplicar otros filtros
-            stage = request.GET.get('stage')
-            date = request.GET.get('date')
-            status = request.GET.get('status')
-            staff_id = request.GET.get('staff_id')
-
-            if stage:
-                queryset = queryset.filter(stage_id=stage)
-            if date:
-                queryset = queryset.filter(date__date=date)
-            if status:
-                queryset = queryset.filter(status=status)
-            if staff_id and is_supervisor and staff_id.isdigit():
-                queryset = queryset.filter(staff_id=staff_id)
+            queryset = _filter_appointments(queryset, request.GET, is_supervisor)
 
             # Total de registros DESPUÉS de filtros
             filtered_records = queryset.count()
@@ -865,6 +972,7 @@ class AppointmentAPIView(LoginRequiredMixin, View):
                 'error': str(e)
             }, status=500)
 
+    @method_decorator(idempotent)
     def post(self, request):
         try:
             logger.debug("=== APPOINTMENT CREATION START ===")
@@ -874,12 +982,12 @@ class AppointmentAPIView(LoginRequiredMixin, View):
             logger.debug(f"Parsed data: {data}")
 
             # 2. Asignar staff_id
-            is_supervisor = request.user.groups.filter(name='Supervisor').exists()
+            is_supervisor = request.staff_access.is_supervisor
             if not is_supervisor:
-                data['staff'] = request.user.staffprofile.id
+                data['staff'] = request.staff_access.staff_id
             else:
                 if 'staff' not in data:
-                    data['staff'] = request.user.staffprofile.id
+                    data['staff'] = request.staff_access.staff_id
 
             # 3. Validar y procesar fecha
             try:
@@ -891,64 +999,14 @@ class AppointmentAPIView(LoginRequiredMixin, View):
                 logger.error(f"Error parsing date: {str(e)}")
                 return JsonResponse({'error': 'Formato de fecha inválido'}, status=400)
 
-            # 4. CORRECCIÓN: Verificar solapamientos con lógica correcta Y MENSAJE CORRECTO
+            # 4. Verificar solapamientos
             staff_id = data['staff']
             duration = data.get('duration', 60)
             appointment_end = appointment_date + timedelta(minutes=duration)
 
-            logger.debug(f"=== DEBUGGING OVERLAP CHECK ===")
-            logger.debug(f"New appointment: {appointment_date} to {appointment_end}")
-            logger.debug(f"Staff ID: {staff_id}, Duration: {duration}")
-
-            # Obtener citas del mismo día y staff
-            existing_appointments = Appointment.objects.filter(
-                staff_id=staff_id,
-                date__date=appointment_date.date()
-            )
-
-            logger.debug(f"Found {existing_appointments.count()} existing appointments on {appointment_date.date()}")
-
-            # CORRECCIÓN: Verificar solapamiento con límites exactos permitidos
-            overlap = False
-            overlap_details = []
-
-            for existing_apt in existing_appointments:
-                existing_end = existing_apt.date + timedelta(minutes=existing_apt.duration)
-                
-                logger.debug(f"Checking existing appointment {existing_apt.id}:")
-                logger.debug(f"  Existing: {existing_apt.date} to {existing_end}")
-                logger.debug(f"  New:      {appointment_date} to {appointment_end}")
-                
-                # Hay solapamiento si hay intersección real (no en límites exactos)
-                if existing_apt.date < appointment_end and existing_end > appointment_date:
-                    # CORRECCIÓN: Permitir límites exactos
-                    if existing_end == appointment_date or existing_apt.date == appointment_end:
-                        logger.debug(f"  Límite exacto permitido con appointment {existing_apt.id}")
-                        continue  # No es solapamiento, es límite exacto
-                    
-                    # Hay solapamiento real
-                    overlap = True
-                    
-                    # CORRECCIÓN: Convertir a hora local para el mensaje
-                    existing_local = localtime(existing_apt.date)
-                    existing_end_local = existing_local + timedelta(minutes=existing_apt.duration)
-                    
-                    overlap_details.append({
-                        'existing_id': existing_apt.id,
-                        'existing_start': existing_local,  # Hora local
-                        'existing_end': existing_end_local,  # Hora local
-                        'existing_visitor': existing_apt.visitor_name
-                    })
-                    logger.warning(f"OVERLAP DETECTED with appointment {existing_apt.id}")
-                    break
-                else:
-                    logger.debug(f"  No overlap with appointment {existing_apt.id}")
-
-            logger.debug(f"Final overlap result: {overlap}")
-
-            if overlap:
-                # CORRECCIÓN: Mensaje con horas locales
-                error_msg = f'Ya existe una cita en este horario. Conflicto con cita de {overlap_details[0]["existing_visitor"]} de {overlap_details[0]["existing_start"].strftime("%H:%M")} a {overlap_details[0]["existing_end"].strftime("%H:%M")}'
+            conflict = find_appointment_conflict(staff_id, appointment_date, appointment_end)
+            if conflict:
+                error_msg = _overlap_error_message(conflict)
                 logger.error(f"Overlap error: {error_msg}")
                 return JsonResponse({'error': error_msg}, status=400)
 
@@ -957,26 +1015,28 @@ class AppointmentAPIView(LoginRequiredMixin, View):
             # 5. Crear la cita
             serializer = AppointmentSerializer(data=data)
             if serializer.is_valid():
-                appointment = serializer.save()
-                logger.info(f"Created appointment: {appointment.id}")
+                # La cita, los slots y los emails (outbox) en la misma transacción
+                with transaction.atomic():
+                    appointment = serializer.save()
+                    logger.info(f"Created appointment: {appointment.id}")
                 
-                # 6. Eliminar slots solapados
-                appointment_end = appointment.date + timedelta(minutes=appointment.duration)
-                deleted_slots = AvailabilitySlot.objects.filter(
-                    staff_id=staff_id,
-                    date=appointment.date.date(),
-                    start_time__lt=appointment_end.time(),
-                    end_time__gt=appointment.date.time()
-                ).delete()
-                logger.info(f"Deleted {deleted_slots[0]} overlapping slots for appointment: {appointment.id}")
+                    # 6. Eliminar slots solapados
+                    appointment_end = appointment.date + timedelta(minutes=appointment.duration)
+                    deleted_slots = AvailabilitySlot.delete_batch(AvailabilitySlot.objects.filter(
+                        staff_id=staff_id,
+                        date=appointment.date.date(),
+                        start_time__lt=appointment_end.time(),
+                        end_time__gt=appointment.date.time()
+                    ))
+                    logger.info(f"Deleted {deleted_slots} overlapping slots for appointment: {appointment.id}")
                 
-                # 7. Enviar email de confirmación
-                try:
-                    send_appointment_confirmation(appointment)
-                    logger.info(f"Confirmation email sent for appointment: {appointment.id}")
-                except Exception as e:
-                    logger.error(f"Error sending confirmation email: {str(e)}", exc_info=True)
-                    # No fallar la creación si el email falla
+                    # 7. Enviar email de confirmación
+                    try:
+                        send_appointment_confirmation(appointment)
+                        logger.info(f"Confirmation email queued for appointment: {appointment.id}")
+                    except Exception as e:
+                        logger.error(f"Error queueing confirmation email: {str(e)}", exc_info=True)
+                        # No fallar la creación si el email falla
                 
                 response_data = serializer.data
                 response_data['duration'] = appointment.duration
@@ -996,7 +1056,7 @@ class AppointmentAPIView(LoginRequiredMixin, View):
         try:
             logger.debug(f"=== APPOINTMENT UPDATE START for ID {appointment_id} ===")
             
-            is_supervisor = request.user.groups.filter(name='Supervisor').exists()
+            is_supervisor = request.staff_access.is_supervisor
             
             # Permitir que los supervisores editen cualquier cita
             if is_supervisor:
@@ -1005,14 +1065,14 @@ class AppointmentAPIView(LoginRequiredMixin, View):
                 appointment = get_object_or_404(
                     Appointment, 
                     id=appointment_id,
-                    staff=request.user.staffprofile
+                    staff_id=request.staff_access.staff_id
                 )
 
             data = json.loads(request.body)
             logger.debug(f"Received PUT data for appointment {appointment_id}: {data}")
 
             if not is_supervisor:
-                data['staff'] = request.user.staffprofile.id
+                data['staff'] = request.staff_access.staff_id
 
             # Guardar fecha anterior para comparación
             old_date = appointment.date
@@ -1033,94 +1093,46 @@ class AppointmentAPIView(LoginRequiredMixin, View):
                 if not isinstance(duration, int) or duration not in [15, 30, 45, 60]:
                     return JsonResponse({'error': 'Duración inválida'}, status=400)
 
-            # CORRECCIÓN: Verificar solapamientos si la fecha cambia CON MENSAJE CORRECTO
+            # Verificar solapamientos si la fecha cambia
             if 'date' in data:
                 staff_id = data.get('staff', appointment.staff_id)
                 duration = data.get('duration', appointment.duration)
                 appointment_end = data['date'] + timedelta(minutes=duration)
                 
-                logger.debug(f"=== DEBUGGING UPDATE OVERLAP CHECK ===")
-                logger.debug(f"Updated appointment: {data['date']} to {appointment_end}")
-                logger.debug(f"Staff ID: {staff_id}, Duration: {duration}")
-                
-                # Obtener citas del mismo día y staff (excluyendo la actual)
-                existing_appointments = Appointment.objects.filter(
-                    staff_id=staff_id,
-                    date__date=data['date'].date()
-                ).exclude(id=appointment_id)
-                
-                logger.debug(f"Found {existing_appointments.count()} existing appointments on {data['date'].date()} (excluding current)")
-                
-                # CORRECCIÓN: Verificar solapamiento con límites exactos permitidos
-                overlap = False
-                overlap_details = []
-                
-                for existing_apt in existing_appointments:
-                    existing_end = existing_apt.date + timedelta(minutes=existing_apt.duration)
-                    
-                    logger.debug(f"Checking existing appointment {existing_apt.id}:")
-                    logger.debug(f"  Existing: {existing_apt.date} to {existing_end}")
-                    logger.debug(f"  Updated:  {data['date']} to {appointment_end}")
-                    
-                    # Hay solapamiento si hay intersección real (no en límites exactos)
-                    if existing_apt.date < appointment_end and existing_end > data['date']:
-                        # CORRECCIÓN: Permitir límites exactos
-                        if existing_end == data['date'] or existing_apt.date == appointment_end:
-                            logger.debug(f"  Límite exacto permitido con appointment {existing_apt.id}")
-                            continue  # No es solapamiento, es límite exacto
-                        
-                        # Hay solapamiento real
-                        overlap = True
-                        
-                        # CORRECCIÓN: Convertir a hora local para el mensaje
-                        existing_local = localtime(existing_apt.date)
-                        existing_end_local = existing_local + timedelta(minutes=existing_apt.duration)
-                        
-                        overlap_details.append({
-                            'existing_id': existing_apt.id,
-                            'existing_start': existing_local,  # Hora local
-                            'existing_end': existing_end_local,  # Hora local
-                            'existing_visitor': existing_apt.visitor_name
-                        })
-                        logger.warning(f"OVERLAP DETECTED with appointment {existing_apt.id}")
-                        break
-                    else:
-                        logger.debug(f"  No overlap with appointment {existing_apt.id}")
-
-                logger.debug(f"Final update overlap result: {overlap}")
-
-                if overlap:
-                    # CORRECCIÓN: Mensaje con horas locales
-                    error_msg = f'Ya existe una cita en este horario. Conflicto con cita de {overlap_details[0]["existing_visitor"]} de {overlap_details[0]["existing_start"].strftime("%H:%M")} a {overlap_details[0]["existing_end"].strftime("%H:%M")}'
+                conflict = find_appointment_conflict(
+                    staff_id, data['date'], appointment_end, exclude_id=appointment_id
+                )
+                if conflict:
+                    error_msg = _overlap_error_message(conflict)
                     logger.error(f"Update overlap error: {error_msg}")
                     return JsonResponse({'error': error_msg}, status=400)
-                
-                logger.debug("No overlaps detected, proceeding with appointment update")
 
             serializer = AppointmentSerializer(appointment, data=data, partial=True)
             if serializer.is_valid():
-                updated_appointment = serializer.save()
-                logger.info(f"Updated appointment: {appointment_id}")
+                # La cita, los slots y el email (outbox) en la misma transacción
+                with transaction.atomic():
+                    updated_appointment = serializer.save()
+                    logger.info(f"Updated appointment: {appointment_id}")
                 
-                # Eliminar slots solapados si cambió la fecha
-                if 'date' in data:
-                    appointment_end = updated_appointment.date + timedelta(minutes=updated_appointment.duration)
-                    deleted_slots = AvailabilitySlot.objects.filter(
-                        staff_id=staff_id,
-                        date=updated_appointment.date.date(),
-                        start_time__lt=appointment_end.time(),
-                        end_time__gt=updated_appointment.date.time()
-                    ).delete()
-                    logger.info(f"Deleted {deleted_slots[0]} overlapping slots for updated appointment: {appointment_id}")
+                    # Eliminar slots solapados si cambió la fecha
+                    if 'date' in data:
+                        appointment_end = updated_appointment.date + timedelta(minutes=updated_appointment.duration)
+                        deleted_slots = AvailabilitySlot.delete_batch(AvailabilitySlot.objects.filter(
+                            staff_id=staff_id,
+                            date=updated_appointment.date.date(),
+                            start_time__lt=appointment_end.time(),
+                            end_time__gt=updated_appointment.date.time()
+                        ))
+                        logger.info(f"Deleted {deleted_slots} overlapping slots for updated appointment: {appointment_id}")
                 
-                # Enviar email de modificación si cambió la fecha
-                if old_date and old_date != updated_appointment.date:
-                    try:
-                        send_appointment_modification(updated_appointment, old_date=old_date)
-                        logger.info(f"Modification email sent for appointment: {appointment_id}")
-                    except Exception as e:
-                        logger.error(f"Error sending modification email: {str(e)}", exc_info=True)
-                        # No fallar la actualización si el email falla
+                    # Enviar email de modificación si cambió la fecha
+                    if old_date and old_date != updated_appointment.date:
+                        try:
+                            send_appointment_modification(updated_appointment, old_date=old_date)
+                            logger.info(f"Modification email queued for appointment: {appointment_id}")
+                        except Exception as e:
+                            logger.error(f"Error queueing modification email: {str(e)}", exc_info=True)
+                            # No fallar la actualización si el email falla
                 
                 response_data = serializer.data
                 response_data['duration'] = updated_appointment.duration
@@ -1138,7 +1150,7 @@ class AppointmentAPIView(LoginRequiredMixin, View):
 
     def delete(self, request, appointment_id):
         try:
-            is_supervisor = request.user.groups.filter(name='Supervisor').exists()
+            is_supervisor = request.staff_access.is_supervisor
             
             # Permitir que los supervisores eliminen cualquier cita
             if is_supervisor:
@@ -1147,18 +1159,20 @@ class AppointmentAPIView(LoginRequiredMixin, View):
                 appointment = get_object_or_404(
                     Appointment, 
                     id=appointment_id,
-                    staff=request.user.staffprofile
+                    staff_id=request.staff_access.staff_id
                 )
 
-            # Enviar email de cancelación antes de eliminar
-            try:
-                send_appointment_cancellation(appointment, cancelled_by='staff')
-                logger.info(f"Cancellation email sent for appointment: {appointment_id}")
-            except Exception as e:
-                logger.error(f"Error sending cancellation email: {str(e)}", exc_info=True)
-                # Continuar con la eliminación aunque falle el email
+            # Los emails (outbox) y el borrado en la misma transacción
+            with transaction.atomic():
+                # Enviar email de cancelación antes de eliminar
+                try:
+                    send_appointment_cancellation(appointment, cancelled_by='staff')
+                    logger.info(f"Cancellation email queued for appointment: {appointment_id}")
+                except Exception as e:
+                    logger.error(f"Error queueing cancellation email: {str(e)}", exc_info=True)
+                    # Continuar con la eliminación aunque falle el email
 
-            appointment.delete()
+                appointment.delete()
             logger.info(f"Deleted appointment: {appointment_id}")
             return JsonResponse({'status': 'success'})
 
@@ -1169,6 +1183,241 @@ class AppointmentAPIView(LoginRequiredMixin, View):
             logger.error(f"Error deleting appointment: {str(e)}", exc_info=True)
             return JsonResponse({'error': str(e)}, status=500)
 
+class BulkAppointmentAPIView(LoginRequiredMixin, View):
+    """
+    Alta de muchas citas en una sola petición (jornadas de puertas abiertas).
+
+    Recibe {"appointments": [...]} con los mismos campos y validaciones que
+    AppointmentAPIView. Etapas, cursos y staff se cargan de una vez; dentro de
+    la transacción los solapes se comprueban con un único barrido (ver
+    scheduling.find_batch_conflicts) y, si todas son válidas, se insertan con
+    bulk_create; si alguna falla no se crea ninguna.
+    """
+    MAX_APPOINTMENTS = 200
+    REQUIRED_FIELDS = ['visitor_name', 'visitor_email', 'visitor_phone', 'stage', 'date']
+
+    @method_decorator(idempotent)
+    def post(self, request):
+        try:
+            data = json.loads(request.body)
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Invalid JSON data'}, status=400)
+
+        items = data.get('appointments') if isinstance(data, dict) else data
+        if not isinstance(items, list) or not items:
+            return JsonResponse({'error': 'Se esperaba una lista de citas en "appointments"'}, status=400)
+        if len(items) > self.MAX_APPOINTMENTS:
+            return JsonResponse({'error': f'Máximo {self.MAX_APPOINTMENTS} citas por petición'}, status=400)
+
+        try:
+            is_supervisor = request.staff_access.is_supervisor
+            own_staff_id = request.staff_access.staff_id
+
+            # Todo lo que hay que validar, con una consulta por tabla
+            stages = {stage.id: stage for stage in SchoolStage.objects.prefetch_related('courses')}
+            staff_ids = {own_staff_id}
+            if is_supervisor:
+                staff_ids.update(_parse_id(item.get('staff')) for item in items if isinstance(item, dict) and item.get('staff'))
+            staff_profiles = {
+                staff.id: staff
+                for staff in StaffProfile.objects.filter(id__in=[
+                    staff_id for staff_id in staff_ids if staff_id is not None
+                ]).select_related('user').prefetch_related('allowed_stages')
+            }
+
+            errors = []
+            appointments = []
+            for index, item in enumerate(items):
+                appointment, error = self._build_appointment(item, is_supervisor, own_staff_id, stages, staff_profiles)
+                if error:
+                    errors.append({'index': index, 'error': error})
+                else:
+                    appointments.append((index, appointment))
+
+            with transaction.atomic():
+                # Solapes contra la agenda y entre las propias citas del lote,
+                # bloqueando las citas leídas como en las altas individuales
+                conflicts = find_batch_conflicts([
+                    (appointment.staff_id, appointment.date, appointment.duration, appointment.visitor_name)
+                    for _, appointment in appointments
+                ], lock=True)
+                for position, details in conflicts.items():
+                    errors.append({'index': appointments[position][0], 'error': _conflict_message(details)})
+
+                if errors:
+                    errors.sort(key=lambda error: error['index'])
+                    logger.warning(f"Bulk appointment creation rejected: {len(errors)} invalid of {len(items)}")
+                    return JsonResponse({'error': 'Hay citas no válidas; no se ha creado ninguna', 'errors': errors}, status=400)
+
+                # Slots cubiertos, todos con un mismo borrado; create_batch
+                # refresca después la disponibilidad de esos staff y días
+                covered = Q()
+                for _, appointment in appointments:
+                    start_local = localtime(appointment.date)
+                    end_local = start_local + timedelta(minutes=appointment.duration)
+                    covered.add(Q(
+                        staff_id=appointment.staff_id,
+                        date=start_local.date(),
+                        start_time__lt=end_local.time(),
+                        end_time__gt=start_local.time()
+                    ), Q.OR)
+                deleted_slots = AvailabilitySlot.delete_batch(AvailabilitySlot.objects.filter(covered), refresh=False)
+
+                created = Appointment.create_batch([appointment for _, appointment in appointments])
+
+                try:
+                    send_appointment_confirmations(created)
+                except Exception as e:
+                    logger.error(f"Error queueing bulk confirmation emails: {str(e)}", exc_info=True)
+
+            logger.info(f"Bulk created {len(created)} appointments, deleted {deleted_slots} overlapping slots")
+            return JsonResponse({
+                'status': 'success',
+                'created': len(created),
+                'appointments': [AppointmentSerializer(appointment).data for appointment in created]
+            })
+
+        except Exception as e:
+            logger.error(f"Error in bulk appointment creation: {str(e)}", exc_info=True)
+            return JsonResponse({'error': str(e)}, status=500)
+
+    def _build_appointment(self, item, is_supervisor, own_staff_id, stages, staff_profiles):
+        """Cita sin guardar a partir de un elemento del lote, o (None, error)"""
+        if not isinstance(item, dict):
+            return None, 'Formato de cita inválido'
+
+        missing = [field for field in self.REQUIRED_FIELDS if not item.get(field)]
+        if missing:
+            return None, f'Faltan campos obligatorios: {", ".join(missing)}'
+
+        try:
+            appointment_date = make_aware(datetime.fromisoformat(item['date']))
+        except (TypeError, ValueError):
+            return None, 'Formato de fecha inválido'
+
+        # Mismas reglas que AppointmentAPIView (longitudes, email, teléfono, duración)
+        serializer = AppointmentBatchItemSerializer(data={
+            field: item[field] for field in AppointmentBatchItemSerializer.Meta.fields if field in item
+        } | {'date': appointment_date, 'duration': item.get('duration', 60)})
+        if not serializer.is_valid():
+            return None, serializer.errors
+        data = serializer.validated_data
+        if data['status'] not in dict(Appointment.STATUS_CHOICES):
+            return None, 'Estado inválido'
+
+        staff_id = (item.get('staff') or own_staff_id) if is_supervisor else own_staff_id
+        staff = staff_profiles.get(_parse_id(staff_id))
+        if staff is None:
+            return None, 'Staff no encontrado'
+
+        stage = stages.get(_parse_id(item['stage']))
+        if stage is None:
+            return None, 'Etapa no encontrada'
+        if stage not in staff.allowed_stages.all():
+            return None, 'Este miembro del staff no puede atender citas de esta etapa.'
+
+        courses = {course.id: course for course in stage.courses.all()}
+        course = None
+        if item.get('course'):
+            course = courses.get(_parse_id(item['course']))
+            if course is None:
+                return None, 'El curso seleccionado no pertenece a la etapa elegida.'
+        elif courses:
+            return None, 'Debes seleccionar un curso para esta etapa educativa.'
+
+        return Appointment(stage=stage, course=course, staff=staff, **data), None
+
+
+def _parse_id(value):
+    """Id entero de un valor del JSON, o None si no lo es"""
+    text = str(value)
+    return int(text) if text.isdecimal() else None
+
+
+class AppointmentStatusBulkView(LoginRequiredMixin, View):
+    """
+    Cambia el estado de muchas citas con un solo UPDATE (p. ej. marcar como
+    realizadas las de un día de visitas).
+
+    Recibe {"status": "completed", "ids": [...]} o {"status": ..., "filters":
+    {"date", "stage", "status", "staff_id"}} con los mismos filtros que el
+    listado. El staff solo puede cambiar sus citas; los supervisores, todas.
+    """
+
+    FILTER_KEYS = ('date', 'stage', 'status', 'staff_id')
+
+    def post(self, request):
+        try:
+            data = json.loads(request.body)
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Datos JSON inválidos'}, status=400)
+        if not isinstance(data, dict):
+            return JsonResponse({'error': 'Datos JSON inválidos'}, status=400)
+
+        status = data.get('status')
+        if status not in dict(Appointment.STATUS_CHOICES):
+            return JsonResponse({'error': 'Estado inválido'}, status=400)
+
+        ids = data.get('ids')
+        filters = data.get('filters')
+        if not ids and not filters:
+            return JsonResponse({'error': 'Indica los IDs de las citas o algún filtro'}, status=400)
+
+        try:
+            is_supervisor = request.staff_access.is_supervisor
+            queryset = Appointment.objects.all()
+            if not is_supervisor:
+                queryset = queryset.filter(staff_id=request.staff_access.staff_id)
+
+            if ids:
+                if not isinstance(ids, list) or not all(str(appointment_id).isdigit() for appointment_id in ids):
+                    return JsonResponse({'error': 'Lista de IDs inválida'}, status=400)
+                queryset = queryset.filter(id__in=ids)
+            if filters:
+                error = self._validate_filters(filters, is_supervisor)
+                if error:
+                    return JsonResponse({'error': error}, status=400)
+                queryset = _filter_appointments(queryset, filters, is_supervisor)
+
+            updated = Appointment.bulk_set_status(queryset, status)
+            logger.info(f"Bulk status change to '{status}' by {request.user.username}: {updated} appointments")
+            return JsonResponse({'status': 'success', 'updated': updated})
+
+        except Exception as e:
+            logger.error(f"Error in bulk status change: {str(e)}", exc_info=True)
+            return JsonResponse({'error': str(e)}, status=500)
+
+    def _validate_filters(self, filters, is_supervisor):
+        """
+        Mensaje de error, o None si los filtros son válidos. Tiene que quedar al
+        menos un filtro con valor: unos filtros vacíos o desconocidos cambiarían
+        todas las citas a las que llega el usuario.
+        """
+        if not isinstance(filters, dict):
+            return 'Filtros inválidos'
+        unknown = set(filters) - set(self.FILTER_KEYS)
+        if unknown:
+            return f'Filtros desconocidos: {", ".join(sorted(map(str, unknown)))}'
+
+        values = {key: str(value).strip() for key, value in filters.items() if value not in (None, '')}
+        if not is_supervisor:
+            # El staff solo ve sus citas: staff_id no filtra nada
+            values.pop('staff_id', None)
+        if not any(values.values()):
+            return 'Indica al menos un filtro con valor'
+
+        if 'date' in values:
+            try:
+                datetime.strptime(values['date'], '%Y-%m-%d')
+            except ValueError:
+                return 'Fecha inválida (formato AAAA-MM-DD)'
+        if 'status' in values and values['status'] not in dict(Appointment.STATUS_CHOICES):
+            return 'Estado del filtro inválido'
+        for key in ('stage', 'staff_id'):
+            if key in values and not values[key].isdigit():
+                return f'{key} inválido'
+        return None
+
 class PrivacyPolicyView(TemplateView):
     template_name = 'visits/privacy_policy.html'
 
@@ -1203,24 +1452,24 @@ class DashboardView(LoginRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         
-        if hasattr(self.request.user, 'staffprofile'):
-            staff_profile = self.request.user.staffprofile
-            # Verificar si el usuario pertenece al grupo Supervisor
-            is_supervisor = self.request.user.groups.filter(name='Supervisor').exists()
+        # Rol, perfil y etapas resueltos por StaffAccessMiddleware
+        access = self.request.staff_access
+        if access.has_profile:
+            is_supervisor = access.is_supervisor
             
             # CORREGIDO: Todos los usuarios (incluidos supervisores) solo ven sus etapas asignadas
             # Cada staff solo puede crear citas para las etapas donde está autorizado
-            context['all_stages'] = staff_profile.allowed_stages.all()
+            context['all_stages'] = SchoolStage.objects.filter(id__in=access.stage_ids)
             
             # Solo incluir lista de staff para supervisores
             if is_supervisor:
                 context['staff_list'] = StaffProfile.objects.exclude(
-                    id=staff_profile.id
+                    id=access.staff_id
                 ).select_related('user').all()
             
             # Citas del usuario actual
             context['appointments'] = Appointment.objects.filter(
-                staff=staff_profile
+                staff_id=access.staff_id
             ).select_related('stage', 'course')
 
             # Generar horas disponibles (8:00 - 20:00)
@@ -1241,7 +1490,7 @@ class DashboardView(LoginRequiredMixin, TemplateView):
                 'is_supervisor': is_supervisor,
                 'dashboard_config': {
                     'isSupervisor': is_supervisor,
-                    'staffId': staff_profile.id,
+                    'staffId': access.staff_id,
                     'csrfToken': get_token(self.request),
                     'apiUrl': reverse('api_appointments'),
                     'calendarUrl': reverse('dashboard_calendar'),
@@ -1261,14 +1510,14 @@ class DashboardView(LoginRequiredMixin, TemplateView):
 class DashboardCalendarView(LoginRequiredMixin, View):
     def get(self, request):
         try:
-            if not hasattr(request.user, 'staffprofile'):
+            access = request.staff_access
+            if not access.has_profile:
                 return JsonResponse({'error': 'Perfil no encontrado'}, status=404)
                 
-            staff_profile = request.user.staffprofile
             staff_id = request.GET.get('staff_id')
             start_str = request.GET.get('start')
             end_str = request.GET.get('end')
-            is_supervisor = request.user.groups.filter(name='Supervisor').exists()
+            is_supervisor = access.is_supervisor
 
             # Validar y procesar fechas
             try:
@@ -1277,57 +1526,89 @@ class DashboardCalendarView(LoginRequiredMixin, View):
             except ValueError as e:
                 return JsonResponse({'error': str(e)}, status=400)
 
-            # Construir query base
-            appointments_query = Appointment.objects.select_related('stage', 'course', 'staff__user')
-            
-            # Aplicar filtros según permisos
-            if is_supervisor:
-                if staff_id == 'global':
-                    pass  # No filtrar
-                elif staff_id and staff_id.isdigit():
-                    appointments_query = appointments_query.filter(staff_id=int(staff_id))
-                else:
-                    appointments_query = appointments_query.filter(staff=staff_profile)
+            # Ámbito: todas las citas (global), las de otro staff o las propias
+            if is_supervisor and staff_id == 'global':
+                scope = GLOBAL_SCOPE
+            elif is_supervisor and staff_id and staff_id.isdigit():
+                scope = int(staff_id)
             else:
-                appointments_query = appointments_query.filter(staff=staff_profile)
-
-            # Filtrar por rango de fechas
-            appointments = appointments_query.filter(
-                date__range=(start, end)
-            ).order_by('date')
-
-            # Formatear eventos
-            events = []
-            for apt in appointments:
-                end_time = apt.date + timedelta(minutes=apt.duration)
-                course_info = f" - {apt.course.name}" if apt.course else ""
-                event = {
-                    'id': apt.id,
-                    'title': f'{apt.visitor_name}{course_info}',
-                    'start': apt.date.isoformat(),
-                    'end': end_time.isoformat(),
-                    'backgroundColor': self._get_status_color(apt.status),
-                    'borderColor': self._get_status_color(apt.status),
-                    'extendedProps': {
-                        'staffId': apt.staff.id,
-                        'status': apt.status,
-                        'stage': apt.stage.name,
-                        'course': apt.course.name if apt.course else '',
-                        'visitor_name': apt.visitor_name,
-                        'visitor_email': apt.visitor_email,
-                        'visitor_phone': apt.visitor_phone,
-                        'duration': apt.duration,
-                        'staff_name': apt.staff.user.get_full_name()
+                scope = access.staff_id
+
+            role = 'supervisor' if is_supervisor else 'staff'
+            params = (start.isoformat(), end.isoformat())
+
+            # Modo sync (sync=1 o sync_token): con un token válido, solo los cambios
+            if request.GET.get('sync') or 'sync_token' in request.GET:
+                since = parse_sync_token(request.GET.get('sync_token'))
+                if since is not None:
+                    return JsonResponse(self._get_changes(scope, start, end, since))
+                # Carga completa del rango, con su token; también compartida
+                return JsonResponse(get_dashboard_data(
+                    'calendar-sync', role, scope, params,
+                    lambda: {
+                        'full': True,
+                        'sync_token': make_sync_token(),
+                        'events': self._get_events(scope, start, end),
+                        'deleted': []
                     }
-                }
-                events.append(event)
+                ))
 
+            # Supervisores con el mismo ámbito y rango comparten el resultado
+            events = get_dashboard_data(
+                'calendar', role, scope, params,
+                lambda: self._get_events(scope, start, end)
+            )
             return JsonResponse(events, safe=False)
 
         except Exception as e:
             logger.error(f"Error obteniendo eventos del calendario: {str(e)}", exc_info=True)
             return JsonResponse({'error': str(e)}, status=500)
 
+    def _get_events(self, scope, start, end):
+        appointments = Appointment.objects.select_related('stage', 'course', 'staff__user').filter(
+            date__range=(start, end)
+        ).order_by('date')
+        if scope != GLOBAL_SCOPE:
+            appointments = appointments.filter(staff_id=scope)
+        return [self._event(apt) for apt in appointments]
+
+    def _get_changes(self, scope, start, end, since):
+        """Citas nuevas o modificadas e ids a quitar del rango desde `since`"""
+        sync_token = make_sync_token()
+        changed, deleted = calendar_changes(None if scope == GLOBAL_SCOPE else scope, start, end, since)
+        events = [self._event(apt) for apt in changed.select_related('stage', 'course', 'staff__user').order_by('date')]
+        logger.debug(f"Calendario sync ({scope}): {len(events)} cambios, {len(deleted)} eliminadas")
+        return {
+            'full': False,
+            'sync_token': sync_token,
+            'events': events,
+            'deleted': deleted
+        }
+
+    def _event(self, apt):
+        # Formatear evento
+        end_time = apt.date + timedelta(minutes=apt.duration)
+        course_info = f" - {apt.course.name}" if apt.course else ""
+        return {
+            'id': apt.id,
+            'title': f'{apt.visitor_name}{course_info}',
+            'start': apt.date.isoformat(),
+            'end': end_time.isoformat(),
+            'backgroundColor': self._get_status_color(apt.status),
+            'borderColor': self._get_status_color(apt.status),
+            'extendedProps': {
+                'staffId': apt.staff.id,
+                'status': apt.status,
+                'stage': apt.stage.name,
+                'course': apt.course.name if apt.course else '',
+                'visitor_name': apt.visitor_name,
+                'visitor_email': apt.visitor_email,
+                'visitor_phone': apt.visitor_phone,
+                'duration': apt.duration,
+                'staff_name': apt.staff.user.get_full_name()
+            }
+        }
+
     def _parse_date(self, date_str):
         try:
             date = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
@@ -1347,138 +1628,67 @@ class DashboardCalendarView(LoginRequiredMixin, View):
 class DashboardStatsView(LoginRequiredMixin, View):
     def get(self, request):
         try:
-            if not hasattr(request.user, 'staffprofile'):
+            access = request.staff_access
+            if not access.has_profile:
                 return JsonResponse({'error': 'Perfil no encontrado'}, status=404)
                 
-            staff_profile = request.user.staffprofile
             staff_id = request.GET.get('staff_id')
-            is_supervisor = request.user.groups.filter(name='Supervisor').exists()
+            is_supervisor = access.is_supervisor
             
             logger.info(f"DashboardStatsView: user={request.user.username}, staff_id param={staff_id}, is_supervisor={is_supervisor}")
             
             today = timezone.now()
-            today_start = timezone.localtime(today).replace(hour=0, minute=0, second=0)
-            today_end = today_start + timedelta(days=1)
             
             # Determinar el perfil objetivo y queryset base
             base_queryset = Appointment.objects.select_related('stage', 'course', 'staff__user')
-            target_profile = staff_profile  # Por defecto, el usuario actual
+            rollups = AppointmentRollup.objects.all()
+            stage_ids = access.stage_ids  # Etapas a mostrar: por defecto, las del usuario actual
+            scope = access.staff_id  # Staff cuyas citas se cuentan (o GLOBAL_SCOPE)
             viewing_all = False  # Flag para saber si está viendo "todas las citas"
             
             if is_supervisor:
                 if staff_id == 'global':
                     # Vista global: no filtrar por staff
                     viewing_all = True
+                    scope = GLOBAL_SCOPE
                     logger.info("Vista global - no filtering by staff")
                 elif staff_id and staff_id.isdigit():
                     # Vista de un staff específico
                     base_queryset = base_queryset.filter(staff_id=int(staff_id))
+                    rollups = rollups.filter(staff_id=int(staff_id))
+                    scope = int(staff_id)
                     try:
-                        target_staff = StaffProfile.objects.get(id=int(staff_id))
-                        target_profile = target_staff
+                        target_staff = StaffProfile.objects.select_related('user').get(id=int(staff_id))
+                        stage_ids = list(target_staff.allowed_stages.values_list('id', flat=True))
                         logger.info(f"Vista de staff específico: {target_staff.user.get_full_name()} (ID: {staff_id})")
                     except StaffProfile.DoesNotExist:
                         logger.warning(f"StaffProfile {staff_id} no encontrado")
                 else:
                     # Vista propia del supervisor (sin staff_id o vacío)
-                    base_queryset = base_queryset.filter(staff=staff_profile)
-                    logger.info(f"Vista propia del supervisor: {staff_profile.user.get_full_name()}")
+                    base_queryset = base_queryset.filter(staff_id=access.staff_id)
+                    rollups = rollups.filter(staff_id=access.staff_id)
+                    logger.info(f"Vista propia del supervisor: {request.user.get_full_name()}")
             else:
                 # Usuario normal: solo sus citas
-                base_queryset = base_queryset.filter(staff=staff_profile)
-                logger.info(f"Usuario normal: {staff_profile.user.get_full_name()}")
-
-            # Log del queryset para debug
-            total_appointments = base_queryset.count()
-            logger.info(f"Total appointments in base_queryset: {total_appointments}")
-            
-            # Estadísticas básicas
-            today_count = base_queryset.filter(date__range=(today_start, today_end)).count()
-            confirmed_count = base_queryset.filter(status='completed').count()
-            # CORREGIDO: Contar TODAS las pendientes futuras (no solo de hoy en adelante)
-            pending_count = base_queryset.filter(status='pending', date__gte=today_start).count()
-            
-            logger.info(f"Stats: today={today_count}, confirmed={confirmed_count}, pending={pending_count}")
-            
-            stats = {
-                'today_count': today_count,
-                'confirmed_count': confirmed_count,
-                'pending_count': pending_count,
-                'stages_count': SchoolStage.objects.count() if viewing_all else target_profile.allowed_stages.count()
-            }
+                base_queryset = base_queryset.filter(staff_id=access.staff_id)
+                rollups = rollups.filter(staff_id=access.staff_id)
+                logger.info(f"Usuario normal: {request.user.get_full_name()}")
 
-            # Estadísticas por etapa
-            stages_distribution = []
-            
             # Etapas a considerar según la vista
             if viewing_all:
                 stages_queryset = SchoolStage.objects.all()
             else:
-                stages_queryset = target_profile.allowed_stages.all()
-            
-            for stage in stages_queryset:
-                stage_count = base_queryset.filter(stage=stage).count()
-                if stage_count > 0:  # Solo incluir etapas con citas
-                    stages_distribution.append({
-                        'stage': stage.name,
-                        'count': stage_count
-                    })
-            
-            logger.info(f"Stages distribution: {stages_distribution}")
-
-            # Horas más populares
-            popular_hours_query = (
-                base_queryset
-                .filter(date__gte=today_start)
-                .annotate(
-                    hour=ExtractHour('date', tzinfo=timezone.get_current_timezone())
-                )
-                .values('hour')
-                .annotate(count=Count('id'))
-                .order_by('-count')[:10]
+                stages_queryset = SchoolStage.objects.filter(id__in=stage_ids)
+
+            # Supervisores con el mismo ámbito comparten el resultado durante unos segundos
+            response_data = get_dashboard_data(
+                'stats',
+                'supervisor' if is_supervisor else 'staff',
+                scope,
+                (timezone.localdate(today), 'all' if viewing_all else ','.join(map(str, sorted(stage_ids)))),
+                lambda: self._get_stats(base_queryset, rollups, stages_queryset, today)
             )
             
-            popular_hours = [
-                {
-                    'hour': f"{item['hour']:02d}:00",
-                    'count': item['count']
-                } for item in popular_hours_query
-            ]
-
-            # Próximas citas
-            upcoming = (
-                base_queryset
-                .filter(
-                    date__gte=today,
-                    status='pending'
-                )
-                .order_by('date')[:5]
-            )
-            
-            logger.info(f"Upcoming appointments: {upcoming.count()}")
-
-            response_data = {
-                'stages_distribution': stages_distribution,
-                'popular_hours': popular_hours,
-                'upcoming_appointments': [
-                    {
-                        'id': apt.id,
-                        'visitor_name': apt.visitor_name,
-                        'stage__name': apt.stage.name,
-                        'stage': apt.stage.name,
-                        'course__name': apt.course.name if apt.course else '',
-                        'course': apt.course.name if apt.course else '',
-                        'date': timezone.localtime(apt.date).isoformat(),
-                        'time': timezone.localtime(apt.date).strftime('%H:%M'),
-                        'status': apt.status,
-                        'staff_name': apt.staff.user.get_full_name(),
-                        'staff_id': apt.staff.id,
-                        'student_name': apt.notes.split('Alumno:')[1].split('\n')[0].strip() if apt.notes and 'Alumno:' in apt.notes else ''
-                    } for apt in upcoming
-                ],
-                **stats
-            }
-            
             logger.info(f"Returning response with {len(response_data.get('upcoming_appointments', []))} upcoming appointments")
 
             return JsonResponse(response_data)
@@ -1486,6 +1696,52 @@ class DashboardStatsView(LoginRequiredMixin, View):
         except Exception as e:
             logger.error(f"Error obteniendo estadísticas: {str(e)}", exc_info=True)
             return JsonResponse({'error': str(e)}, status=500)
+
+    def _get_stats(self, base_queryset, rollups, stages_queryset, today):
+        # Contadores y distribuciones: del resumen de citas (AppointmentRollup)
+        stats = dashboard_stats(rollups, stages_queryset, now=today)
+        stages_distribution = stats.pop('stages_distribution')
+        popular_hours = stats.pop('popular_hours')
+        
+        logger.info(
+            f"Stats: total={stats['total_count']}, today={stats['today_count']}, "
+            f"confirmed={stats['confirmed_count']}, pending={stats['pending_count']}"
+        )
+
+        # Próximas citas
+        upcoming = list(
+            base_queryset
+            .filter(
+                date__gte=today,
+                status='pending'
+            )
+            .order_by('date')[:5]
+        )
+        
+        logger.info(f"Upcoming appointments: {len(upcoming)}")
+
+        response_data = {
+            'stages_distribution': stages_distribution,
+            'popular_hours': popular_hours,
+            'upcoming_appointments': [
+                {
+                    'id': apt.id,
+                    'visitor_name': apt.visitor_name,
+                    'stage__name': apt.stage.name,
+                    'stage': apt.stage.name,
+                    'course__name': apt.course.name if apt.course else '',
+                    'course': apt.course.name if apt.course else '',
+                    'date': timezone.localtime(apt.date).isoformat(),
+                    'time': timezone.localtime(apt.date).strftime('%H:%M'),
+                    'status': apt.status,
+                    'staff_name': apt.staff.user.get_full_name(),
+                    'staff_id': apt.staff.id,
+                    'student_name': apt.notes.split('Alumno:')[1].split('\n')[0].strip() if apt.notes and 'Alumno:' in apt.notes else ''
+                } for apt in upcoming
+            ],
+            **stats
+        }
+        return response_data
         
 # ====================================
 # Part 9: Export Functions